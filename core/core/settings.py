@@ -53,6 +53,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.utils.middleware.TracingMiddleware',
+    'core.utils.middleware.QueryCountMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -98,6 +100,15 @@ DATABASES = {
     }
 }
 
+# DB_ENGINE=sqlite runs without Postgres (local benchmarks and checks)
+if os.getenv('DB_ENGINE') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -168,6 +179,160 @@ CHANNEL_LAYERS = {
         },
     }
 }
+
+# Streamed answers over WebSockets (teaching.consumers). WEBSOCKET_URL is the
+# ws(s):// origin serving core.asgi when it is not the page's own host, e.g.
+# daphne on its own port next to gunicorn.
+WEBSOCKET_URL = os.getenv('WEBSOCKET_URL', '')
+STREAMING_PARTIAL_INTERVAL_MS = int(os.getenv('STREAMING_PARTIAL_INTERVAL_MS', '1000'))
+# Partials only transcribe this much of the end of the recording, so each costs the same however long the answer
+STREAMING_PARTIAL_WINDOW_SECONDS = float(os.getenv('STREAMING_PARTIAL_WINDOW_SECONDS', '10'))
+
+# Whisper configuration
+# The model is loaded on first use. With TRANSCRIPTION_WORKERS=0 (Whisper inline
+# in the web process), set WHISPER_PRELOAD=1 together with `gunicorn --preload`
+# to load it once in the master so forked workers share it. With a worker pool
+# each pool process loads its own copy and WHISPER_PRELOAD is ignored.
+WHISPER_MODEL_NAME = os.getenv('WHISPER_MODEL_NAME', 'base')
+WHISPER_DEVICE = os.getenv('WHISPER_DEVICE', 'cpu')
+WHISPER_NUM_THREADS = int(os.getenv('WHISPER_NUM_THREADS', '0'))  # 0 keeps torch's default
+WHISPER_DOWNLOAD_ROOT = os.getenv('WHISPER_DOWNLOAD_ROOT') or None
+WHISPER_PRELOAD = os.getenv('WHISPER_PRELOAD', '0') == '1'
+# Inference backend: 'torch', 'torch-int8' (dynamic int8 quantization) or 'onnx'
+# (encoder in ONNX Runtime, created with `manage.py export_whisper_model`; torch
+# is used instead if onnxruntime or the exported file is missing)
+WHISPER_BACKEND = os.getenv('WHISPER_BACKEND', 'torch')
+WHISPER_ONNX_DIR = os.getenv('WHISPER_ONNX_DIR', os.path.join(BASE_DIR, 'models'))
+
+# Transcription worker pool (per web process). 0 workers runs Whisper inline.
+# Every gunicorn worker and daphne has its own pool, so this many model copies
+# are loaded per web process: size it as web processes x workers <= cores.
+TRANSCRIPTION_WORKERS = int(os.getenv('TRANSCRIPTION_WORKERS', '2'))
+# 'spawn' (default) or 'forkserver'; 'fork' from a threaded web worker with torch loaded can deadlock
+TRANSCRIPTION_START_METHOD = os.getenv('TRANSCRIPTION_START_METHOD', 'spawn')
+TRANSCRIPTION_QUEUE_SIZE = int(os.getenv('TRANSCRIPTION_QUEUE_SIZE', '8'))  # jobs allowed to wait for a worker
+TRANSCRIPTION_TIMEOUT = float(os.getenv('TRANSCRIPTION_TIMEOUT', '30'))  # seconds per job
+TRANSCRIPTION_RETRY_AFTER = int(os.getenv('TRANSCRIPTION_RETRY_AFTER', '5'))  # Retry-After seconds on a 503
+# Micro-batching: utterances arriving within the window are decoded as one batch. 1 disables it.
+TRANSCRIPTION_MAX_BATCH = int(os.getenv('TRANSCRIPTION_MAX_BATCH', '8'))
+TRANSCRIPTION_BATCH_WINDOW_MS = int(os.getenv('TRANSCRIPTION_BATCH_WINDOW_MS', '75'))
+# Short-utterance mode: trim silence and cap the decode length from the expected sentence.
+WHISPER_SHORT_UTTERANCE = os.getenv('WHISPER_SHORT_UTTERANCE', '1') == '1'
+# Also shrink the encoder window to the trimmed audio instead of a padded 30s (check accuracy first)
+WHISPER_SHORT_AUDIO_CTX = os.getenv('WHISPER_SHORT_AUDIO_CTX', '0') == '1'
+
+# How spoken answers are scored: 'transcribe' (Whisper transcript + string comparison)
+# or 'forced' (teacher-forced likelihood of the expected sentence, per-word confidence)
+SCORING_ENGINE = os.getenv('SCORING_ENGINE', 'transcribe')
+
+# Audio guardrails: uploads outside these limits, or silent ones, are refused
+# with a specific error before Whisper runs
+AUDIO_MAX_UPLOAD_BYTES = int(os.getenv('AUDIO_MAX_UPLOAD_BYTES', str(5 * 1024 * 1024)))
+AUDIO_MAX_SECONDS = float(os.getenv('AUDIO_MAX_SECONDS', '30'))
+AUDIO_MIN_SECONDS = float(os.getenv('AUDIO_MIN_SECONDS', '0.3'))
+AUDIO_SILENCE_DB = float(os.getenv('AUDIO_SILENCE_DB', '-50'))  # loudest 20ms frame, dBFS
+
+# Class that writes conversations: the Gemini-backed ConversationAI, or
+# core.utils.conversation_ai.StubConversationAI (built-in dialogues, no API key)
+CONVERSATION_AI_BACKEND = os.getenv('CONVERSATION_AI_BACKEND', 'core.utils.conversation_ai.ConversationAI')
+
+# Gemini calls: per-attempt timeout (seconds), retries with jittered exponential
+# backoff (BACKOFF is the base delay, seconds), and a circuit breaker that after
+# BREAKER_THRESHOLD consecutive failures serves the built-in fallback conversations
+# without calling Gemini for BREAKER_RESET seconds
+CONVERSATION_AI_TIMEOUT = float(os.getenv('CONVERSATION_AI_TIMEOUT', '20'))
+CONVERSATION_AI_RETRIES = int(os.getenv('CONVERSATION_AI_RETRIES', '2'))
+CONVERSATION_AI_BACKOFF = float(os.getenv('CONVERSATION_AI_BACKOFF', '0.5'))
+CONVERSATION_AI_BREAKER_THRESHOLD = int(os.getenv('CONVERSATION_AI_BREAKER_THRESHOLD', '5'))
+CONVERSATION_AI_BREAKER_RESET = float(os.getenv('CONVERSATION_AI_BREAKER_RESET', '30'))
+
+# Ready dialogues per topic, kept by `manage.py refill_dialogue_pool`: a topic
+# with fewer than DIALOGUE_POOL_LOW_WATER is topped up to DIALOGUE_POOL_SIZE
+DIALOGUE_POOL_SIZE = int(os.getenv('DIALOGUE_POOL_SIZE', '10'))
+DIALOGUE_POOL_LOW_WATER = int(os.getenv('DIALOGUE_POOL_LOW_WATER', '3'))
+# Topics typed by students are only refilled while in use (a session in the
+# last DIALOGUE_POOL_CUSTOM_RECENT_DAYS days), and only to DIALOGUE_POOL_CUSTOM_SIZE
+DIALOGUE_POOL_CUSTOM_SIZE = int(os.getenv('DIALOGUE_POOL_CUSTOM_SIZE', '2'))
+DIALOGUE_POOL_CUSTOM_RECENT_DAYS = int(os.getenv('DIALOGUE_POOL_CUSTOM_RECENT_DAYS', '7'))
+
+# Background jobs (core.utils.jobs), e.g. generating a dialogue for a topic with
+# an empty pool when the client asks for it asynchronously: threads per process
+# (0 runs jobs inline), how long a job's status can be polled and how long a job
+# may stay pending without an update before it is reported as failed, in seconds
+BACKGROUND_JOB_WORKERS = int(os.getenv('BACKGROUND_JOB_WORKERS', '4'))
+BACKGROUND_JOB_TTL = int(os.getenv('BACKGROUND_JOB_TTL', '3600'))
+BACKGROUND_JOB_TIMEOUT = int(os.getenv('BACKGROUND_JOB_TIMEOUT', '300'))
+
+# Typed topic names resolved to existing topics (see core.utils.topic_cache):
+# keys of the newest active topics indexed per process for near matches, and the
+# minimum RapidFuzz score, 0-100, for a near match (a typo) to reuse a topic.
+# 0, the default, only matches identical normalized names; lower than about 95
+# matches different topics that differ by a letter ("car" and "cat")
+TOPIC_CACHE_SIZE = int(os.getenv('TOPIC_CACHE_SIZE', '1024'))
+TOPIC_MATCH_THRESHOLD = int(os.getenv('TOPIC_MATCH_THRESHOLD', '0'))
+
+# Edit-distance backend for spelling scores: 'rapidfuzz' (C++), 'myers'
+# (bit-parallel pure Python) or 'python' (the original reference loop)
+LEVENSHTEIN_BACKEND = os.getenv('LEVENSHTEIN_BACKEND', 'rapidfuzz')
+
+# Dialogues whose expected responses are kept compiled in memory (per process, LRU)
+EXPECTED_INDEX_CACHE_SIZE = int(os.getenv('EXPECTED_INDEX_CACHE_SIZE', '512'))
+
+# Topic difficulties scored by sound rather than spelling (comma separated, e.g.
+# "easy,medium"): homophones such as their/there then count as correct. Words
+# are looked up in the pronouncing dictionary built by build_phonetic_dictionary,
+# falling back to Metaphone for words it lacks (or when it has not been built).
+PHONETIC_SCORING_DIFFICULTIES = [d.strip() for d in os.getenv('PHONETIC_SCORING_DIFFICULTIES', '').split(',') if d.strip()]
+PHONETIC_DICTIONARY_PATH = os.getenv('PHONETIC_DICTIONARY_PATH') or os.path.join(BASE_DIR, 'data', 'phonetic.dict')
+
+# Per-request stage timings (Server-Timing header and /metrics histograms, per
+# process). METRICS_TOKEN lets a Prometheus scraper read /metrics without a staff login.
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', '0') == '1'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Query budgets declared on views with @query_budget: 'off', 'warn' (print views
+# over budget or repeating a SELECT QUERY_BUDGET_REPEAT_LIMIT times, with an
+# X-Query-Count header on every response) or 'raise' (fail; the tests use this)
+QUERY_BUDGET_MODE = os.getenv('QUERY_BUDGET_MODE', 'off')
+QUERY_BUDGET_REPEAT_LIMIT = int(os.getenv('QUERY_BUDGET_REPEAT_LIMIT', '3'))
+
+# Transcription cache: results keyed by a hash of the audio plus model and options,
+# so retried or repeated uploads skip ffmpeg and Whisper. Backends: 'locmem' (per
+# process, LRU-bounded by MAX_ENTRIES), 'file' (shared on disk), 'redis' (shared;
+# bound it with Redis' maxmemory + allkeys-lru) or 'dummy' to disable caching.
+TRANSCRIPTION_CACHE_BACKEND = os.getenv('TRANSCRIPTION_CACHE_BACKEND', 'locmem')
+TRANSCRIPTION_CACHE_TTL = int(os.getenv('TRANSCRIPTION_CACHE_TTL', '86400'))
+TRANSCRIPTION_CACHE_MAX_ENTRIES = int(os.getenv('TRANSCRIPTION_CACHE_MAX_ENTRIES', '5000'))
+_transcription_cache_backends = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'transcriptions',
+        'OPTIONS': {'MAX_ENTRIES': TRANSCRIPTION_CACHE_MAX_ENTRIES},
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('TRANSCRIPTION_CACHE_LOCATION', os.path.join(BASE_DIR, 'cache', 'transcriptions')),
+        'OPTIONS': {'MAX_ENTRIES': TRANSCRIPTION_CACHE_MAX_ENTRIES},
+    },
+    'redis': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('TRANSCRIPTION_CACHE_LOCATION', 'redis://redis:6379/1'),
+    },
+    'dummy': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'transcriptions': {
+        **_transcription_cache_backends[TRANSCRIPTION_CACHE_BACKEND],
+        'TIMEOUT': TRANSCRIPTION_CACHE_TTL,
+    },
+}
+
 # Security settings for HTTPS
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 SECURE_SSL_REDIRECT = False  # Let Nginx handle the SSL redirect
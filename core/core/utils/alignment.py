@@ -0,0 +1,199 @@
+"""
+Word alignment between what the student said and the expected sentence.
+
+One weighted edit-distance pass over the two word lists: a missing or extra
+word costs 1, pairing two words costs 2 * (1 - their character similarity), so
+an exact match is free and two unrelated words cost as much as one missing plus
+one extra word. Tracing the cheapest path back gives, in a single walk, the
+word_analysis / missing_words / extra_words / incorrect_words structure that
+MessageView.get_word_comparison returns.
+"""
+from core.utils.phonetics import phonetic_keys, sounds_alike
+
+try:
+    from rapidfuzz import fuzz
+    from rapidfuzz.process import cdist
+except ImportError:  # pragma: no cover - RapidFuzz is in requirements
+    fuzz = cdist = None
+
+# Character similarity thresholds for a paired word
+CORRECT_SIMILARITY = 0.9
+CLOSE_SIMILARITY = 0.7
+
+GAP_COST = 1.0
+SUBSTITUTION_COST = 2 * GAP_COST  # for two words with nothing in common
+
+_DIAGONAL, _UP, _LEFT = 0, 1, 2
+
+
+def normalize_words(text):
+    # Clean and normalize input, then split into words
+    return text.lower().strip().replace("’", "'").split()
+
+
+def similarity_matrix(user_words, expected_words):
+    """Character similarity (0-1) of every user word against every expected word."""
+    if cdist is not None:
+        return (cdist(user_words, expected_words, scorer=fuzz.ratio) / 100.0).tolist()
+    import difflib
+
+    return [[difflib.SequenceMatcher(None, u, e).ratio() for e in expected_words] for u in user_words]
+
+
+def align_words(user_words, expected_words):
+    """
+    Cheapest alignment of the two word lists as (user_index, expected_index,
+    similarity) steps in order; an index is None for an extra or missing word.
+    """
+    # Identical leading and trailing words are always paired, only the middle needs the DP
+    n, m = len(user_words), len(expected_words)
+    start = 0
+    while start < n and start < m and user_words[start] == expected_words[start]:
+        start += 1
+    end = 0
+    while end < n - start and end < m - start and user_words[n - 1 - end] == expected_words[m - 1 - end]:
+        end += 1
+
+    steps = [(k, k, 1.0) for k in range(start)]
+    steps += _align_middle(user_words[start:n - end], expected_words[start:m - end], start)
+    steps += [(n - end + k, m - end + k, 1.0) for k in range(end)]
+    return steps
+
+
+def _align_middle(user_words, expected_words, offset):
+    n, m = len(user_words), len(expected_words)
+    if not n or not m:
+        return [(offset + i, None, 0.0) for i in range(n)] + [(None, offset + j, 0.0) for j in range(m)]
+    similarities = similarity_matrix(user_words, expected_words)
+    # Identical words have similarity 1, so pairing them is free
+    pair_costs = [[SUBSTITUTION_COST * (1.0 - sim) for sim in row] for row in similarities]
+
+    previous = [j * GAP_COST for j in range(m + 1)]
+    move = [[_LEFT] * (m + 1)]
+    for i in range(1, n + 1):
+        current = i * GAP_COST
+        row = [current]
+        moves = [_UP]
+        for diagonal, above, pair_cost in zip(previous, previous[1:], pair_costs[i - 1]):
+            pair = diagonal + pair_cost
+            extra = above + GAP_COST
+            missing = current + GAP_COST
+            # Prefer pairing words on ties
+            if pair <= extra and pair <= missing:
+                current = pair
+                moves.append(_DIAGONAL)
+            elif extra <= missing:
+                current = extra
+                moves.append(_UP)
+            else:
+                current = missing
+                moves.append(_LEFT)
+            row.append(current)
+        previous = row
+        move.append(moves)
+
+    steps = []
+    i, j = n, m
+    while i or j:
+        direction = move[i][j]
+        if direction == _DIAGONAL:
+            i -= 1
+            j -= 1
+            steps.append((offset + i, offset + j, similarities[i][j]))
+        elif direction == _UP:
+            i -= 1
+            steps.append((offset + i, None, 0.0))
+        else:
+            j -= 1
+            steps.append((None, offset + j, 0.0))
+    steps.reverse()
+    return steps
+
+
+def compare_words(user_input, expected_text, phonetic=False):
+    """
+    Get detailed word-by-word comparison with specific feedback. `expected_text`
+    may be a compiled ExpectedSentence, whose words are already normalized.
+    With `phonetic`, a paired word that sounds like the expected one (same
+    phonetic key, e.g. "there" for "their") counts as correct.
+    """
+    if not user_input or not expected_text:
+        return {
+            'word_analysis': [],
+            'missing_words': [],
+            'extra_words': [],
+            'incorrect_words': []
+        }
+
+    user_words = normalize_words(user_input)
+    if isinstance(expected_text, str):
+        expected_words = normalize_words(expected_text)
+        expected_keys = [phonetic_keys(word) for word in expected_words] if phonetic else None
+    else:
+        expected_words = expected_text.words
+        expected_keys = expected_text.phonetic_keys
+
+    word_analysis = []
+    incorrect_words = []
+    missing_words = []
+    extra_words = []
+    correct_words = 0
+
+    for i, j, similarity in align_words(user_words, expected_words):
+        if i is None:
+            missing_words.append({'word': expected_words[j], 'position': len(word_analysis)})
+            continue
+        if j is None:
+            extra_words.append({'word': user_words[i], 'position': len(word_analysis)})
+            continue
+
+        user_word, expected_word = user_words[i], expected_words[j]
+        entry = {
+            'user_word': user_word,
+            'expected_word': expected_word,
+            'position': len(word_analysis),
+        }
+        if user_word == expected_word:
+            entry['status'] = 'correct'
+        else:
+            if similarity > CORRECT_SIMILARITY:
+                entry['status'] = 'correct'
+            elif phonetic and sounds_alike(phonetic_keys(user_word), expected_keys[j]):
+                entry['status'] = 'correct'
+            elif similarity > CLOSE_SIMILARITY:
+                entry['status'] = 'close'
+            else:
+                entry['status'] = 'incorrect'
+            entry['similarity'] = round(similarity * 100)
+            if entry['status'] != 'correct':
+                incorrect_words.append({
+                    'user_word': user_word,
+                    'expected_word': expected_word,
+                    'position': entry['position'],
+                })
+        if entry['status'] == 'correct':
+            correct_words += 1
+        word_analysis.append(entry)
+
+    return {
+        'word_analysis': word_analysis,
+        'missing_words': missing_words,
+        'extra_words': extra_words,
+        'incorrect_words': incorrect_words,
+        'total_expected_words': len(expected_words),
+        'total_user_words': len(user_words),
+        'correct_words': correct_words,
+    }
+
+
+def compare_words_batch(pairs):
+    """
+    compare_words for many (user_input, expected_text) pairs, e.g. when
+    re-scoring stored messages. Repeated pairs are aligned once; the results
+    for them are shared, not copied.
+    """
+    results = {}
+    return [
+        results[pair] if pair in results else results.setdefault(pair, compare_words(*pair))
+        for pair in map(tuple, pairs)
+    ]
@@ -0,0 +1,298 @@
+import io
+import os
+import struct
+import subprocess
+import tempfile
+import wave
+import numpy as np
+
+SAMPLE_RATE = 16000  # Whisper works on 16kHz mono float32 samples
+
+
+class AudioDecodeError(Exception):
+    """Raised when the uploaded audio cannot be decoded."""
+
+
+def _pcm16_to_float32(pcm_bytes):
+    return np.frombuffer(pcm_bytes, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def needs_seekable_input(data):
+    """
+    MP4/MOV style containers (Safari's MediaRecorder output) may keep their index
+    at the end of the file, which ffmpeg cannot reach when reading from a pipe.
+    """
+    return len(data) >= 12 and data[4:8] == b'ftyp'
+
+
+def decode_wav(data):
+    """
+    Decode a 16kHz 16-bit PCM WAV in-process. Returns None for anything else so
+    the caller can fall back to ffmpeg.
+    """
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+    try:
+        with wave.open(io.BytesIO(data)) as wav:
+            if wav.getsampwidth() != 2 or wav.getframerate() != SAMPLE_RATE:
+                return None
+            channels = wav.getnchannels()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+
+    samples = _pcm16_to_float32(frames)
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    return samples
+
+
+def _run_ffmpeg(input_arg, data=None, max_seconds=None):
+    """
+    Run a single ffmpeg process that writes 16kHz mono s16le PCM to stdout.
+    With `max_seconds` ffmpeg stops after that much audio instead of decoding all of it.
+    """
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+    if data is None:
+        cmd.append('-nostdin')  # reading from a file, keep ffmpeg off our stdin
+    cmd += [
+        '-threads', '0',
+        '-i', input_arg,
+    ]
+    if max_seconds:
+        cmd += ['-t', str(max_seconds)]
+    cmd += [
+        '-f', 's16le',
+        '-ac', '1',
+        '-acodec', 'pcm_s16le',
+        '-ar', str(SAMPLE_RATE),
+        '-',
+    ]
+    try:
+        out = subprocess.run(cmd, input=data, capture_output=True, check=True).stdout
+    except FileNotFoundError:
+        raise AudioDecodeError("ffmpeg is not installed")
+    except subprocess.CalledProcessError as e:
+        raise AudioDecodeError(f"ffmpeg failed to decode audio: {e.stderr.decode(errors='ignore').strip()}")
+    return _pcm16_to_float32(out)
+
+
+def decode_with_ffmpeg_pipe(data, max_seconds=None):
+    """Stream the uploaded bytes through ffmpeg's stdin and read PCM back from stdout."""
+    return _run_ffmpeg('pipe:0', data, max_seconds)
+
+
+def decode_with_temp_file(data, suffix='', max_seconds=None):
+    """Fallback for containers ffmpeg can only read from a seekable file."""
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
+    try:
+        temp_file.write(data)
+        temp_file.close()
+        return _run_ffmpeg(temp_file.name, max_seconds=max_seconds)
+    finally:
+        try:
+            os.unlink(temp_file.name)
+        except OSError:
+            pass
+
+
+def load_audio(source, max_seconds=None):
+    """
+    Decode audio into a 16kHz mono float32 NumPy array.
+
+    `source` may be raw bytes from an upload, a file path, or an array that is
+    already decoded. Plain 16kHz WAV is parsed in-process; everything else goes
+    through one ffmpeg process over pipes, and only MP4-style containers are
+    written to a temporary file first. `max_seconds` truncates the result, and
+    ffmpeg never decodes past it.
+    """
+    if isinstance(source, np.ndarray):
+        samples = source.astype(np.float32, copy=False)
+    elif isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            header = f.read(12)
+        samples = None
+        if header[:4] == b'RIFF':
+            with open(source, 'rb') as f:
+                samples = decode_wav(f.read())
+        if samples is None:
+            samples = _run_ffmpeg(os.fspath(source), max_seconds=max_seconds)
+    else:
+        data = bytes(source)
+        if not data:
+            raise AudioDecodeError("Audio file is empty")
+
+        samples = decode_wav(data)
+        if samples is None:
+            if needs_seekable_input(data):
+                samples = decode_with_temp_file(data, suffix='.mp4', max_seconds=max_seconds)
+            else:
+                samples = decode_with_ffmpeg_pipe(data, max_seconds)
+
+    if max_seconds:
+        samples = samples[:int(max_seconds * SAMPLE_RATE)]
+    return samples
+
+
+# Container header probing: duration, sample rate and channel count without decoding.
+# Any field the header does not carry (MediaRecorder's WebM has no duration) is None.
+
+_EBML_CLUSTER = 0x1F43B675
+# Segment, Info, Tracks, TrackEntry, Audio: the elements we descend into
+_EBML_CONTAINERS = {0x18538067, 0x1549A966, 0x1654AE6B, 0xAE, 0xE1}
+
+
+def _read_vint(data, pos, keep_marker=False):
+    """Read an EBML variable-length integer; returns (value, new position, is 'unknown size')."""
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError("Invalid EBML integer")
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, pos + length, unknown
+
+
+def _ebml_float(payload):
+    return struct.unpack('>f' if len(payload) == 4 else '>d', payload)[0]
+
+
+def _probe_matroska(data):
+    info = {}
+    timecode_scale = 1_000_000  # nanoseconds per duration unit
+    duration = None
+    pos = 0
+    while pos < len(data):
+        element_id, pos, _ = _read_vint(data, pos, keep_marker=True)
+        size, pos, unknown = _read_vint(data, pos)
+        if element_id == _EBML_CLUSTER:
+            break  # audio data starts here, the headers are done
+        if element_id in _EBML_CONTAINERS:
+            continue  # descend: the children follow immediately
+        if unknown:
+            break
+        payload = data[pos:pos + size]
+        pos += size
+        if element_id == 0x2AD7B1:  # TimecodeScale
+            timecode_scale = int.from_bytes(payload, 'big')
+        elif element_id == 0x4489:  # Duration
+            duration = _ebml_float(payload)
+        elif element_id == 0xB5:  # SamplingFrequency
+            info['sample_rate'] = int(_ebml_float(payload))
+        elif element_id == 0x9F:  # Channels
+            info['channels'] = int.from_bytes(payload, 'big')
+    if duration is not None:
+        info['duration'] = duration * timecode_scale / 1e9
+    return info
+
+
+def _probe_ogg(data):
+    info = {}
+    granule_rate = None
+    pre_skip = 0
+    opus = data.find(b'OpusHead')
+    vorbis = data.find(b'\x01vorbis')
+    if opus != -1 and len(data) >= opus + 16:
+        info['channels'] = data[opus + 9]
+        pre_skip = int.from_bytes(data[opus + 10:opus + 12], 'little')
+        info['sample_rate'] = int.from_bytes(data[opus + 12:opus + 16], 'little')
+        granule_rate = 48000  # Opus granule positions always count 48kHz samples
+    elif vorbis != -1 and len(data) >= vorbis + 16:
+        info['channels'] = data[vorbis + 11]
+        info['sample_rate'] = granule_rate = int.from_bytes(data[vorbis + 12:vorbis + 16], 'little')
+    last_page = data.rfind(b'OggS')
+    if granule_rate and last_page != -1 and len(data) >= last_page + 14:
+        granule = int.from_bytes(data[last_page + 6:last_page + 14], 'little')
+        if granule != 0xFFFFFFFFFFFFFFFF:
+            info['duration'] = max(granule - pre_skip, 0) / granule_rate
+    return info
+
+
+def _probe_mp4(data):
+    info = {}
+    mvhd = data.find(b'mvhd')
+    if mvhd != -1:
+        version = data[mvhd + 4] if len(data) > mvhd + 4 else 0
+        if version == 1:
+            timescale = int.from_bytes(data[mvhd + 24:mvhd + 28], 'big')
+            duration = int.from_bytes(data[mvhd + 28:mvhd + 36], 'big')
+        else:
+            timescale = int.from_bytes(data[mvhd + 16:mvhd + 20], 'big')
+            duration = int.from_bytes(data[mvhd + 20:mvhd + 24], 'big')
+        if timescale:
+            info['duration'] = duration / timescale
+    return info
+
+
+def _probe_wav(data):
+    try:
+        with wave.open(io.BytesIO(data), 'rb') as wav:
+            rate = wav.getframerate()
+            return {
+                'duration': wav.getnframes() / rate if rate else None,
+                'sample_rate': rate,
+                'channels': wav.getnchannels(),
+            }
+    except (wave.Error, EOFError):
+        return {}
+
+
+def probe_audio(data):
+    """
+    Read duration (seconds), sample rate and channels from the container header
+    of WAV, WebM/Matroska, Ogg or MP4 bytes. Unknown fields are None.
+    """
+    info = {}
+    try:
+        if data[:4] == b'RIFF':
+            info = _probe_wav(data)
+        elif data[:4] == b'\x1a\x45\xdf\xa3':
+            info = _probe_matroska(data)
+        elif data[:4] == b'OggS':
+            info = _probe_ogg(data)
+        elif needs_seekable_input(data):
+            info = _probe_mp4(data)
+    except (ValueError, IndexError, struct.error):
+        info = {}
+    return {
+        'duration': info.get('duration'),
+        'sample_rate': info.get('sample_rate'),
+        'channels': info.get('channels'),
+    }
+
+
+def frame_energy_db(samples, frame_ms=20):
+    """Per-frame RMS level in dBFS for non-overlapping frames of `frame_ms`."""
+    frame = SAMPLE_RATE * frame_ms // 1000
+    n_frames = len(samples) // frame
+    if n_frames == 0:
+        return np.empty(0, np.float32)
+    frames = samples[:n_frames * frame].reshape(n_frames, frame)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def trim_silence(samples, frame_ms=20, relative_db=-35.0, floor_db=-60.0, pad_ms=200):
+    """
+    Cut leading and trailing silence with a simple energy detector. A frame is
+    voiced when it is within `relative_db` of the loudest frame and above
+    `floor_db`; `pad_ms` of context is kept on both sides. Returns an empty
+    array when nothing is voiced.
+    """
+    energy = frame_energy_db(samples, frame_ms)
+    if len(energy) == 0:
+        return samples
+    voiced = np.flatnonzero((energy > energy.max() + relative_db) & (energy > floor_db))
+    if len(voiced) == 0:
+        return samples[:0]
+    frame = SAMPLE_RATE * frame_ms // 1000
+    pad = SAMPLE_RATE * pad_ms // 1000
+    start = max(voiced[0] * frame - pad, 0)
+    end = min((voiced[-1] + 1) * frame + pad, len(samples))
+    return samples[start:end]
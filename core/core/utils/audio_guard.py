@@ -0,0 +1,60 @@
+from django.conf import settings
+from core.utils.audio import SAMPLE_RATE, frame_energy_db, load_audio, probe_audio
+
+REJECTION_MESSAGES = {
+    'empty': "No audio was received. Please record your answer again.",
+    'too_large': "The recording is too large. Please record a shorter answer.",
+    'too_long': "The recording is too long. Please keep your answer under {max_seconds:g} seconds.",
+    'too_short': "The recording is too short. Please say the whole sentence.",
+    'silent': "We couldn't hear anything. Please check your microphone and try again.",
+}
+
+
+class AudioRejected(Exception):
+    """Raised for recordings refused before transcription; `code` says why."""
+
+    def __init__(self, code, message=None):
+        message = message or REJECTION_MESSAGES[code].format(max_seconds=settings.AUDIO_MAX_SECONDS)
+        super().__init__(code, message)
+        self.code = code
+        self.message = message
+
+
+def _check_duration(duration):
+    if duration > settings.AUDIO_MAX_SECONDS:
+        raise AudioRejected('too_long')
+    if duration < settings.AUDIO_MIN_SECONDS:
+        raise AudioRejected('too_short')
+
+
+def check_upload(data):
+    """
+    Cheap checks on the raw upload before anything is decoded: size, and the
+    duration from the container header when it has one. Returns probe_audio's info.
+    """
+    if not data:
+        raise AudioRejected('empty')
+    if len(data) > settings.AUDIO_MAX_UPLOAD_BYTES:
+        raise AudioRejected('too_large')
+    info = probe_audio(data)
+    if info['duration'] is not None:
+        _check_duration(info['duration'])
+    return info
+
+
+def check_samples(samples):
+    """Duration and silence checks on decoded audio, before it reaches Whisper."""
+    _check_duration(len(samples) / SAMPLE_RATE)
+    energy = frame_energy_db(samples)
+    if len(energy) == 0 or energy.max() < settings.AUDIO_SILENCE_DB:
+        raise AudioRejected('silent')
+
+
+def decode_checked(audio):
+    """
+    load_audio plus check_samples. Decoding stops just past AUDIO_MAX_SECONDS,
+    so a recording without a duration in its header still costs at most that much.
+    """
+    samples = load_audio(audio, max_seconds=settings.AUDIO_MAX_SECONDS + 1)
+    check_samples(samples)
+    return samples
@@ -0,0 +1,64 @@
+"""
+A small thread-safe circuit breaker.
+
+After `failure_threshold` consecutive failures the breaker opens and allow()
+refuses calls for `reset_timeout` seconds; then one trial call is let through
+(half-open). Its success closes the breaker again, its failure reopens it.
+"""
+import threading
+import time
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+# Numeric values for the state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a service whose breaker is open."""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, on_change=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_change = on_change  # called with the new state
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go ahead now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self._set(HALF_OPEN)
+            if self._trial_running:
+                return False  # one trial call at a time while half-open
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_running = False
+            if self.state != CLOSED:
+                self._set(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                if self.state != OPEN:
+                    self._set(OPEN)
+
+    def _set(self, state):
+        self.state = state
+        if self.on_change is not None:
+            self.on_change(state)
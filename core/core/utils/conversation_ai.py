@@ -1,7 +1,108 @@
-import google.generativeai as genai
 import json
 import os
+import random
+import threading
+import time
 from django.conf import settings
+from django.utils.module_loading import import_string
+from core.utils import tracing
+from core.utils.circuit_breaker import STATE_VALUES, CircuitBreaker, CircuitOpen
+from core.utils.tracing import traced
+
+# Exchanges per generated dialogue
+EXCHANGES_PER_DIFFICULTY = {'easy': 5, 'medium': 7, 'hard': 10}
+
+_clients = {}  # backend path -> the process's client
+_clients_lock = threading.Lock()
+
+
+def get_conversation_ai():
+    """
+    The process's CONVERSATION_AI_BACKEND client, created on first use and then
+    shared by every request, so Gemini is configured (and connects) once.
+    """
+    path = settings.CONVERSATION_AI_BACKEND
+    client = _clients.get(path)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(path)
+            if client is None:
+                client = _clients[path] = import_string(path)()
+    return client
+
+
+def reset():
+    """Forget the shared clients (tests, or after changing settings)."""
+    with _clients_lock:
+        _clients.clear()
+
+
+def _breaker_changed(state):
+    tracing.set_gauge(
+        'conversation_ai_breaker_state', STATE_VALUES[state],
+        'Conversation AI circuit breaker: 0 closed, 1 half-open, 2 open.',
+    )
+
+
+def iter_array_items(chunks):
+    """
+    Yield each element of a JSON array as soon as it is complete, from text that
+    arrives in pieces (a streamed model response). Anything before the opening
+    bracket, such as a ```json fence, and anything after the closing one is
+    ignored. Raises ValueError on a malformed element or if the text ends
+    inside the array.
+    """
+    buffer = ''
+    pos = 0  # next character to scan
+    start = None  # where the current element begins
+    depth = 0
+    opened = in_string = escape = False
+    for chunk in chunks:
+        buffer += chunk
+        while pos < len(buffer):
+            char = buffer[pos]
+            if not opened:
+                opened = char == '['
+            elif in_string:
+                if escape:
+                    escape = False
+                elif char == '\\':
+                    escape = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+                if start is None:
+                    start = pos
+            elif char in '{[':
+                if start is None:
+                    start = pos
+                depth += 1
+            elif char in '}]' and depth:
+                depth -= 1
+                if not depth:
+                    yield json.loads(buffer[start:pos + 1])
+                    start = None
+            elif char == ']':
+                if start is not None:
+                    yield json.loads(buffer[start:pos])  # a last scalar element
+                return
+            elif char == ',' and not depth and start is not None:
+                yield json.loads(buffer[start:pos])
+                start = None
+            elif char == '}':
+                raise ValueError("Unbalanced '}' in JSON array")
+            elif start is None and not char.isspace() and char != ',':
+                start = pos
+            pos += 1
+        # Keep only the element in progress
+        keep = pos if start is None else start
+        buffer = buffer[keep:]
+        pos -= keep
+        if start is not None:
+            start = 0
+    raise ValueError("Response ended inside the JSON array")
+
 
 class ConversationAI:
     def __init__(self):
@@ -10,10 +111,88 @@ class ConversationAI:
         if not api_key:
             raise ValueError("GEMINI_API_KEY environment variable is required")
         
+        # Imported here because the SDK is slow to import and most processes never call it
+        import google.generativeai as genai
         genai.configure(api_key=api_key)
         self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.timeout = settings.CONVERSATION_AI_TIMEOUT
+        self.retries = settings.CONVERSATION_AI_RETRIES
+        self.backoff = settings.CONVERSATION_AI_BACKOFF
+        self.breaker = CircuitBreaker(
+            settings.CONVERSATION_AI_BREAKER_THRESHOLD,
+            settings.CONVERSATION_AI_BREAKER_RESET,
+            on_change=_breaker_changed,
+        )
+        _breaker_changed(self.breaker.state)
+    
+    def _call(self, request):
+        """
+        Run request(), a call to Gemini: failures are retried after a jittered
+        exponential backoff. Raises CircuitOpen without calling Gemini while the
+        breaker is open.
+        """
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                tracing.increment('conversation_ai_calls_total', 'Conversation AI calls by outcome.', outcome='short_circuited')
+                raise CircuitOpen("Gemini circuit breaker is open")
+            start = time.perf_counter()
+            try:
+                result = request()
+            except Exception as e:
+                tracing.observe('ai_call', time.perf_counter() - start)
+                tracing.increment('conversation_ai_calls_total', 'Conversation AI calls by outcome.', outcome='error')
+                self.breaker.record_failure()
+                if attempt == self.retries:
+                    raise
+                print(f"Gemini attempt {attempt + 1} failed, retrying: {str(e)}")
+                # Full jitter: spreads out the retries of requests that failed together
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            else:
+                tracing.observe('ai_call', time.perf_counter() - start)
+                tracing.increment('conversation_ai_calls_total', 'Conversation AI calls by outcome.', outcome='success')
+                self.breaker.record_success()
+                return result
+    
+    def _complete(self, prompt):
+        """The whole conversation in one response (each attempt bounded by the timeout)"""
+        response = self.model.generate_content(prompt, request_options={'timeout': self.timeout})
+        return self._parse(response.text)
+    
+    def _first_streamed(self, prompt):
+        """Stream the conversation: returns its first exchange and an iterator over the rest"""
+        response = self.model.generate_content(prompt, stream=True, request_options={'timeout': self.timeout})
+        exchanges = (self._validate(exchange) for exchange in iter_array_items(chunk.text for chunk in response))
+        first = next(exchanges, None)
+        if first is None:
+            raise ValueError("Response has no exchanges")
+        return first, exchanges
+    
+    def _validate(self, exchange):
+        if not isinstance(exchange, dict) or not all(key in exchange for key in ['exchange_number', 'bot_says', 'user_should_say']):
+            raise ValueError("Missing required keys in exchange")
+        return exchange
     
-    def generate_conversation(self, topic, num_exchanges=7, difficulty='medium'):
+    def _parse(self, text):
+        """The validated exchanges in a Gemini response"""
+        # Parse the JSON response
+        conversation_json = text.strip()
+        
+        # Remove any markdown formatting if present
+        if conversation_json.startswith('```json'):
+            conversation_json = conversation_json[7:]
+        if conversation_json.endswith('```'):
+            conversation_json = conversation_json[:-3]
+        
+        conversation_data = json.loads(conversation_json)
+        
+        # Validate the response structure
+        if not isinstance(conversation_data, list):
+            raise ValueError("Response is not a list")
+        
+        return [self._validate(exchange) for exchange in conversation_data]
+    
+    @traced('ai_generate')
+    def generate_conversation(self, topic, num_exchanges=7, difficulty='medium', fallback=True):
         """
         Generate a conversation dialogue based on a given topic using Gemini.
         
@@ -21,11 +200,48 @@ class ConversationAI:
             topic (str): The conversation topic (e.g., "Independence Day holiday")
             num_exchanges (int): Number of exchanges in the conversation
             difficulty (str): Difficulty level - 'easy', 'medium', or 'hard'
+            fallback (bool): Return a built-in conversation if Gemini fails, instead of raising
             
         Returns:
             list: List of dialogue exchanges with bot and user parts
         """
         
+        prompt = self._prompt(topic, num_exchanges, difficulty)
+        
+        try:
+            return self._call(lambda: self._complete(prompt))
+            
+        except Exception as e:
+            print(f"Error generating conversation with Gemini: {str(e)}")
+            if not fallback:
+                raise
+            # Return a fallback conversation if Gemini fails (or its breaker is open)
+            return self.get_fallback_conversation(topic, num_exchanges, difficulty)
+
+    def stream_conversation(self, topic, num_exchanges=7, difficulty='medium', fallback=True):
+        """
+        Like generate_conversation, but yields the exchanges one at a time as
+        Gemini writes them. Retries and the circuit breaker cover the wait for
+        the first exchange; a failure after it ends the stream with an error.
+        With `fallback`, a failure before the first exchange yields the built-in
+        conversation instead.
+        """
+        prompt = self._prompt(topic, num_exchanges, difficulty)
+        start = time.perf_counter()
+        try:
+            first, rest = self._call(lambda: self._first_streamed(prompt))
+        except Exception as e:
+            print(f"Error generating conversation with Gemini: {str(e)}")
+            if not fallback:
+                raise
+            yield from self.get_fallback_conversation(topic, num_exchanges, difficulty)
+            return
+        tracing.observe('ai_first_exchange', time.perf_counter() - start)
+        yield first
+        yield from rest
+    
+    def _prompt(self, topic, num_exchanges, difficulty):
+        """The Gemini prompt for a conversation"""
         # Customize prompt based on difficulty level
         difficulty_instructions = {
             'easy': {
@@ -95,37 +311,9 @@ Example format:
 ]
 
 Please respond with ONLY the JSON array, no additional text or formatting."""
-        
-        try:
-            response = self.model.generate_content(prompt)
-            
-            # Parse the JSON response
-            conversation_json = response.text.strip()
-            
-            # Remove any markdown formatting if present
-            if conversation_json.startswith('```json'):
-                conversation_json = conversation_json[7:]
-            if conversation_json.endswith('```'):
-                conversation_json = conversation_json[:-3]
-            
-            conversation_data = json.loads(conversation_json)
-            
-            # Validate the response structure
-            if not isinstance(conversation_data, list):
-                raise ValueError("Response is not a list")
-            
-            for exchange in conversation_data:
-                if not all(key in exchange for key in ['exchange_number', 'bot_says', 'user_should_say']):
-                    raise ValueError("Missing required keys in exchange")
-            
-            return conversation_data
-            
-        except Exception as e:
-            print(f"Error generating conversation with Gemini: {str(e)}")
-            # Return a fallback conversation if Gemini fails
-            return self._get_fallback_conversation(topic, num_exchanges, difficulty)
+        return prompt
 
-    def _get_fallback_conversation(self, topic, num_exchanges=7, difficulty='medium'):
+    def get_fallback_conversation(self, topic, num_exchanges=7, difficulty='medium'):
         """
         Fallback conversation generation if Gemini fails
         """
@@ -295,4 +483,21 @@ Please respond with ONLY the JSON array, no additional text or formatting."""
                 "user_should_say": user_says.format(topic=topic)
             })
         
-        return generic_exchanges 
\ No newline at end of file
+        return generic_exchanges
+
+
+class StubConversationAI(ConversationAI):
+    """ConversationAI without Gemini: the built-in fallback dialogues, after an optional simulated delay."""
+
+    latency = 0.0
+
+    def __init__(self):
+        self.model = None
+
+    def generate_conversation(self, topic, num_exchanges=7, difficulty='medium', fallback=True):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.get_fallback_conversation(topic, num_exchanges, difficulty)
+
+    def stream_conversation(self, topic, num_exchanges=7, difficulty='medium', fallback=True):
+        yield from self.generate_conversation(topic, num_exchanges, difficulty, fallback)
@@ -0,0 +1,81 @@
+"""
+Compiled expected responses for a Dialogue.
+
+Everything the scorers need from the expected side of an exchange (lowercased
+text, Myers bitmask table, normalized words, phonetic keys) is built once per
+dialogue and kept in a bounded in-process LRU keyed by dialogue id, so scoring
+a submission only has to process what the student said.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from core.utils.alignment import normalize_words
+from core.utils.levenshtein import myers_pattern
+from core.utils.phonetics import phonetic_keys
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+class ExpectedSentence:
+    """One expected response, preprocessed for spelling_score and compare_words."""
+
+    __slots__ = ('text', 'lowered', 'peq', 'words', 'phonetic_keys')
+
+    def __init__(self, text):
+        self.text = text
+        self.lowered = text.lower()
+        self.peq = myers_pattern(self.lowered)
+        self.words = normalize_words(text)
+        self.phonetic_keys = [phonetic_keys(word) for word in self.words]
+
+    def __len__(self):
+        return len(self.text)
+
+    def __bool__(self):
+        return bool(self.text)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f"ExpectedSentence({self.text!r})"
+
+
+def _cache_size():
+    return getattr(settings, 'EXPECTED_INDEX_CACHE_SIZE', 512)
+
+
+def compile_dialogue(dialogue):
+    """Compile every expected response of `dialogue` and cache the result."""
+    compiled = [ExpectedSentence(exchange.get('user_should_say') or '') for exchange in dialogue.get_exchanges()]
+    size = _cache_size()
+    if size <= 0:
+        return compiled
+    with _lock:
+        _cache[dialogue.pk] = compiled
+        _cache.move_to_end(dialogue.pk)
+        while len(_cache) > size:
+            _cache.popitem(last=False)
+    return compiled
+
+
+def get_expected(dialogue, index):
+    """Compiled expected response `index` of `dialogue`, compiling the dialogue on a cache miss."""
+    with _lock:
+        compiled = _cache.get(dialogue.pk)
+        if compiled is not None:
+            _cache.move_to_end(dialogue.pk)
+    if compiled is None or len(compiled) < len(dialogue.get_exchanges()):
+        # Not cached, or exchanges were appended since (a streamed dialogue)
+        compiled = compile_dialogue(dialogue)
+    if 0 <= index < len(compiled):
+        return compiled[index]
+    return None
+
+
+def clear():
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,147 @@
+import math
+from core.utils import transcription_cache
+from core.utils.alignment import normalize_words
+from core.utils.audio_guard import decode_checked
+from core.utils.tracing import span
+from core.utils.whisper import get_model, _audio_ctx_for, _encode, _get_tokenizer, _prepare_samples, SAMPLE_RATE
+
+# Per-word confidence (geometric mean token probability) thresholds
+CORRECT_CONFIDENCE = 0.6
+CLOSE_CONFIDENCE = 0.3
+
+UNCLEAR_WORD = "___"
+# Punctuation around a word is not said, so it is not aligned either
+PUNCTUATION = ".,!?;:\"()"
+
+
+def _empty_result(expected_words):
+    return {
+        'transcript': '',
+        'score': 0,
+        'word_comparison': {
+            'word_analysis': [],
+            'missing_words': [{'word': word, 'position': 0} for word in expected_words],
+            'extra_words': [],
+            'incorrect_words': [],
+            'total_expected_words': len(expected_words),
+            'total_user_words': 0,
+            'correct_words': 0,
+        },
+    }
+
+
+def word_confidences(samples, expected_words):
+    """
+    Teacher-force the expected words through the decoder in one pass and return
+    each word's confidence: exp(mean log-probability of its tokens).
+    """
+    import torch
+    import whisper
+    from whisper.audio import HOP_LENGTH
+
+    model = get_model()
+    tokenizer = _get_tokenizer(model)
+
+    audio_ctx = _audio_ctx_for(model, len(samples))
+    mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(samples, audio_ctx * 2 * HOP_LENGTH), model.dims.n_mels)
+    mel = mel.unsqueeze(0).to(model.device)
+
+    prefix = list(tokenizer.sot_sequence_including_notimestamps)
+    word_tokens = [tokenizer.encode(" " + word) for word in expected_words]
+    target = [token for tokens in word_tokens for token in tokens]
+    tokens = torch.tensor([prefix + target], device=model.device)
+
+    with torch.no_grad():
+        if audio_ctx < model.dims.n_audio_ctx:
+            audio_features = _encode(model, mel)
+        else:
+            audio_features = model.encoder(mel)
+        logits = model.decoder(tokens, audio_features)[0]
+    # logits at position i predict token i + 1
+    logprobs = torch.log_softmax(logits[len(prefix) - 1:-1].float(), dim=-1)
+    target_logprobs = logprobs[torch.arange(len(target)), torch.tensor(target)].tolist()
+
+    confidences = []
+    offset = 0
+    for tokens in word_tokens:
+        word_logprobs = target_logprobs[offset:offset + len(tokens)]
+        offset += len(tokens)
+        confidences.append(math.exp(sum(word_logprobs) / len(word_logprobs)) if word_logprobs else 0.0)
+    return confidences
+
+
+def score_expected(audio, expected_text):
+    """
+    Score a recording directly against the sentence the student should say.
+
+    Returns {'transcript', 'score', 'word_comparison'} where `word_comparison`
+    has the same shape as MessageView.get_word_comparison, each word carrying
+    a `confidence` instead of a spelling similarity. Words the model is not
+    confident about are blanked out in the transcript.
+    """
+    expected_words = normalize_words(expected_text)
+    with span('audio_decode'):
+        samples = decode_checked(audio)
+    cache_key = transcription_cache.pcm_key(samples, expected_text, engine='forced')
+    cached = transcription_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    with span('whisper'):
+        result = _score_samples(_prepare_samples(samples), expected_words, expected_text.split())
+    transcription_cache.set(cache_key, result)
+    return result
+
+
+def _score_samples(samples, expected_words, display_words=None):
+    """
+    Score decoded samples against the normalized expected words (see
+    normalize_words); `display_words` are the same words as written, for the
+    transcript.
+    """
+    if not expected_words or len(samples) < SAMPLE_RATE // 10:
+        return _empty_result(expected_words)
+
+    confidences = word_confidences(samples, [word.strip(PUNCTUATION) or word for word in expected_words])
+
+    word_analysis = []
+    incorrect_words = []
+    transcript = []
+    for position, (expected_word, confidence) in enumerate(zip(expected_words, confidences)):
+        if confidence >= CORRECT_CONFIDENCE:
+            status = 'correct'
+        elif confidence >= CLOSE_CONFIDENCE:
+            status = 'close'
+        else:
+            status = 'incorrect'
+
+        word_analysis.append({
+            'user_word': expected_word if status != 'incorrect' else UNCLEAR_WORD,
+            'expected_word': expected_word,
+            'status': status,
+            'position': position,
+            'similarity': round(confidence * 100),
+            'confidence': round(confidence * 100),
+        })
+        if status != 'correct':
+            incorrect_words.append({
+                'user_word': word_analysis[-1]['user_word'],
+                'expected_word': expected_word,
+                'position': position,
+                'confidence': round(confidence * 100),
+            })
+        transcript.append((display_words or expected_words)[position] if status != 'incorrect' else UNCLEAR_WORD)
+
+    correct_words = sum(1 for w in word_analysis if w['status'] == 'correct')
+    return {
+        'transcript': " ".join(transcript),
+        'score': round(100 * sum(confidences) / len(confidences)),
+        'word_comparison': {
+            'word_analysis': word_analysis,
+            'missing_words': [],
+            'extra_words': [],
+            'incorrect_words': incorrect_words,
+            'total_expected_words': len(expected_words),
+            'total_user_words': len(expected_words),
+            'correct_words': correct_words,
+        },
+    }
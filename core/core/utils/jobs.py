@@ -0,0 +1,129 @@
+"""
+Background jobs for work too slow to hold a request for, such as generating a
+dialogue. Jobs run on a per-process thread pool (BACKGROUND_JOB_WORKERS; 0 runs
+them inline, as the tests do) and their status is a teaching.BackgroundJob row,
+so a client can poll any web process for it (a job can publish() its result
+before it finishes):
+
+    {'status': 'pending' | 'ready' | 'failed', 'result': ..., 'error': ..., **extra}
+
+Rows older than BACKGROUND_JOB_TTL seconds are treated as unknown and deleted
+when the next job is submitted. A job still pending BACKGROUND_JOB_TIMEOUT
+seconds after its last update (e.g. its process died with it) is reported as
+failed.
+"""
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+_executor = None
+_lock = threading.Lock()
+_current = threading.local()  # the job running in this thread
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(settings.BACKGROUND_JOB_WORKERS, thread_name_prefix='job')
+    return _executor
+
+
+def _jobs():
+    from teaching.models import BackgroundJob
+    return BackgroundJob.objects.all()
+
+
+def _cutoff():
+    return timezone.now() - timedelta(seconds=settings.BACKGROUND_JOB_TTL)
+
+
+def _as_status(job):
+    return {'status': job.status, 'result': job.result, 'error': job.error or None, **job.extra}
+
+
+def _is_stale(job):
+    stale = timezone.now() - timedelta(seconds=settings.BACKGROUND_JOB_TIMEOUT)
+    return job.status == 'pending' and job.updated_at < stale
+
+
+def get_status(job_id):
+    """The job's status dict, or None if it is unknown or expired."""
+    job = _jobs().filter(pk=job_id, created_at__gte=_cutoff()).first()
+    if job is None:
+        return None
+    if _is_stale(job):
+        # Only if nothing updated it meanwhile, e.g. a slow job that just finished
+        _jobs().filter(pk=job_id, status='pending', updated_at=job.updated_at).update(
+            status='failed', error='Job timed out', updated_at=timezone.now()
+        )
+        job.refresh_from_db()
+    return _as_status(job)
+
+
+def _update(job_id, **fields):
+    _jobs().filter(pk=job_id).update(updated_at=timezone.now(), **fields)
+    return get_status(job_id)
+
+
+def _notify(notify, job_id, status):
+    if notify is not None:
+        try:
+            notify(job_id, status)
+        except Exception as e:
+            print(f"Error notifying background job {job_id}: {str(e)}")
+
+
+def publish(result):
+    """
+    Called from inside a job: mark it ready with `result` now, while the job
+    carries on (e.g. streaming the rest of a dialogue). Its return value and
+    any later error are then not reported.
+    """
+    job_id, notify = _current.job
+    _current.published = True
+    _notify(notify, job_id, _update(job_id, status='ready', result=result))
+
+
+def _run(job_id, func, args, notify):
+    _current.job = (job_id, notify)
+    _current.published = False
+    try:
+        result = func(*args)
+    except Exception as e:
+        print(f"Error in background job {job_id}: {str(e)}")
+        if not _current.published:
+            _notify(notify, job_id, _update(job_id, status='failed', error=str(e)))
+    else:
+        if not _current.published:
+            _notify(notify, job_id, _update(job_id, status='ready', result=result))
+    finally:
+        _current.job = None
+
+
+def _run_in_thread(*args):
+    try:
+        _run(*args)
+    finally:
+        connections.close_all()  # this pool thread's connections only
+
+
+def submit(func, *args, notify=None, **extra):
+    """
+    Run func(*args) in the background and return the new job's id. `extra` is
+    stored with the status (e.g. who may read it); notify(job_id, status) is
+    called once the job is ready or has failed.
+    """
+    job_id = uuid.uuid4().hex
+    _jobs().filter(created_at__lt=_cutoff()).delete()
+    _jobs().create(id=job_id, extra=extra)
+    if settings.BACKGROUND_JOB_WORKERS <= 0:
+        _run(job_id, func, args, notify)
+    else:
+        _get_executor().submit(_run_in_thread, job_id, func, args, notify)
+    return job_id
@@ -1,10 +1,26 @@
-def levenshtein_distance(s1, s2):
+"""
+Levenshtein distance with pluggable backends.
+
+- rapidfuzz: RapidFuzz's C++ implementation (the default)
+- myers:     Myers/Hyyrö bit-parallel algorithm in pure Python; one big-int
+             operation per character of the longer string instead of a row
+- python:    the original dynamic-programming loop, kept as the reference
+
+All backends accept strings or sequences of hashable items (e.g. word lists)
+and return the same integer distance.
+"""
+from django.conf import settings
+
+BACKENDS = ('rapidfuzz', 'myers', 'python')
+
+
+def levenshtein_distance_python(s1, s2):
     """
     Calculate the Levenshtein distance between two strings.
     This is the minimum number of single-character edits required to change one string into the other.
     """
     if len(s1) < len(s2):
-        return levenshtein_distance(s2, s1)
+        return levenshtein_distance_python(s2, s1)
 
     if len(s2) == 0:
         return len(s1)
@@ -19,4 +35,88 @@ def levenshtein_distance(s1, s2):
             current_row.append(min(insertions, deletions, substitutions))
         previous_row = current_row
 
-    return previous_row[-1] 
\ No newline at end of file
+    return previous_row[-1]
+
+
+def myers_pattern(pattern):
+    """Per-symbol match bitmasks of `pattern` (bit i set where pattern[i] is the symbol)."""
+    peq = {}
+    for i, symbol in enumerate(pattern):
+        peq[symbol] = peq.get(symbol, 0) | (1 << i)
+    return peq
+
+
+def myers_distance(peq, pattern_length, text):
+    """Distance between a pattern given by its myers_pattern() masks and `text`."""
+    if pattern_length == 0:
+        return len(text)
+    mask = (1 << pattern_length) - 1
+    high = 1 << (pattern_length - 1)
+    pv = mask
+    mv = 0
+    score = pattern_length
+    for symbol in text:
+        eq = peq.get(symbol, 0)
+        xv = eq | mv
+        xh = ((((eq & pv) + pv) & mask) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & mask
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+    return score
+
+
+def levenshtein_distance_myers(s1, s2):
+    # The shorter string becomes the bit vector, the longer one is scanned
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    return myers_distance(myers_pattern(s2), len(s2), s1)
+
+
+def _rapidfuzz_distance():
+    from rapidfuzz.distance import Levenshtein
+
+    return Levenshtein.distance
+
+
+def get_backend(name=None):
+    """Return the distance function for backend `name` (default: settings.LEVENSHTEIN_BACKEND)."""
+    name = name or getattr(settings, 'LEVENSHTEIN_BACKEND', 'rapidfuzz')
+    if name == 'rapidfuzz':
+        try:
+            return _rapidfuzz_distance()
+        except ImportError:
+            return levenshtein_distance_myers
+    if name == 'myers':
+        return levenshtein_distance_myers
+    if name == 'python':
+        return levenshtein_distance_python
+    raise ValueError(f"Unknown LEVENSHTEIN_BACKEND '{name}', expected one of {', '.join(BACKENDS)}")
+
+
+def levenshtein_distance(s1, s2, backend=None):
+    """
+    Calculate the Levenshtein distance between two strings (or sequences).
+    This is the minimum number of single-character edits required to change one string into the other.
+    """
+    return get_backend(backend)(s1, s2)
+
+
+def levenshtein_distances(pairs, backend=None):
+    """Distances for many (s1, s2) pairs in one call, in order."""
+    pairs = list(pairs)
+    if not pairs:
+        return []
+    distance = get_backend(backend)
+    if distance is not levenshtein_distance_python and distance is not levenshtein_distance_myers:
+        from rapidfuzz.process import cpdist
+
+        # Pairwise in C++, no Python call per pair
+        return cpdist([a for a, _ in pairs], [b for _, b in pairs], scorer=distance).tolist()
+    return [distance(a, b) for a, b in pairs]
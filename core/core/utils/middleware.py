@@ -0,0 +1,56 @@
+import time
+from django.db import connection
+from core.utils import query_budget, tracing
+
+
+def _time_query(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        tracing.record('db', time.perf_counter() - start)
+
+
+class TracingMiddleware:
+    """
+    Times each request by stage (see core.utils.tracing) and reports the stages
+    in a Server-Timing header. Does nothing unless TRACING_ENABLED is set.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not tracing.enabled():
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        with tracing.collect() as spans, connection.execute_wrapper(_time_query):
+            response = self.get_response(request)
+        total = time.perf_counter() - start
+        tracing.observe('request', total)
+        response['Server-Timing'] = tracing.server_timing(spans, total)
+        return response
+
+
+class QueryCountMiddleware:
+    """
+    Development aid: records the queries of every request, reports N+1 patterns
+    per view (see core.utils.query_budget) and adds an X-Query-Count header.
+    Does nothing while QUERY_BUDGET_MODE is 'off'.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if query_budget.mode() == 'off':
+            return self.get_response(request)
+
+        with query_budget.QueryRecorder() as recorder:
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        name = match.view_name if match and match.view_name else request.path
+        response['X-Query-Count'] = str(len(recorder))
+        query_budget.report(name, recorder)
+        return response
@@ -0,0 +1,256 @@
+"""
+Phonetic keys for English words, so that words which sound alike ("their" /
+"there", "night" / "nite") get the same key.
+
+Keys come from a pronouncing dictionary when one has been built (see the
+build_phonetic_dictionary command, e.g. from CMUdict) and from Lawrence
+Philips' original Metaphone otherwise. The two are different alphabets, so a
+word keeps both and dictionary keys are only ever compared with each other:
+a word the dictionary lacks (a typo, a name) is compared on Metaphone, and so
+is the word it is compared with. The dictionary is a sorted binary file
+that is memory-mapped once per process and binary-searched per word, so it
+costs no Python objects per entry and its pages are shared between workers.
+
+Dictionary file layout (little-endian):
+    MAGIC, uint32 entry count N, (N + 1) uint32 record offsets, then the
+    records "word\0key" sorted by word, as UTF-8.
+A dictionary key has one character per phoneme (see PHONEME_CODES), so two
+keys can be compared with an ordinary edit distance.
+"""
+import mmap
+import os
+import struct
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+
+VOWELS = set('AEIOU')
+FRONT_VOWELS = set('EIY')
+
+MAGIC = b'PHONDIC1'
+
+# ARPAbet phonemes (stress markers dropped) -> one character each
+PHONEME_CODES = dict(zip(
+    'AA AE AH AO AW AY B CH D DH EH ER EY F G HH IH IY JH K L M N NG OW OY P R S SH T TH UH UW V W Y Z ZH'.split(),
+    'abcdefghijklmnopqrstuvwxyz!#$%&*+-/<=>?',
+))
+
+_dictionary = None
+_dictionary_loaded = False
+_lock = threading.Lock()
+
+
+def metaphone(word):
+    """Metaphone key of a single word; non-letters are ignored."""
+    w = ''.join(c for c in word.upper() if 'A' <= c <= 'Z')
+    if not w:
+        return ''
+
+    # Initial letter exceptions
+    if w[:2] in ('AE', 'GN', 'KN', 'PN', 'WR'):
+        w = w[1:]
+    elif w[0] == 'X':
+        w = 'S' + w[1:]
+    elif w[:2] == 'WH':
+        w = 'W' + w[2:]
+
+    key = []
+    n = len(w)
+    i = 0
+    while i < n:
+        c = w[i]
+        prev = w[i - 1] if i > 0 else ''
+        nxt = w[i + 1] if i + 1 < n else ''
+        after = w[i + 2] if i + 2 < n else ''
+
+        # Doubled letters sound once, except C
+        if c == prev and c != 'C':
+            i += 1
+            continue
+
+        if c in VOWELS:
+            if i == 0:
+                key.append(c)
+        elif c == 'B':
+            if not (prev == 'M' and i == n - 1):
+                key.append('B')
+        elif c == 'C':
+            if nxt == 'I' and after == 'A':
+                key.append('X')
+            elif nxt == 'H':
+                key.append('K' if prev == 'S' else 'X')
+                i += 1
+            elif nxt in FRONT_VOWELS:
+                if prev != 'S':
+                    key.append('S')
+            else:
+                key.append('K')
+        elif c == 'D':
+            if nxt == 'G' and after in FRONT_VOWELS:
+                key.append('J')
+                i += 1
+            else:
+                key.append('T')
+        elif c == 'G':
+            if nxt == 'H' and not (i + 2 >= n or after in VOWELS):
+                pass  # silent, as in "night"
+            elif nxt == 'N' and (i + 2 == n or w[i + 2:] == 'ED'):
+                pass  # silent, as in "sign", "signed"
+            elif nxt in FRONT_VOWELS and prev != 'G':
+                key.append('J')
+            else:
+                key.append('K')
+        elif c == 'H':
+            if prev in VOWELS and nxt not in VOWELS:
+                pass
+            elif prev in ('C', 'S', 'P', 'T', 'G'):
+                pass
+            else:
+                key.append('H')
+        elif c == 'K':
+            if prev != 'C':
+                key.append('K')
+        elif c == 'P':
+            if nxt == 'H':
+                key.append('F')
+                i += 1
+            else:
+                key.append('P')
+        elif c == 'Q':
+            key.append('K')
+        elif c == 'S':
+            if nxt == 'H':
+                key.append('X')
+                i += 1
+            elif nxt == 'I' and after in ('O', 'A'):
+                key.append('X')
+            else:
+                key.append('S')
+        elif c == 'T':
+            if nxt == 'I' and after in ('O', 'A'):
+                key.append('X')
+            elif nxt == 'H':
+                key.append('0')  # "th"
+                i += 1
+            elif not (nxt == 'C' and after == 'H'):
+                key.append('T')
+        elif c == 'V':
+            key.append('F')
+        elif c == 'W' or c == 'Y':
+            if nxt in VOWELS:
+                key.append(c)
+        elif c == 'X':
+            key.append('KS')
+        elif c == 'Z':
+            key.append('S')
+        else:  # F J L M N R
+            key.append(c)
+        i += 1
+    return ''.join(key)
+
+
+def encode_phonemes(phonemes):
+    """Dictionary key for a pronunciation given as ARPAbet phonemes (e.g. ['DH', 'EH1', 'R'])."""
+    return ''.join(PHONEME_CODES[p.rstrip('012')] for p in phonemes)
+
+
+def write_dictionary(entries, path):
+    """Write {word: key} as a dictionary file; returns the number of entries."""
+    records = [f"{word}\0{key}".encode() for word, key in sorted(entries.items())]
+    offsets = [0]
+    for record in records:
+        offsets.append(offsets[-1] + len(record))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack(f'<I{len(offsets)}I', len(records), *offsets))
+        f.write(b''.join(records))
+    os.replace(tmp, path)
+    return len(records)
+
+
+class PhoneticDictionary:
+    """Read-only, memory-mapped view of a dictionary file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a phonetic dictionary")
+        (self.count,) = struct.unpack_from('<I', self._data, len(MAGIC))
+        self._offsets = memoryview(self._data)[len(MAGIC) + 4:len(MAGIC) + 8 + 4 * self.count].cast('I')
+        self._records = len(MAGIC) + 8 + 4 * self.count
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, i):
+        return self._data[self._records + self._offsets[i]:self._records + self._offsets[i + 1]]
+
+    def lookup(self, word):
+        """Key for `word` (lowercase), or None if it is not in the dictionary."""
+        target = word.encode()
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            record = self._record(mid)
+            entry, _, key = record.partition(b'\0')
+            if entry == target:
+                return key.decode()
+            if entry < target:
+                low = mid + 1
+            else:
+                high = mid
+        return None
+
+
+def get_dictionary():
+    """The dictionary at settings.PHONETIC_DICTIONARY_PATH, loaded once; None if there is none."""
+    global _dictionary, _dictionary_loaded
+    if not _dictionary_loaded:
+        with _lock:
+            if not _dictionary_loaded:
+                path = getattr(settings, 'PHONETIC_DICTIONARY_PATH', '')
+                if path and os.path.exists(path):
+                    try:
+                        _dictionary = PhoneticDictionary(path)
+                    except (OSError, ValueError) as e:
+                        print(f"Error loading phonetic dictionary: {str(e)}")
+                _dictionary_loaded = True
+    return _dictionary
+
+
+@lru_cache(maxsize=65536)
+def phonetic_keys(word):
+    """(dictionary key or None, Metaphone key) of a normalized word."""
+    dictionary = get_dictionary()
+    key = dictionary.lookup(word.strip(".,!?;:\"()")) if dictionary is not None else None
+    return key, metaphone(word)
+
+
+def sounds_alike(keys, other_keys):
+    """Whether two words' phonetic_keys match: on pronunciation when both are in the dictionary, else on Metaphone."""
+    if keys[0] is not None and other_keys[0] is not None:
+        return keys[0] == other_keys[0]
+    return keys[1] == other_keys[1]
+
+
+def phonetic_texts(*sentences):
+    """
+    A key string per sentence (a list of phonetic_keys) that can be compared
+    with the others: dictionary keys when the dictionary knows every word of
+    every sentence, else Metaphone keys.
+    """
+    column = 0 if all(keys[0] is not None for sentence in sentences for keys in sentence) else 1
+    return [' '.join(keys[column] for keys in sentence) for sentence in sentences]
+
+
+def reset():
+    """Forget the loaded dictionary and cached keys (after rebuilding the dictionary or changing settings)."""
+    global _dictionary, _dictionary_loaded
+    with _lock:
+        _dictionary = None
+        _dictionary_loaded = False
+    phonetic_keys.cache_clear()
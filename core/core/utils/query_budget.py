@@ -0,0 +1,104 @@
+"""
+Query budgets for views.
+
+`@query_budget(n)` declares how many database queries a view may run. With
+QUERY_BUDGET_MODE 'warn' a request over budget, or one that repeats the same
+SELECT (an N+1 pattern, e.g. a lazy foreign key in a loop), is printed; with
+'raise' it raises QueryBudgetExceeded, which is how the tests fail a view that
+regresses. With 'off' (the default) the decorator adds nothing per request.
+"""
+import re
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+MODES = ('off', 'warn', 'raise')
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r'\bIN \((?:\s*(?:%s|\?)\s*,?)+\)', re.IGNORECASE)
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in 'raise' mode when a view runs more queries than its budget or repeats a SELECT."""
+
+
+def mode():
+    return getattr(settings, 'QUERY_BUDGET_MODE', 'off')
+
+
+def sql_shape(sql):
+    """The statement with literals and IN lists collapsed, so repeats of one query compare equal."""
+    return _IN_LIST.sub('IN (...)', _LITERAL.sub('?', sql))
+
+
+class QueryRecorder:
+    """Context manager recording the SQL run on the default connection inside the block."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self._record)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._wrapper.__exit__(*exc)
+        return False
+
+    def _record(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def repeated(self, limit=None):
+        """SELECT shapes run at least `limit` times (default QUERY_BUDGET_REPEAT_LIMIT), with their counts."""
+        limit = limit or getattr(settings, 'QUERY_BUDGET_REPEAT_LIMIT', 3)
+        shapes = Counter(sql_shape(sql) for sql in self.queries if sql.lstrip()[:6].upper() == 'SELECT')
+        return {shape: count for shape, count in shapes.items() if count >= limit}
+
+    def problems(self, budget=None):
+        """Human-readable budget and N+1 findings; empty when all is well."""
+        problems = []
+        if budget is not None and len(self) > budget:
+            problems.append(f"{len(self)} queries, budget {budget}")
+        for shape, count in self.repeated().items():
+            problems.append(f"N+1: {count}x {shape[:160]}")
+        return problems
+
+
+def report(name, recorder, budget=None):
+    """Print or raise (per QUERY_BUDGET_MODE) the recorder's problems for view `name`."""
+    problems = recorder.problems(budget)
+    if not problems:
+        return
+    message = f"Query budget for {name}: " + "; ".join(problems)
+    if mode() == 'raise':
+        raise QueryBudgetExceeded(message)
+    print(message)
+
+
+def query_budget(max_queries):
+    """Declare (and, unless QUERY_BUDGET_MODE is 'off', check) a view's maximum number of queries."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if mode() == 'off':
+                return view(*args, **kwargs)
+            with QueryRecorder() as recorder:
+                response = view(*args, **kwargs)
+            report(view.__qualname__, recorder, max_queries)
+            return response
+        wrapper.query_budget = max_queries
+        return wrapper
+    return decorator
+
+
+def budget_of(view_class_or_func, method=None):
+    """The declared budget of a function view, or of a class-based view's handler for `method`."""
+    view = getattr(view_class_or_func, method, None) if method else view_class_or_func
+    return getattr(view, 'query_budget', None)
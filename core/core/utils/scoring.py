@@ -0,0 +1,83 @@
+from django.conf import settings
+from core.utils.alignment import normalize_words
+from core.utils.levenshtein import (
+    get_backend, levenshtein_distance, levenshtein_distance_myers, levenshtein_distances, myers_distance,
+)
+from core.utils.phonetics import phonetic_keys, phonetic_texts
+
+# 'spelling' compares characters, 'phonetic' compares how the words sound
+SCORING_MODES = ('spelling', 'phonetic')
+
+
+def _score(distance, user_input, expected_text):
+    max_length = max(len(user_input), len(expected_text))
+    if max_length == 0:
+        return 0
+    # Calculate similarity score (0-100)
+    similarity = (1 - distance / max_length) * 100
+    return round(similarity)
+
+
+def spelling_scores(pairs, backend=None):
+    """
+    Spelling similarity scores (0-100) for many (user_input, expected_text)
+    pairs with one bulk distance call. None where either side is empty.
+    """
+    pairs = list(pairs)
+    scored = [i for i, (user_input, expected_text) in enumerate(pairs) if user_input and expected_text]
+    distances = levenshtein_distances(
+        [(pairs[i][0].lower(), pairs[i][1].lower()) for i in scored], backend
+    )
+    scores = [None] * len(pairs)
+    for i, distance in zip(scored, distances):
+        scores[i] = _score(distance, *pairs[i])
+    return scores
+
+
+def spelling_score(user_input, expected_text, backend=None):
+    """
+    Calculate spelling similarity score between user input and expected text.
+    `expected_text` may be a compiled ExpectedSentence (core.utils.expected_index),
+    in which case only the user side is lowercased and, with the myers backend,
+    the expected side's bitmask table is reused.
+    """
+    if not user_input or not expected_text:
+        return None
+    distance_fn = get_backend(backend)
+    if isinstance(expected_text, str):
+        distance = distance_fn(user_input.lower(), expected_text.lower())
+    elif distance_fn is levenshtein_distance_myers:
+        distance = myers_distance(expected_text.peq, len(expected_text.lowered), user_input.lower())
+    else:
+        distance = distance_fn(user_input.lower(), expected_text.lowered)
+    return _score(distance, user_input, expected_text)
+
+
+def phonetic_score(user_input, expected_text, backend=None):
+    """
+    Calculate how alike the two sentences sound (0-100): the edit distance
+    between their per-word phonetic keys, so homophones such as "their" /
+    "there" cost nothing. Same scale as spelling_score, None if either side is empty.
+    """
+    if not user_input or not expected_text:
+        return None
+    if isinstance(expected_text, str):
+        expected_keys = [phonetic_keys(word) for word in normalize_words(expected_text)]
+    else:
+        expected_keys = expected_text.phonetic_keys
+    user_key, expected_key = phonetic_texts([phonetic_keys(word) for word in normalize_words(user_input)], expected_keys)
+    return _score(levenshtein_distance(user_key, expected_key, backend), user_key, expected_key)
+
+
+def scoring_mode(difficulty):
+    """Scoring mode for a topic difficulty level (settings.PHONETIC_SCORING_DIFFICULTIES)."""
+    return 'phonetic' if difficulty in getattr(settings, 'PHONETIC_SCORING_DIFFICULTIES', ()) else 'spelling'
+
+
+def score_answer(user_input, expected_text, mode='spelling', backend=None):
+    """Score an answer (0-100, None if either side is empty) in the given scoring mode."""
+    if mode == 'phonetic':
+        return phonetic_score(user_input, expected_text, backend)
+    if mode == 'spelling':
+        return spelling_score(user_input, expected_text, backend)
+    raise ValueError(f"Unknown scoring mode '{mode}', expected one of {', '.join(SCORING_MODES)}")
@@ -0,0 +1,207 @@
+"""
+Resolving typed topic names to existing topics.
+
+Students type topics freely, so "Favorite Food", "favorite food " and
+"favourite foods" would each get their own ConversationTopic, dialogue pool
+and conversation AI calls. A name is reduced to a key, the sorted set of its
+words with case, punctuation, British spellings, plurals and filler words
+("my", "the", "about", ...) folded away, and looked up among active topics:
+
+- exact: a topic has the same key (one indexed query)
+- fuzzy: opt-in, for typos. A key in the in-memory index with as many words
+         scores at least TOPIC_MATCH_THRESHOLD (RapidFuzz token_sort_ratio,
+         0-100; the default 0 turns this off). Below about 95 this matches
+         different topics ("buying a car" and "buying a cat").
+- miss:  nothing matches and the caller creates the topic
+
+Only a topic with exactly the typed name may be at a difficulty the student
+has not reached (the caller then refuses it, as before); a merely similar
+name only matches topics at the given difficulties.
+
+The index holds the keys of the TOPIC_CACHE_SIZE newest active topics, per
+process; topics created here are added to it (evicting the oldest) and it is
+reloaded from the database every INDEX_MAX_AGE seconds to see other processes'
+topics. The topic's difficulty fixes the dialogue length, so a match also
+reuses dialogues of the right difficulty and length. Counts per outcome are
+kept for stats() and the /metrics counter topic_lookups_total.
+"""
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+from core.utils import tracing
+
+OUTCOMES = ('exact', 'fuzzy', 'miss')
+INDEX_MAX_AGE = 60  # seconds
+
+_index = OrderedDict()  # topic id -> (key, difficulty), oldest first
+_index_loaded_at = None
+_counts = Counter()
+_lock = threading.Lock()
+
+_WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+_IRREGULAR = {
+    'children': 'child', 'people': 'person', 'men': 'man', 'women': 'woman',
+    'feet': 'foot', 'teeth': 'tooth', 'mice': 'mouse', 'geese': 'goose',
+}
+# Words ending in s that are not plurals
+_KEEP = {'news', 'series', 'species', 'clothes', 'glasses', 'sports', 'physics', 'mathematics', 'politics', 'christmas'}
+# Singulars ending in -ie, whose plurals would otherwise become -y ("movies" -> "movy")
+_IE_SINGULARS = {
+    'movie', 'cookie', 'pie', 'tie', 'lie', 'die', 'zombie', 'rookie', 'selfie', 'hippie', 'brownie',
+    'calorie', 'smoothie', 'prairie', 'goalie', 'genie', 'freebie', 'veggie', 'hoodie', 'foodie',
+    'auntie', 'newbie', 'sweetie', 'boogie', 'magpie', 'necktie', 'birdie', 'bootie', 'walkie', 'talkie',
+}
+_SPELLINGS = {
+    'favourite': 'favorite', 'colour': 'color', 'neighbour': 'neighbor', 'neighbourhood': 'neighborhood',
+    'theatre': 'theater', 'centre': 'center', 'travelling': 'traveling', 'traveller': 'traveler',
+    'jewellery': 'jewelry', 'programme': 'program', 'honour': 'honor', 'humour': 'humor',
+    'behaviour': 'behavior', 'flavour': 'flavor', 'harbour': 'harbor', 'labour': 'labor', 'grey': 'gray',
+    'organise': 'organize', 'practise': 'practice', 'licence': 'license', 'defence': 'defense',
+    'catalogue': 'catalog', 'mum': 'mom', 'cosy': 'cozy', 'pyjama': 'pajama', 'tyre': 'tire',
+}
+_STOPWORDS = {
+    'a', 'an', 'the', 'my', 'your', 'our', 'their', 'his', 'her', 'its', 'about', 'of', 'and',
+    'to', 'in', 'on', 'at', 'for', 'with', 'some',
+}
+
+
+def _singular(word):
+    if word.endswith("'s"):
+        word = word[:-2]
+    if word in _IRREGULAR:
+        return _IRREGULAR[word]
+    if len(word) <= 3 or word in _KEEP or word.endswith(('ss', 'us', 'is')) or not word.endswith('s'):
+        return word
+    if word.endswith('ies'):
+        return word[:-1] if len(word) <= 4 or word[:-1] in _IE_SINGULARS else word[:-3] + 'y'
+    if word.endswith(('sses', 'shes', 'xes', 'zes')) or (word.endswith('ches') and not word.endswith('aches')):
+        return word[:-2]
+    return word[:-1]
+
+
+def normalize_topic(name):
+    """The topic's key: its distinct words, normalized and sorted, without filler words unless that leaves none."""
+    words = {_singular(_SPELLINGS.get(word, word)) for word in _WORD.findall(name.lower().replace('’', "'"))}
+    words = {_SPELLINGS.get(word, word) for word in words}  # British plurals ("favourites") once singular
+    return ' '.join(sorted(words - _STOPWORDS or words))
+
+
+def _cache_size():
+    return getattr(settings, 'TOPIC_CACHE_SIZE', 1024)
+
+
+def _active_topics():
+    from teaching.models import ConversationTopic
+    return ConversationTopic.objects.filter(is_active=True)
+
+
+def _add_to_index(topic_id, key, difficulty):
+    # Caller holds _lock
+    _index[topic_id] = (key, difficulty)
+    _index.move_to_end(topic_id)
+    while len(_index) > _cache_size():
+        _index.popitem(last=False)
+        _counts['evictions'] += 1
+
+
+def _index_items():
+    """The (topic id, (key, difficulty)) pairs of the index, reloading it when it is stale."""
+    global _index_loaded_at
+    with _lock:
+        fresh = _index_loaded_at is not None and time.monotonic() - _index_loaded_at < INDEX_MAX_AGE
+        if fresh:
+            return list(_index.items())
+    newest = list(_active_topics().order_by('-id').values_list('id', 'key', 'difficulty_level')[:_cache_size()])
+    with _lock:
+        _index.clear()
+        for topic_id, key, difficulty in reversed(newest):
+            _add_to_index(topic_id, key, difficulty)
+        _index_loaded_at = time.monotonic()
+        _counts['index_loads'] += 1
+        return list(_index.items())
+
+
+def _count(outcome):
+    with _lock:
+        _counts[outcome] += 1
+    tracing.increment('topic_lookups_total', 'Topic lookups by outcome (exact, fuzzy or miss).', outcome=outcome)
+
+
+def _fuzzy_match(key, difficulties):
+    threshold = getattr(settings, 'TOPIC_MATCH_THRESHOLD', 0)
+    if threshold <= 0 or _cache_size() <= 0 or not key:
+        return None
+    from rapidfuzz import fuzz, process
+
+    words = key.count(' ')
+    choices = {
+        topic_id: topic_key for topic_id, (topic_key, difficulty) in _index_items()
+        if topic_key.count(' ') == words and (difficulties is None or difficulty in difficulties)
+    }
+    match = process.extractOne(key, choices, scorer=fuzz.token_sort_ratio, score_cutoff=threshold)
+    return match[2] if match else None
+
+
+def find_topic(name, difficulties=None):
+    """
+    The active topic `name` refers to, or None (counted as a miss). Unless the
+    name is identical, only topics at one of `difficulties` (default: any) match.
+    """
+    key = normalize_topic(name)
+    outcome = 'exact'
+    candidates = list(_active_topics().filter(key=key).order_by('id'))
+    topic = next((topic for topic in candidates if topic.name == name.strip()), None) or next(
+        (topic for topic in candidates if difficulties is None or topic.difficulty_level in difficulties), None
+    )
+    if topic is None:
+        outcome = 'fuzzy'
+        topic_id = _fuzzy_match(key, difficulties)
+        # The index can be up to INDEX_MAX_AGE old: check the topic is still active
+        topic = _active_topics().filter(id=topic_id).first() if topic_id is not None else None
+    if topic is None:
+        _count('miss')
+        return None
+    _count(outcome)
+    return topic
+
+
+def get_or_create_topic(name, difficulties=None, **defaults):
+    """
+    find_topic(name, difficulties), creating the topic with `defaults` when
+    nothing matches. Returns (topic, created).
+    """
+    from teaching.models import ConversationTopic
+
+    topic = find_topic(name, difficulties)
+    if topic is not None:
+        return topic, False
+    topic = ConversationTopic.objects.create(name=name.strip(), **defaults)
+    if topic.is_active:
+        with _lock:
+            if _index_loaded_at is not None:  # otherwise the first load reads it
+                _add_to_index(topic.id, topic.key, topic.difficulty_level)
+    return topic, True
+
+
+def stats():
+    """This process's lookup counts, hit rate and index size."""
+    with _lock:
+        result = {outcome: _counts[outcome] for outcome in OUTCOMES}
+        result['evictions'] = _counts['evictions']
+        result['index_loads'] = _counts['index_loads']
+        result['size'] = len(_index)
+    lookups = sum(result[outcome] for outcome in OUTCOMES)
+    result['hit_rate'] = round((lookups - result['miss']) / lookups, 4) if lookups else 0.0
+    return result
+
+
+def clear():
+    global _index_loaded_at
+    with _lock:
+        _index.clear()
+        _index_loaded_at = None
+        _counts.clear()
@@ -0,0 +1,194 @@
+"""
+Lightweight per-request tracing.
+
+`span(name)` times a stage of the current request; TracingMiddleware collects
+the stages of each request into a Server-Timing header, and every stage also
+feeds a per-process latency histogram that MetricsView exposes in the
+Prometheus text format. Database time is recorded as a 'db' stage through a
+query wrapper. set_gauge() and increment() add plain gauges and counters
+(e.g. the conversation AI's circuit breaker) to the same output.
+
+With TRACING_ENABLED off, span() returns a shared no-op context manager and
+the middleware passes requests straight through.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+from django.conf import settings
+
+# Histogram bucket upper bounds, seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_PREFIX = 'english_teaching_'
+METRIC_NAME = METRIC_PREFIX + 'stage_seconds'
+
+_NOOP = nullcontext()
+_current = contextvars.ContextVar('trace', default=None)
+_histograms = {}  # stage -> [bucket counts..., +Inf count], total seconds
+_values = {}  # gauge/counter name -> [type, help, {labels: value}]
+_lock = threading.Lock()
+
+
+def enabled():
+    return getattr(settings, 'TRACING_ENABLED', False)
+
+
+def observe(name, seconds):
+    """Add one duration to the stage's histogram."""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = [[0] * (len(BUCKETS) + 1), 0.0]
+        counts = histogram[0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        histogram[1] += seconds
+
+
+def _set_value(kind, name, help_text, labels, update):
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        metric = _values.get(name)
+        if metric is None:
+            metric = _values[name] = [kind, help_text, {}]
+        metric[2][key] = update(metric[2].get(key, 0))
+
+
+def set_gauge(name, value, help_text='', **labels):
+    """Set the gauge english_teaching_<name>."""
+    _set_value('gauge', name, help_text, labels, lambda _: value)
+
+
+def increment(name, help_text='', amount=1, **labels):
+    """Add to the counter english_teaching_<name> (by convention ending in _total)."""
+    _set_value('counter', name, help_text, labels, lambda current: current + amount)
+
+
+def record(name, seconds):
+    """Record a finished stage on the current trace (if any) and in the histograms."""
+    spans = _current.get()
+    if spans is not None:
+        spans.append((name, seconds))
+    observe(name, seconds)
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def span(name):
+    """Context manager timing the stage `name`."""
+    if not enabled():
+        return _NOOP
+    return _Span(name)
+
+
+def traced(name):
+    """Decorator form of span()."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def collect():
+    """Collect the stages recorded inside the block into the yielded list of (name, seconds)."""
+    spans = []
+    token = _current.set(spans)
+    try:
+        yield spans
+    finally:
+        _current.reset(token)
+
+
+class TracedResult:
+    """A worker job's result together with the stages it recorded in the worker process."""
+
+    __slots__ = ('value', 'spans')
+
+    def __init__(self, value, spans):
+        self.value = value
+        self.spans = spans
+
+
+def unwrap(result):
+    """Replay a worker's stages in this process and return its plain result."""
+    if isinstance(result, TracedResult):
+        for name, seconds in result.spans:
+            record(name, seconds)
+        return result.value
+    return result
+
+
+def server_timing(spans, total=None):
+    """Server-Timing header value; repeated stages (e.g. several queries) are summed."""
+    durations = {}
+    counts = {}
+    for name, seconds in spans:
+        durations[name] = durations.get(name, 0.0) + seconds
+        counts[name] = counts.get(name, 0) + 1
+    parts = [
+        f'{name};dur={seconds * 1000:.1f}' + (f';desc="x{counts[name]}"' if counts[name] > 1 else '')
+        for name, seconds in durations.items()
+    ]
+    if total is not None:
+        parts.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(parts)
+
+
+def render_prometheus():
+    """All stage histograms, gauges and counters in the Prometheus text exposition format."""
+    with _lock:
+        snapshot = {name: (list(counts), total) for name, (counts, total) in _histograms.items()}
+        values = {name: (kind, help_text, dict(series)) for name, (kind, help_text, series) in _values.items()}
+    lines = [
+        f'# HELP {METRIC_NAME} Time spent per request stage.',
+        f'# TYPE {METRIC_NAME} histogram',
+    ]
+    for name in sorted(snapshot):
+        counts, total = snapshot[name]
+        cumulative = 0
+        for bound, count in zip(BUCKETS, counts):
+            cumulative += count
+            lines.append(f'{METRIC_NAME}_bucket{{stage="{name}",le="{bound:g}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{METRIC_NAME}_bucket{{stage="{name}",le="+Inf"}} {cumulative}')
+        lines.append(f'{METRIC_NAME}_sum{{stage="{name}"}} {total:.6f}')
+        lines.append(f'{METRIC_NAME}_count{{stage="{name}"}} {cumulative}')
+    for name in sorted(values):
+        kind, help_text, series = values[name]
+        lines.append(f'# HELP {METRIC_PREFIX}{name} {help_text}')
+        lines.append(f'# TYPE {METRIC_PREFIX}{name} {kind}')
+        for labels, value in sorted(series.items()):
+            label_text = ','.join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f'{METRIC_PREFIX}{name}{{{label_text}}} {value:g}' if labels else f'{METRIC_PREFIX}{name} {value:g}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _values.clear()
@@ -0,0 +1,116 @@
+import contextvars
+import hashlib
+import json
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import caches
+from core.utils import tracing
+
+# Two kinds of keys point at the same results:
+#   raw:<hash of the uploaded bytes>  - checked by the web process before anything is decoded
+#   pcm:<hash of the decoded samples> - checked by the worker after decoding, so a re-encoded
+#                                       copy of the same audio still skips Whisper
+# Both include the model and every option that can change the result.
+#
+# Hits and misses are counted in memory by the process that serves them; pcm
+# lookups made in a transcription worker are collected there and counted by the
+# web process that ran the job (see collect() and replay()), so stats() covers
+# every lookup of this web process whatever the cache backend.
+CACHE_ALIAS = 'transcriptions'
+STAT_KEYS = ('raw_hits', 'raw_misses', 'pcm_hits', 'pcm_misses')
+
+_counts = Counter()
+_lock = threading.Lock()
+_collected = contextvars.ContextVar('transcription_cache_counts', default=None)
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def _options_fingerprint(expected_text, engine):
+    options = {
+        'model': settings.WHISPER_MODEL_NAME,
+        'backend': getattr(settings, 'WHISPER_BACKEND', 'torch'),
+        'engine': engine,
+        'short': getattr(settings, 'WHISPER_SHORT_UTTERANCE', False),
+        'short_ctx': getattr(settings, 'WHISPER_SHORT_AUDIO_CTX', False),
+    }
+    # The expected sentence only matters when it shapes decoding (decode-length cap, forced scoring)
+    if engine == 'forced' or options['short']:
+        options['expected'] = expected_text or ''
+    return json.dumps(options, sort_keys=True)
+
+
+def _key(kind, data, expected_text, engine):
+    digest = hashlib.sha256(data)
+    digest.update(_options_fingerprint(expected_text, engine).encode())
+    return f"{kind}:{digest.hexdigest()}"
+
+
+def raw_key(audio_bytes, expected_text=None, engine='transcribe'):
+    return _key('raw', bytes(audio_bytes), expected_text, engine)
+
+
+def pcm_key(samples, expected_text=None, engine='transcribe'):
+    return _key('pcm', samples.tobytes(), expected_text, engine)
+
+
+def _count(stat):
+    collected = _collected.get()
+    if collected is not None:
+        collected.append(stat)
+        return
+    with _lock:
+        _counts[stat] += 1
+    kind, outcome = stat.split('_')
+    tracing.increment(
+        'transcription_cache_lookups_total', 'Transcription cache lookups by key kind and outcome.',
+        kind=kind, outcome={'hits': 'hit', 'misses': 'miss'}[outcome],
+    )
+
+
+@contextmanager
+def collect():
+    """Collect the hits and misses inside the block (e.g. a worker job) into the yielded list instead of counting them."""
+    stats = []
+    token = _collected.set(stats)
+    try:
+        yield stats
+    finally:
+        _collected.reset(token)
+
+
+def replay(stats):
+    """Count hits and misses collected by collect(), e.g. in a worker process."""
+    for stat in stats:
+        _count(stat)
+
+
+def get(key):
+    """Return the cached result for `key` or None, counting the hit or miss."""
+    kind = key.split(':', 1)[0]
+    value = get_cache().get(key)
+    _count(f"{kind}_hits" if value is not None else f"{kind}_misses")
+    return value
+
+
+def set(key, value):
+    get_cache().set(key, value)
+
+
+def stats():
+    """This process's hit/miss counters per key kind, plus hit rates."""
+    with _lock:
+        result = {stat: _counts[stat] for stat in STAT_KEYS}
+    for kind in ('raw', 'pcm'):
+        lookups = result[f"{kind}_hits"] + result[f"{kind}_misses"]
+        result[f"{kind}_hit_rate"] = round(result[f"{kind}_hits"] / lookups, 4) if lookups else 0.0
+    return result
+
+
+def reset_stats():
+    with _lock:
+        _counts.clear()
@@ -0,0 +1,389 @@
+import multiprocessing
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from core.utils import tracing, transcription_cache
+
+
+class TranscriptionQueueFull(Exception):
+    """Raised when every worker is busy and the waiting queue is full."""
+
+    def __init__(self, retry_after):
+        super().__init__("Transcription queue is full")
+        self.retry_after = retry_after
+
+
+class TranscriptionTimeout(Exception):
+    """Raised when a job does not finish within the configured timeout."""
+
+
+def _init_worker():
+    """Set up Django and load the model once per worker process (a fresh interpreter under 'spawn')."""
+    import django
+
+    django.setup()
+    from core.utils.whisper import get_model
+
+    get_model()
+
+
+class _JobResult:
+    """A worker job's result with the transcription cache lookups it made, to be counted by the caller."""
+
+    __slots__ = ('value', 'cache_stats')
+
+    def __init__(self, value, cache_stats):
+        self.value = value
+        self.cache_stats = cache_stats
+
+
+def _run_job(func, args, kwargs, traced=False):
+    with transcription_cache.collect() as cache_stats:
+        if not traced:
+            result = func(*args, **kwargs)
+        else:
+            # Send the stages timed in this worker process back with the result
+            with tracing.collect() as spans:
+                result = tracing.TracedResult(func(*args, **kwargs), spans)
+    return _JobResult(result, cache_stats)
+
+
+def _unwrap(result):
+    """Count a worker job's cache lookups and replay its stages in this process; return its plain result."""
+    if isinstance(result, _JobResult):
+        transcription_cache.replay(result.cache_stats)
+        result = result.value
+    return tracing.unwrap(result)
+
+
+class TranscriptionPool:
+    """
+    Runs transcription jobs in a small pool of worker processes so Whisper never
+    blocks a web worker's CPU. At most `max_workers + max_queue` jobs are admitted
+    at a time; anything beyond that is rejected straight away so the caller can
+    answer with a 503 instead of piling up requests.
+
+    Workers are started with 'spawn' by default: forking a threaded web worker,
+    let alone one with torch loaded, can leave a child stuck on a lock (torch's
+    OpenMP and intra-op thread pools are known to deadlock after fork).
+    """
+
+    def __init__(self, max_workers, max_queue, timeout, retry_after, start_method='spawn'):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.start_method = start_method
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._admitted = 0  # jobs holding a slot, running or queued
+        self._admitted_lock = threading.Lock()
+        self._timed_out = weakref.WeakSet()  # futures stopped by _expire
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        mp_context=multiprocessing.get_context(self.start_method),
+                        initializer=_init_worker,
+                    )
+        return self._executor
+
+    def _reset_executor(self, executor=None, kill=False):
+        """
+        Drop `executor` (default: the current one) so the next job starts a fresh
+        pool. With `kill` its workers are stopped too; jobs still running on them fail.
+        """
+        with self._lock:
+            executor = executor or self._executor
+            if executor is None:
+                return
+            if self._executor is executor:
+                self._executor = None
+        # shutdown() forgets the worker processes, so take them first
+        processes = list((getattr(executor, '_processes', None) or {}).values()) if kill else []
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.kill()
+
+    def _submit(self, func, args, kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise TranscriptionQueueFull(self.retry_after)
+        with self._admitted_lock:
+            self._admitted += 1
+        traced = tracing.enabled()
+        try:
+            executor = self._get_executor()
+            future = executor.submit(_run_job, func, args, kwargs, traced)
+        except BrokenProcessPool:
+            # A worker died (OOM, segfault); start over with a fresh pool
+            self._reset_executor(executor)
+            try:
+                executor = self._get_executor()
+                future = executor.submit(_run_job, func, args, kwargs, traced)
+            except Exception:
+                self._release_slot()
+                raise
+        except Exception:
+            self._release_slot()
+            raise
+        released = threading.Lock()
+
+        def release(_=None):
+            if released.acquire(blocking=False):
+                self._release_slot()
+
+        future.add_done_callback(release)
+        if self.timeout:
+            # Nothing interrupts a job once a worker runs it, so a stuck one is stopped from here
+            timer = threading.Timer(self.timeout, self._expire, (future, executor, release))
+            timer.daemon = True
+            timer.start()
+            future.add_done_callback(lambda _: timer.cancel())
+        return future, executor, release
+
+    def _release_slot(self):
+        with self._admitted_lock:
+            self._admitted -= 1
+        self._slots.release()
+
+    def has_idle_worker(self):
+        """Whether a job submitted now would start straight away instead of waiting for a worker."""
+        return self._admitted < self.max_workers
+
+    def _expire(self, future, executor, release):
+        """Give up on a job past its timeout: drop it if still queued, else recycle the pool it runs in."""
+        if future.cancel() or future.done():
+            return
+        self._timed_out.add(future)
+        self._reset_executor(executor, kill=True)
+        release()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue `func(*args, **kwargs)` and return its future, or raise
+        TranscriptionQueueFull. A job still running after the timeout has its
+        pool's workers killed and fails with BrokenProcessPool.
+        """
+        return self._submit(func, args, kwargs)[0]
+
+    def run(self, func, *args, **kwargs):
+        """Submit a job and wait for its result, raising TranscriptionTimeout if it takes too long."""
+        future, executor, release = self._submit(func, args, kwargs)
+        try:
+            return _unwrap(future.result(timeout=self.timeout))
+        except FuturesTimeoutError:
+            self._expire(future, executor, release)
+            raise TranscriptionTimeout(f"Transcription did not finish within {self.timeout}s")
+        except BrokenProcessPool:
+            if future in self._timed_out:
+                # The timer got there before this wait did
+                raise TranscriptionTimeout(f"Transcription did not finish within {self.timeout}s")
+            self._reset_executor(executor)
+            raise
+
+    def shutdown(self):
+        self._reset_executor()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return this process's transcription pool, or None when jobs run inline."""
+    global _pool
+    if getattr(settings, 'TRANSCRIPTION_WORKERS', 0) <= 0:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = TranscriptionPool(
+                    max_workers=settings.TRANSCRIPTION_WORKERS,
+                    max_queue=settings.TRANSCRIPTION_QUEUE_SIZE,
+                    timeout=settings.TRANSCRIPTION_TIMEOUT,
+                    retry_after=settings.TRANSCRIPTION_RETRY_AFTER,
+                    start_method=getattr(settings, 'TRANSCRIPTION_START_METHOD', 'spawn'),
+                )
+    return _pool
+
+
+def run_transcription(func, *args, **kwargs):
+    """Run a transcription job through the pool, or inline when the pool is disabled."""
+    pool = get_pool()
+    if pool is None:
+        return func(*args, **kwargs)
+    return pool.run(func, *args, **kwargs)
+
+
+def has_idle_worker():
+    """Whether a transcription submitted now would start straight away (always, when jobs run inline)."""
+    pool = get_pool()
+    return pool is None or pool.has_idle_worker()
+
+
+class MicroBatcher:
+    """
+    Collects utterances that arrive within a short window and transcribes them
+    as one batch. Each caller still waits on, and gets, only its own result.
+    """
+
+    def __init__(self, run_batch, window, max_batch, max_pending, timeout, retry_after):
+        self.run_batch = run_batch  # callable(list of items) -> Future of list of results
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._loop, name='transcription-batcher', daemon=True)
+                    self._thread.start()
+
+    def _collect(self):
+        """Block for the first item, then gather more until the window closes or the batch is full."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                batch_future = self.run_batch(items)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            batch_future.add_done_callback(lambda f, futures=futures: self._resolve(f, futures))
+
+    @staticmethod
+    def _resolve(batch_future, futures):
+        try:
+            results = _unwrap(batch_future.result())
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)  # e.g. AudioRejected for this item only
+            else:
+                future.set_result(result)
+
+    def submit(self, item):
+        if not self._slots.acquire(blocking=False):
+            raise TranscriptionQueueFull(self.retry_after)
+        future = Future()
+        future.add_done_callback(lambda _: self._slots.release())
+        self._ensure_thread()
+        self._queue.put((item, future))
+        return future
+
+    def run(self, item):
+        future = self.submit(item)
+        try:
+            return future.result(timeout=self.timeout)
+        except FuturesTimeoutError:
+            raise TranscriptionTimeout(f"Transcription did not finish within {self.timeout}s")
+
+
+def _run_batch(items):
+    """Start a batch in the worker pool, or run it inline when the pool is disabled."""
+    from core.utils.whisper import transcribe_batch
+
+    audios = [audio for audio, _ in items]
+    expected_texts = [expected_text for _, expected_text in items]
+    pool = get_pool()
+    if pool is not None:
+        return pool.submit(transcribe_batch, audios, expected_texts)
+    future = Future()
+    try:
+        future.set_result(transcribe_batch(audios, expected_texts))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+_batcher = None
+
+
+def get_batcher():
+    """Return this process's micro-batcher, or None when batching is disabled."""
+    global _batcher
+    if getattr(settings, 'TRANSCRIPTION_MAX_BATCH', 1) <= 1:
+        return None
+    if _batcher is None:
+        with _pool_lock:
+            if _batcher is None:
+                workers = max(settings.TRANSCRIPTION_WORKERS, 1)
+                _batcher = MicroBatcher(
+                    run_batch=_run_batch,
+                    window=settings.TRANSCRIPTION_BATCH_WINDOW_MS / 1000.0,
+                    max_batch=settings.TRANSCRIPTION_MAX_BATCH,
+                    max_pending=workers * settings.TRANSCRIPTION_MAX_BATCH + settings.TRANSCRIPTION_QUEUE_SIZE,
+                    timeout=settings.TRANSCRIPTION_TIMEOUT,
+                    retry_after=settings.TRANSCRIPTION_RETRY_AFTER,
+                )
+    return _batcher
+
+
+def transcribe(audio, expected_text=None):
+    """
+    Transcribe one utterance, batching it with concurrent ones when enabled.
+    `expected_text` lets short-utterance mode cap the decode length. Uploads
+    seen before are answered from the transcription cache without decoding.
+    Raises TranscriptionQueueFull or TranscriptionTimeout under load.
+    """
+    from core.utils.whisper import transcribe_audio, ERROR_MESSAGE
+
+    cache_key = transcription_cache.raw_key(audio, expected_text) if isinstance(audio, bytes) else None
+    if cache_key:
+        cached = transcription_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    batcher = get_batcher()
+    if batcher is None:
+        text = run_transcription(transcribe_audio, audio, expected_text)
+    else:
+        text = batcher.run((audio, expected_text))
+    if cache_key and text != ERROR_MESSAGE:
+        transcription_cache.set(cache_key, text)
+    return text
+
+
+def score(audio, expected_text):
+    """Forced-alignment scoring in the worker pool, cached like transcribe()."""
+    from core.utils.forced_alignment import score_expected
+
+    cache_key = transcription_cache.raw_key(audio, expected_text, engine='forced')
+    cached = transcription_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    result = run_transcription(score_expected, audio, expected_text)
+    transcription_cache.set(cache_key, result)
+    return result
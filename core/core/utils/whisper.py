@@ -1,78 +1,319 @@
-import whisper
-import os
-import subprocess
-import tempfile
-from Levenshtein import ratio
+import threading
+from django.conf import settings
+from core.utils import transcription_cache
+from core.utils.audio import SAMPLE_RATE, load_audio, trim_silence
+from core.utils.audio_guard import AudioRejected, decode_checked
+from core.utils.tracing import span
 
-# Use a better model for improved accuracy
-model = whisper.load_model("base")  # Changed from "tiny" to "base" for better accuracy
+# Whisper (and torch) are imported lazily so that management commands, the admin
+# and workers that never touch audio don't pay the import and model load cost.
+# One model is kept per inference backend (see core.utils.whisper_backends).
+_models = {}
+_model_lock = threading.Lock()
 
-def convert_audio_to_wav(input_path, output_path):
-    """Convert audio to WAV format using ffmpeg if available."""
-    try:
-        # Try to use ffmpeg for better audio conversion
-        subprocess.run([
-            'ffmpeg', '-i', input_path, 
-            '-ar', '16000',  # 16kHz sample rate (Whisper's preferred)
-            '-ac', '1',      # Mono channel
-            '-c:a', 'pcm_s16le',  # 16-bit PCM
-            output_path, '-y'
-        ], check=True, capture_output=True)
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        # ffmpeg not available or failed, return False to use original file
-        return False
-
-def transcribe_audio(audio_path):
-    """Transcribe audio file to text using Whisper with improved processing."""
-    converted_file = None
-    try:
-        # Try to convert audio for better quality
-        temp_dir = os.path.dirname(audio_path)
-        converted_file = os.path.join(temp_dir, f"converted_{os.path.basename(audio_path)}.wav")
+
+def _configure_torch():
+    """Apply the configured CPU thread count before the model is built."""
+    import torch
+
+    num_threads = getattr(settings, 'WHISPER_NUM_THREADS', 0)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def get_model(backend=None):
+    """Return the process-wide Whisper model for `backend` (default WHISPER_BACKEND), loading it on first use."""
+    backend = backend or getattr(settings, 'WHISPER_BACKEND', 'torch')
+    model = _models.get(backend)
+    if model is None:
+        with _model_lock:
+            model = _models.get(backend)
+            if model is None:
+                import whisper
+                from core.utils.whisper_backends import apply_backend
+
+                _configure_torch()
+                model = whisper.load_model(
+                    getattr(settings, 'WHISPER_MODEL_NAME', 'base'),
+                    device=getattr(settings, 'WHISPER_DEVICE', 'cpu'),
+                    download_root=getattr(settings, 'WHISPER_DOWNLOAD_ROOT', None),
+                )
+                model.eval()
+                model = apply_backend(model, backend)
+                _models[backend] = model
+    return model
+
+
+def is_model_loaded(backend=None):
+    return (backend or getattr(settings, 'WHISPER_BACKEND', 'torch')) in _models
+
+
+def preload_model():
+    """
+    Load the model eagerly. Call this in the master process before workers fork
+    (gunicorn --preload) so every worker shares the weights copy-on-write.
+    """
+    model = get_model()
+    # Freeze the parameters in place; nothing writes to them afterwards, so the
+    # pages stay shared between the forked workers.
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
+
+
+def clean_transcription(text):
+    """Strip Whisper artifacts and map empty or junk output to a friendly message."""
+    text = text.strip()
+    if text:
+        # Remove common Whisper artifacts
+        text = text.replace(".", "").replace(",", "").replace("!", "").replace("?", "")
+        text = " ".join(text.split())  # Normalize whitespace
         
-        if convert_audio_to_wav(audio_path, converted_file):
-            # Use converted file if conversion was successful
-            transcription_file = converted_file
-        else:
-            # Use original file if conversion failed
-            transcription_file = audio_path
+        # Filter out very short or common whisper errors
+        if len(text) < 2 or text.lower() in ["you", "thank you", "thanks", ""]:
+            return "Sorry, I couldn't understand that clearly. Please try speaking again."
         
-        # Enhanced transcription options
-        result = model.transcribe(
-            transcription_file,
-            language="en",  # Force English language
-            fp16=False,     # Use FP32 for better accuracy on CPU
-            temperature=0.0,  # Deterministic output
-            best_of=1,      # Use beam search
-            beam_size=5,    # Better beam search
-            word_timestamps=False,  # Don't need word-level timestamps
-            condition_on_previous_text=False  # Don't condition on previous text
+        return text
+    else:
+        return "Sorry, I couldn't understand that. Please try speaking more clearly."
+
+ERROR_MESSAGE = "Sorry, there was an error processing your speech. Please try again."
+
+# Decode-length cap for short utterances: the expected sentence's token count times
+# this factor, plus a margin for timestamp tokens and misrecognised words.
+SAMPLE_LEN_FACTOR = 2.0
+SAMPLE_LEN_MARGIN = 10
+
+_tokenizer = None
+
+
+def _get_tokenizer(model):
+    global _tokenizer
+    if _tokenizer is None:
+        from whisper.tokenizer import get_tokenizer
+
+        _tokenizer = get_tokenizer(
+            model.is_multilingual, num_languages=model.num_languages, language="en", task="transcribe"
         )
-        
-        text = result["text"].strip()
-        
-        # Clean up the transcribed text
-        if text:
-            # Remove common Whisper artifacts
-            text = text.replace(".", "").replace(",", "").replace("!", "").replace("?", "")
-            text = " ".join(text.split())  # Normalize whitespace
-            
-            # Filter out very short or common whisper errors
-            if len(text) < 2 or text.lower() in ["you", "thank you", "thanks", ""]:
-                return "Sorry, I couldn't understand that clearly. Please try speaking again."
-            
-            return text
+    return _tokenizer
+
+
+def _transcribe_full(model, samples):
+    """The general path: model.transcribe over as many 30s windows as needed."""
+    result = model.transcribe(
+        samples,
+        language="en",  # Force English language
+        fp16=False,     # Use FP32 for better accuracy on CPU
+        temperature=0.0,  # Deterministic output
+        best_of=1,      # Use beam search
+        beam_size=5,    # Better beam search
+        word_timestamps=False,  # Don't need word-level timestamps
+        condition_on_previous_text=False  # Don't condition on previous text
+    )
+    return result["text"]
+
+
+def _sample_len_for(model, expected_texts):
+    """Cap the number of decoded tokens from the sentences we expect to hear."""
+    if not getattr(settings, 'WHISPER_SHORT_UTTERANCE', False) or any(not text for text in expected_texts):
+        return None
+    tokenizer = _get_tokenizer(model)
+    longest = max(len(tokenizer.encode(" " + text.strip())) for text in expected_texts)
+    return min(int(longest * SAMPLE_LEN_FACTOR) + SAMPLE_LEN_MARGIN, model.dims.n_text_ctx // 2)
+
+
+def _audio_ctx_for(model, n_samples):
+    """
+    Encoder positions needed for `n_samples` of audio when a reduced context is
+    enabled (50 positions per second, plus a second of headroom, rounded up).
+    """
+    full_ctx = model.dims.n_audio_ctx
+    if not getattr(settings, 'WHISPER_SHORT_AUDIO_CTX', False):
+        return full_ctx
+    seconds = n_samples / SAMPLE_RATE + 1.0
+    ctx = -(-int(seconds * 50) // 64) * 64
+    return min(ctx, full_ctx)
+
+
+def _encode(model, mel):
+    """AudioEncoder.forward without the fixed 1500-position assertion."""
+    import torch.nn.functional as F
+
+    encoder = model.encoder
+    if getattr(encoder, 'supports_variable_length', False):
+        return encoder(mel)
+    x = F.gelu(encoder.conv1(mel))
+    x = F.gelu(encoder.conv2(x))
+    x = x.permute(0, 2, 1)
+    x = (x + encoder.positional_embedding[:x.shape[1]]).to(x.dtype)
+    for block in encoder.blocks:
+        x = block(x)
+    return encoder.ln_post(x)
+
+
+def _batched_decoding_task(model, options, audio_ctx=None):
+    """
+    DecodingTask that supports beam search over a batch of windows.
+
+    openai-whisper 20240930 expands the text tokens by the beam size but not the
+    audio features, which only works for a batch of one. Expand the features
+    here and hand language detection the de-duplicated ones. With `audio_ctx`
+    smaller than the model's, the encoder runs on a truncated window.
+    """
+    from whisper.decoding import DecodingTask
+
+    class BatchedDecodingTask(DecodingTask):
+        def _get_audio_features(self, mel):
+            if audio_ctx and audio_ctx < model.dims.n_audio_ctx:
+                features = _encode(model, mel)
+            else:
+                features = super()._get_audio_features(mel)
+            return features.repeat_interleave(self.n_group, dim=0)
+
+        def _detect_language(self, audio_features, tokens):
+            return super()._detect_language(audio_features[::self.n_group], tokens)
+
+    return BatchedDecodingTask(model, options)
+
+
+def _decode_windows(model, sample_list, expected_texts):
+    """
+    Decode utterances of at most 30s each in one batch and return the raw texts.
+    Every utterance gets its own mel window, all of the same length.
+    """
+    import torch
+    import whisper
+    from whisper.audio import HOP_LENGTH
+
+    audio_ctx = _audio_ctx_for(model, max(len(samples) for samples in sample_list))
+    window = audio_ctx * 2 * HOP_LENGTH  # two mel frames per encoder position
+    mels = [
+        whisper.log_mel_spectrogram(whisper.pad_or_trim(samples, window), model.dims.n_mels)
+        for samples in sample_list
+    ]
+    options = whisper.DecodingOptions(
+        language="en",
+        fp16=False,
+        temperature=0.0,
+        beam_size=5,
+        sample_len=_sample_len_for(model, expected_texts),
+    )
+    decoded = _batched_decoding_task(model, options, audio_ctx).run(torch.stack(mels).to(model.device))
+
+    texts = []
+    for result in decoded:
+        # model.transcribe drops windows it considers silence; do the same
+        if result.no_speech_prob > 0.6 and result.avg_logprob < -1.0:
+            texts.append("")
         else:
-            return "Sorry, I couldn't understand that. Please try speaking more clearly."
-            
+            texts.append(result.text)
+    return texts
+
+
+def _prepare_samples(audio):
+    """Decode the audio and, in short-utterance mode, trim leading/trailing silence."""
+    samples = load_audio(audio)
+    if getattr(settings, 'WHISPER_SHORT_UTTERANCE', False):
+        samples = trim_silence(samples)
+    return samples
+
+
+def _fits_one_window(samples):
+    from whisper.audio import N_SAMPLES
+
+    return 0 < len(samples) <= N_SAMPLES
+
+
+def transcribe_audio(audio, expected_text=None):
+    """
+    Transcribe audio to text using Whisper with improved processing.
+
+    `audio` can be the uploaded bytes, a file path or an already decoded 16kHz
+    float32 array; see core.utils.audio.load_audio. In short-utterance mode the
+    audio is trimmed and, when `expected_text` is known, the decode length is
+    capped from it. Raises AudioRejected for empty, silent or over-long audio.
+    """
+    try:
+        with span('audio_decode'):
+            samples = decode_checked(audio)
+        cache_key = transcription_cache.pcm_key(samples, expected_text)
+        cached = transcription_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        model = get_model()
+        samples = _prepare_samples(samples)
+        if len(samples) == 0:
+            text = clean_transcription("")
+        elif getattr(settings, 'WHISPER_SHORT_UTTERANCE', False) and _fits_one_window(samples):
+            with span('whisper'):
+                text = clean_transcription(_decode_windows(model, [samples], [expected_text])[0])
+        else:
+            with span('whisper'):
+                text = clean_transcription(_transcribe_full(model, samples))
+        transcription_cache.set(cache_key, text)
+        return text
+
+    except AudioRejected:
+        raise
     except Exception as e:
         print(f"Error transcribing audio: {str(e)}")
-        return "Sorry, there was an error processing your speech. Please try again."
-    finally:
-        # Clean up converted file
-        if converted_file and os.path.exists(converted_file):
+        return ERROR_MESSAGE
+
+def transcribe_batch(audios, expected_texts=None):
+    """
+    Transcribe several short utterances with one batched encoder/decoder pass.
+
+    In short-utterance mode every utterance is padded to its own mel window and
+    the windows are stacked, so the model sees a single batch instead of N
+    batch-of-one calls. Otherwise, and for anything longer than 30s, each one
+    goes through model.transcribe on its own, as in transcribe_audio. Returns one
+    cleaned transcription per input, in order, or the AudioRejected error for
+    inputs that failed the audio checks.
+    """
+    expected_texts = expected_texts or [None] * len(audios)
+    results = [None] * len(audios)
+    try:
+        model = get_model()
+        batch = []
+        positions = []
+        cache_keys = [None] * len(audios)
+        for i, audio in enumerate(audios):
             try:
-                os.remove(converted_file)
-            except Exception:
-                pass
+                with span('audio_decode'):
+                    samples = decode_checked(audio)
+            except AudioRejected as e:
+                results[i] = e
+                continue
+            except Exception as e:
+                print(f"Error decoding audio: {str(e)}")
+                results[i] = ERROR_MESSAGE
+                continue
+            cache_keys[i] = transcription_cache.pcm_key(samples, expected_texts[i])
+            results[i] = transcription_cache.get(cache_keys[i])
+            if results[i] is not None:
+                cache_keys[i] = None
+                continue
+
+            samples = _prepare_samples(samples)
+            if len(samples) == 0:
+                results[i] = clean_transcription("")
+            elif getattr(settings, 'WHISPER_SHORT_UTTERANCE', False) and _fits_one_window(samples):
+                batch.append(samples)
+                positions.append(i)
+            else:
+                with span('whisper'):
+                    results[i] = clean_transcription(_transcribe_full(model, samples))
+
+        if batch:
+            with span('whisper'):
+                texts = _decode_windows(model, batch, [expected_texts[i] for i in positions])
+            for i, text in zip(positions, texts):
+                results[i] = clean_transcription(text)
+        for key, text in zip(cache_keys, results):
+            if key:
+                transcription_cache.set(key, text)
+    except Exception as e:
+        print(f"Error transcribing audio batch: {str(e)}")
+        results = [r if r is not None else ERROR_MESSAGE for r in results]
+    return results
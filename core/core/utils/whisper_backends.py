@@ -0,0 +1,116 @@
+"""
+Inference backends for the Whisper model.
+
+- torch:      the stock PyTorch model (fp32 on CPU)
+- torch-int8: the PyTorch model with its Linear layers dynamically quantized to int8
+- onnx:       the audio encoder runs in ONNX Runtime from a file made by
+              `manage.py export_whisper_model`; the decoder stays in PyTorch.
+              Falls back to torch if onnxruntime or the file is missing.
+
+Every backend returns an object with the regular Whisper model interface, so
+transcribe_audio and friends work unchanged.
+"""
+import os
+from django.conf import settings
+
+BACKENDS = ('torch', 'torch-int8', 'onnx')
+
+
+def onnx_encoder_path(model_name=None):
+    model_name = model_name or settings.WHISPER_MODEL_NAME
+    return os.path.join(settings.WHISPER_ONNX_DIR, f"whisper-{model_name}-encoder.onnx")
+
+
+def quantize_int8(model):
+    """Dynamically quantize every Linear layer of the model to int8 (CPU only)."""
+    import torch
+
+    # whisper.model.Linear only overrides forward() to cast the weights to the
+    # input dtype, a no-op in fp32; quantize_dynamic only accepts plain nn.Linear.
+    for module in model.modules():
+        if isinstance(module, torch.nn.Linear) and type(module) is not torch.nn.Linear:
+            module.__class__ = torch.nn.Linear
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _encoder_for_export(encoder):
+    """Wrap the encoder so the number of mel frames can vary (the stock forward asserts 3000)."""
+    import torch
+    import torch.nn.functional as F
+
+    class VariableLengthEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.encoder = encoder
+
+        def forward(self, mel):
+            x = F.gelu(self.encoder.conv1(mel))
+            x = F.gelu(self.encoder.conv2(x))
+            x = x.permute(0, 2, 1)
+            x = x + self.encoder.positional_embedding[:x.shape[1]]
+            for block in self.encoder.blocks:
+                x = block(x)
+            return self.encoder.ln_post(x)
+
+    return VariableLengthEncoder().eval()
+
+
+def export_onnx_encoder(model, path):
+    """Export the model's audio encoder to ONNX with dynamic batch and frame axes."""
+    import torch
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    mel = torch.zeros(1, model.dims.n_mels, model.dims.n_audio_ctx * 2)
+    torch.onnx.export(
+        _encoder_for_export(model.encoder),
+        (mel,),
+        path,
+        input_names=['mel'],
+        output_names=['audio_features'],
+        dynamic_axes={'mel': {0: 'batch', 2: 'frames'}, 'audio_features': {0: 'batch', 1: 'positions'}},
+        opset_version=17,
+        dynamo=False,
+    )
+    return path
+
+
+def _onnx_encoder(path):
+    import numpy as np
+    import onnxruntime
+    import torch
+
+    options = onnxruntime.SessionOptions()
+    num_threads = getattr(settings, 'WHISPER_NUM_THREADS', 0)
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    class OnnxEncoder(torch.nn.Module):
+        # Accepts any number of mel frames, see _encoder_for_export
+        supports_variable_length = True
+
+        def forward(self, mel):
+            features = session.run(None, {'mel': mel.detach().cpu().numpy().astype(np.float32)})[0]
+            return torch.from_numpy(features).to(mel.device)
+
+    return OnnxEncoder()
+
+
+def apply_backend(model, backend):
+    """Convert a freshly loaded PyTorch Whisper model to the requested backend."""
+    if backend == 'torch':
+        return model
+    if backend == 'torch-int8':
+        return quantize_int8(model)
+    if backend == 'onnx':
+        # Without onnxruntime or the exported encoder, keep serving with torch
+        path = onnx_encoder_path()
+        if not os.path.exists(path):
+            print(f"Error loading ONNX encoder: {path} not found, run `manage.py export_whisper_model` first; using torch")
+            return model
+        try:
+            model.encoder = _onnx_encoder(path)
+        except ImportError as e:
+            print(f"Error loading ONNX encoder: {str(e)}; using torch")
+        return model
+    raise ValueError(f"Unknown WHISPER_BACKEND '{backend}', expected one of {', '.join(BACKENDS)}")
@@ -14,3 +14,13 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_wsgi_application()
+
+
+# Load the Whisper model before gunicorn forks its workers (requires --preload).
+# Only when Whisper runs inline: pool workers load their own copy.
+from django.conf import settings
+
+if settings.WHISPER_PRELOAD and settings.TRANSCRIPTION_WORKERS <= 0:
+    from core.utils.whisper import preload_model
+
+    preload_model()
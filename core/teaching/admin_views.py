@@ -1,15 +1,23 @@
+import hmac
 from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
 from django.db.models import Avg, Count, Q
+from django.utils import timezone
+from datetime import timedelta
 from django.utils.decorators import method_decorator
 from django.views import View
 from .models import UserProgress, Message, User
 from django.contrib.auth.models import User
+from django.conf import settings
+from core.utils import topic_cache, tracing, transcription_cache
+from core.utils.query_budget import query_budget
 
 @method_decorator(staff_member_required, name='dispatch')
 class ScoreAnalyticsView(View):
     template_name = 'admin/teaching/score_analytics.html'
     
+    @query_budget(7)
     def get(self, request):
         # Overall statistics
         total_students = UserProgress.objects.count()
@@ -39,15 +47,26 @@ class ScoreAnalyticsView(View):
             spelling_score__lt=70
         ).count()
         
+        # Per-student averages, attempts and recent performance in one query
+        scored = Q(user__room__messages__role='user', user__room__messages__spelling_score__isnull=False)
+        recent = scored & Q(user__room__messages__created_at__gte=timezone.now() - timedelta(days=7))
+        progresses = UserProgress.objects.select_related('user').annotate(
+            avg_score=Avg('user__room__messages__spelling_score', filter=scored),
+            attempts=Count('user__room__messages', filter=scored),
+            recent_avg=Avg('user__room__messages__spelling_score', filter=recent),
+        )
+        student_scores = [
+            (progress, round(progress.avg_score, 2) if progress.avg_score else 0) for progress in progresses
+        ]
+        
         # Top performers
         top_performers = []
-        for progress in UserProgress.objects.select_related('user').all():
-            avg_score = progress.get_average_score()
+        for progress, avg_score in student_scores:
             if avg_score > 0:
                 top_performers.append({
                     'user': progress.user,
                     'score': avg_score,
-                    'attempts': progress.get_total_attempts()
+                    'attempts': progress.attempts
                 })
         
         top_performers.sort(key=lambda x: x['score'], reverse=True)
@@ -55,15 +74,13 @@ class ScoreAnalyticsView(View):
         
         # Students needing help
         students_needing_help = []
-        for progress in UserProgress.objects.select_related('user').all():
-            avg_score = progress.get_average_score()
-            attempts = progress.get_total_attempts()
-            if 0 < avg_score < 70 and attempts >= 5:  # At least 5 attempts
+        for progress, avg_score in student_scores:
+            if 0 < avg_score < 70 and progress.attempts >= 5:  # At least 5 attempts
                 students_needing_help.append({
                     'user': progress.user,
                     'score': avg_score,
-                    'attempts': attempts,
-                    'recent_performance': progress.get_recent_performance()
+                    'attempts': progress.attempts,
+                    'recent_performance': round(progress.recent_avg, 2) if progress.recent_avg else 0
                 })
         
         students_needing_help.sort(key=lambda x: x['score'])
@@ -80,4 +97,29 @@ class ScoreAnalyticsView(View):
             'title': 'Student Score Analytics',
         }
         
-        return render(request, self.template_name, context)
\ No newline at end of file
+        return render(request, self.template_name, context)
+
+@method_decorator(staff_member_required, name='dispatch')
+class TranscriptionCacheStatsView(View):
+    @query_budget(0)
+    def get(self, request):
+        return JsonResponse(transcription_cache.stats())
+
+@method_decorator(staff_member_required, name='dispatch')
+class TopicCacheStatsView(View):
+    @query_budget(0)
+    def get(self, request):
+        return JsonResponse(topic_cache.stats())
+
+class MetricsView(View):
+    """Per-stage latency histograms for Prometheus; staff only, or a scraper sending METRICS_TOKEN as a bearer token."""
+
+    @query_budget(2)
+    def get(self, request):
+        token = getattr(settings, 'METRICS_TOKEN', '')
+        authorized = request.user.is_authenticated and request.user.is_staff
+        if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            authorized = True
+        if not authorized:
+            return HttpResponse(status=403)
+        return HttpResponse(tracing.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import time
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from .models import Room
+from .views import AnswerConflict, ExchangePending, MessageView, room_group, transcribe_answer
+from core.utils.audio import SAMPLE_RATE, load_audio
+from core.utils.audio_guard import AudioRejected
+from core.utils.transcription_pool import has_idle_worker, transcribe, TranscriptionQueueFull, TranscriptionTimeout
+from core.utils.whisper import ERROR_MESSAGE
+
+
+class RoomConsumer(AsyncWebsocketConsumer):
+    """
+    Streams a spoken answer for one room while the student is talking.
+
+    Client -> server:
+        {"type": "start"}   begin a new answer
+        binary frames       MediaRecorder chunks, in order
+        {"type": "stop"}    the student stopped talking
+        {"type": "cancel"}  drop the answer in progress
+    Server -> client:
+        {"type": "ready", "expected_response": ...}
+        {"type": "partial", "text": ...}    transcript of the audio received so far
+        {"type": "result", ...}             same payload as POST room/<id>/send/
+        {"type": "error", "error": ..., "code": ...}
+        {"type": "topic_job", "job_id": ..., "status": "ready" | "failed", ...}
+                                            a background conversation (TopicView with
+                                            "async") finished; when ready, the rest is
+                                            the same payload as POST room/<id>/topic/
+
+    Partials transcribe the last STREAMING_PARTIAL_WINDOW_SECONDS of the
+    recording so far, at most every STREAMING_PARTIAL_INTERVAL_MS, one at a
+    time and only when a transcription worker is idle, so they never queue in
+    front of final answers. When the last partial already covered all the audio
+    the final answer is served from the transcription cache.
+    """
+
+    async def connect(self):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            await self.close(code=4401)
+            return
+        room_id = self.scope['url_route']['kwargs']['room_id']
+        self.room = await database_sync_to_async(Room.objects.filter(id=room_id, user=user).first)()
+        if self.room is None:
+            await self.close(code=4404)
+            return
+        self._reset()
+        self.group = room_group(self.room.id)
+        if self.channel_layer is not None:
+            await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, code):
+        if getattr(self, 'partial_task', None) is not None:
+            self.partial_task.cancel()
+        if getattr(self, 'group', None) and self.channel_layer is not None:
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+
+    async def job_finished(self, event):
+        await self.send_event(
+            'topic_job', job_id=event['job_id'], status=event['status'], error=event['error'],
+            **(event['result'] or {}),
+        )
+
+    def _reset(self, expected_response=None):
+        if getattr(self, 'partial_task', None) is not None and not self.partial_task.done():
+            self.partial_task.cancel()
+        self.expected_response = expected_response
+        self.chunks = []
+        self.size = 0
+        self.partial_task = None
+        self.partial_size = 0
+        self.last_partial_at = 0.0
+
+    async def send_event(self, event_type, **data):
+        await self.send(text_data=json.dumps({'type': event_type, **data}))
+
+    async def send_error(self, error, code=None):
+        self.expected_response = None
+        await self.send_event('error', error=error, code=code)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            await self._receive_chunk(bytes_data)
+            return
+
+        try:
+            message = json.loads(text_data)
+        except ValueError:
+            await self.send_error('Invalid message')
+            return
+        if message.get('type') == 'start':
+            expected_response = await database_sync_to_async(self._current_expected_response)()
+            if expected_response is None:
+                await self.send_error('No active conversation. Please select a topic first.')
+                return
+            self._reset(expected_response)
+            await self.send_event('ready', expected_response=expected_response)
+        elif message.get('type') == 'stop':
+            await self._finish()
+        elif message.get('type') == 'cancel':
+            self._reset()
+
+    async def _receive_chunk(self, chunk):
+        if self.expected_response is None:
+            return  # no answer in progress
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        if self.size > settings.AUDIO_MAX_UPLOAD_BYTES:
+            rejected = AudioRejected('too_large')
+            self._reset()
+            await self.send_error(rejected.message, rejected.code)
+            return
+
+        interval = settings.STREAMING_PARTIAL_INTERVAL_MS / 1000.0
+        if self.partial_task is None or self.partial_task.done():
+            if time.monotonic() - self.last_partial_at >= interval and has_idle_worker():
+                self.last_partial_at = time.monotonic()
+                self.partial_size = self.size
+                self.partial_task = asyncio.create_task(
+                    self._send_partial(b''.join(self.chunks), self.expected_response)
+                )
+
+    @staticmethod
+    def _transcribe_partial(audio_bytes, expected_response):
+        # The container has to be decoded from its start, but Whisper only gets the trailing window
+        samples = load_audio(audio_bytes, max_seconds=settings.AUDIO_MAX_SECONDS + 1)
+        return transcribe(samples[-int(settings.STREAMING_PARTIAL_WINDOW_SECONDS * SAMPLE_RATE):], expected_response)
+
+    async def _send_partial(self, audio_bytes, expected_response):
+        try:
+            text = await sync_to_async(self._transcribe_partial, thread_sensitive=False)(audio_bytes, expected_response)
+        except AudioRejected:
+            return  # e.g. too short yet; the final result reports real errors
+        except (TranscriptionQueueFull, TranscriptionTimeout) as e:
+            print(f"Skipped partial transcript: {str(e)}")
+            return
+        except Exception as e:
+            print(f"Error transcribing partial: {str(e)}")  # an incomplete chunk ffmpeg can't decode yet
+            return
+        if text != ERROR_MESSAGE and self.expected_response == expected_response:
+            await self.send_event('partial', text=text)
+
+    async def _finish(self):
+        if self.expected_response is None:
+            return
+        expected_response = self.expected_response
+        audio_bytes = b''.join(self.chunks)
+        if self.partial_task is not None and self.partial_size == self.size:
+            await self.partial_task  # it covers the whole recording, the final hits the cache
+        self._reset()
+
+        try:
+            transcribed_text, spelling_score, word_comparison = await sync_to_async(
+                transcribe_answer, thread_sensitive=False
+            )(audio_bytes, expected_response)
+        except TranscriptionQueueFull:
+            await self.send_error('Speech recognition is busy right now. Please try again in a few seconds.', 'busy')
+            return
+        except TranscriptionTimeout:
+            await self.send_error('Speech recognition took too long. Please try again.', 'timeout')
+            return
+        except AudioRejected as e:
+            await self.send_error(e.message, e.code)
+            return
+
+        payload = await database_sync_to_async(self._record_answer)(
+            transcribed_text, expected_response, spelling_score, word_comparison
+        )
+        if payload is None:
+            await self.send_error('Failed to process message')
+            return
+        if payload.get('pending'):
+            await self.send_error('The rest of the conversation is still being written. Please try again in a moment.', 'pending')
+            return
+        await self.send_event('result', **payload)
+
+    def _current_session(self):
+        return self.room.conversation_sessions.filter(is_completed=False).first()
+
+    def _current_expected_response(self):
+        session = self._current_session()
+        current_exchange = session.get_current_exchange() if session else None
+        return current_exchange['user_should_say'] if current_exchange else None
+
+    def _record_answer(self, transcribed_text, expected_response, spelling_score, word_comparison):
+        try:
+            session = self._current_session()
+            current_exchange = session.get_current_exchange() if session else None
+            if not current_exchange or current_exchange['user_should_say'] != expected_response:
+                return None  # the conversation moved on while this answer was being recorded
+            return MessageView().record_answer(
+                self.room, session, transcribed_text, expected_response, spelling_score, word_comparison
+            )
+        except AnswerConflict:
+            return None  # another request already answered this exchange
+        except ExchangePending:
+            return {'pending': True}
+        except Exception as e:
+            print(f"Error in RoomConsumer: {str(e)}")
+            return None
@@ -0,0 +1,312 @@
+import io
+import json
+import math
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from teaching.models import Room, UserProgress
+from teaching.views import MessageView
+from core.utils.audio import SAMPLE_RATE
+from core.utils.conversation_ai import StubConversationAI
+from core.utils.levenshtein import BACKENDS, levenshtein_distance
+from core.utils.whisper import get_model, transcribe_audio
+from .benchmark_scoring import _make_pair
+from .benchmark_whisper import AUDIO_EXTENSIONS
+
+ENDPOINTS = ('room', 'topic', 'text', 'audio')
+TOPICS = ('independence day holiday', 'weekend plans', 'favourite food', 'travel')
+
+# Synthetic voiced clips (seconds, fundamental Hz): loud enough to pass the
+# silence check and short enough for the short-utterance path
+FIXTURES = ((1.5, 120.0), (2.5, 180.0), (4.0, 220.0))
+
+
+def synthetic_wav(seconds, frequency, seed=0):
+    """16kHz mono 16-bit WAV bytes: a few harmonics with a syllable-rate envelope and a little noise."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    voice = sum(np.sin(2 * np.pi * frequency * k * t) / k for k in range(1, 6))
+    envelope = 0.5 * (1 - np.cos(2 * np.pi * 4 * t)) * np.minimum(1, np.minimum(t, seconds - t) * 10)
+    samples = 0.25 * voice * envelope + 0.01 * rng.standard_normal(len(t))
+    pcm = (np.clip(samples, -1, 1) * 32767).astype('<i2')
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, wall_time=None, queries=None, errors=0):
+    """p50/p95/p99 and mean latency in ms, throughput and query counts for one endpoint or function."""
+    values = sorted(latencies)
+    summary = {
+        'count': len(values),
+        'errors': errors,
+        'p50_ms': round(percentile(values, 50) * 1000, 3) if values else None,
+        'p95_ms': round(percentile(values, 95) * 1000, 3) if values else None,
+        'p99_ms': round(percentile(values, 99) * 1000, 3) if values else None,
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else None,
+    }
+    if wall_time:
+        summary['throughput_rps'] = round(len(values) / wall_time, 2)
+    if queries:
+        summary['queries_mean'] = round(sum(queries) / len(queries), 2)
+        summary['queries_max'] = max(queries)
+    return summary
+
+
+class Student:
+    """One simulated student: a logged-in test client with its own room."""
+
+    def __init__(self, name, rng):
+        self.rng = rng
+        self.user = User.objects.create_user(f'bench-{name}', password='benchmark')
+        UserProgress.objects.create(user=self.user)
+        self.room = Room.objects.create(user=self.user, title='Benchmark')
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.expected = None
+
+    def start_topic(self):
+        response = self.client.post(
+            f'/room/{self.room.id}/topic/', data={'topic': self.rng.choice(TOPICS)}, content_type='application/json'
+        )
+        if response.status_code == 200:
+            self.expected = response.json()['expected_response']
+        return response
+
+    def answer(self):
+        """A near-correct answer, so sessions advance and eventually complete."""
+        words = self.expected.split()
+        if len(words) > 3 and self.rng.random() < 0.5:
+            words.pop(self.rng.randrange(len(words)))
+        response = self.client.post(
+            f'/room/{self.room.id}/send/', data={'content': ' '.join(words)}, content_type='application/json'
+        )
+        self._follow(response)
+        return response
+
+    def speak(self, audio):
+        response = self.client.post(
+            f'/room/{self.room.id}/send/', data={'audio': SimpleUploadedFile('answer.wav', audio, 'audio/wav')}
+        )
+        self._follow(response)
+        return response
+
+    def _follow(self, response):
+        """Track the next expected sentence; start a new conversation (untimed) when one completes."""
+        if response.status_code != 200:
+            return
+        data = response.json()
+        if data.get('conversation_completed'):
+            self.start_topic()
+        else:
+            self.expected = data.get('expected_response', self.expected)
+
+
+class Command(BaseCommand):
+    help = (
+        'Offline load test of the student flow (room page, topic, text and audio answers) on a '
+        'throwaway test database with a stubbed ConversationAI, plus microbenchmarks; saves JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='Requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=4, help='Simulated students sending requests at once')
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='Comma separated: ' + ', '.join(ENDPOINTS))
+        parser.add_argument('--audio-dir', help='Folder of recordings to use instead of the synthetic WAV fixtures')
+        parser.add_argument('--ai-latency-ms', type=float, default=0, help='Simulated ConversationAI delay')
+        parser.add_argument('--micro-iterations', type=int, default=500, help='Calls per microbenchmark (0 skips them)')
+        parser.add_argument('--transcription-cache', action='store_true', help='Keep the transcription cache enabled')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Earlier JSON results to compare median latency with')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        endpoints = [e.strip() for e in options['endpoints'].split(',') if e.strip()]
+        unknown = [e for e in endpoints if e not in ENDPOINTS]
+        if unknown:
+            raise CommandError(f"Unknown endpoints: {', '.join(unknown)}")
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be positive')
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        clips = self.load_clips(options['audio_dir'])
+        StubConversationAI.latency = options['ai_latency_ms'] / 1000.0
+        overrides = {
+            'TRANSCRIPTION_WORKERS': 0,  # transcribe in the request thread, no worker processes
+            'CONVERSATION_AI_BACKEND': 'core.utils.conversation_ai.StubConversationAI',
+        }
+        if not options['transcription_cache']:
+            overrides['CACHES'] = {**settings.CACHES, 'transcriptions': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+        results = {
+            'meta': {
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'whisper_model': getattr(settings, 'WHISPER_MODEL_NAME', None),
+                'whisper_backend': getattr(settings, 'WHISPER_BACKEND', None),
+                'requests': options['requests'],
+                'concurrency': options['concurrency'],
+                'clips': len(clips),
+            },
+            'endpoints': {},
+            'micro': {},
+        }
+
+        with tempfile.TemporaryDirectory() as tmp, override_settings(**overrides):
+            if connection.vendor == 'sqlite':
+                # A file, not shared-cache memory, so concurrent writers wait instead of failing
+                connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(tmp, 'benchmark.sqlite3')
+                connection.settings_dict.setdefault('OPTIONS', {}).setdefault('timeout', 30)
+            setup_test_environment()
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                if 'audio' in endpoints or options['micro_iterations']:
+                    get_model()  # keep the model load out of the timings
+                for endpoint in endpoints:
+                    results['endpoints'][endpoint] = self.run_endpoint(endpoint, clips, options)
+                    self.report(endpoint, results['endpoints'][endpoint], baseline, 'endpoints')
+                if options['micro_iterations']:
+                    results['micro'] = self.run_micro(clips, options)
+                    for name, summary in results['micro'].items():
+                        self.report(name, summary, baseline, 'micro')
+            finally:
+                connection.close()
+                teardown_databases(old_config, verbosity=0)
+                teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def load_clips(self, directory):
+        if not directory:
+            return [synthetic_wav(seconds, frequency, seed=i) for i, (seconds, frequency) in enumerate(FIXTURES)]
+        if not os.path.isdir(directory):
+            raise CommandError(f"{directory} is not a directory")
+        clips = []
+        for name in sorted(os.listdir(directory)):
+            if os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS:
+                with open(os.path.join(directory, name), 'rb') as f:
+                    clips.append(f.read())
+        if not clips:
+            raise CommandError('No audio clips found')
+        return clips
+
+    def run_endpoint(self, endpoint, clips, options):
+        concurrency = options['concurrency']
+        students = [Student(f'{endpoint}-{i}', random.Random(options['seed'] + i)) for i in range(concurrency)]
+        if endpoint in ('text', 'audio'):
+            for student in students:
+                student.start_topic()
+
+        latencies = []
+        queries = []
+        errors = []
+        results_lock = threading.Lock()
+        counter = iter(range(options['requests']))
+
+        def request(student, n):
+            if endpoint == 'room':
+                return student.client.get(f'/room/{student.room.id}/')
+            if endpoint == 'topic':
+                return student.start_topic()
+            if endpoint == 'text':
+                return student.answer()
+            return student.speak(clips[n % len(clips)])
+
+        def worker(student):
+            try:
+                while True:
+                    with results_lock:
+                        n = next(counter, None)
+                    if n is None:
+                        return
+                    with CaptureQueriesContext(connection) as captured:
+                        start = time.perf_counter()
+                        response = request(student, n)
+                        elapsed = time.perf_counter() - start
+                    with results_lock:
+                        latencies.append(elapsed)
+                        queries.append(len(captured))
+                        if response.status_code >= 400:
+                            errors.append(response.status_code)
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, students))
+        wall_time = time.perf_counter() - start
+        return summarize(latencies, wall_time, queries, len(errors))
+
+    def run_micro(self, clips, options):
+        iterations = options['micro_iterations']
+        rng = random.Random(options['seed'])
+        pairs = [_make_pair(rng, rng.randint(8, 25)) for _ in range(iterations)]
+        view = MessageView()
+        micro = {}
+
+        def timed(func, items):
+            latencies = []
+            for item in items:
+                start = time.perf_counter()
+                func(*item)
+                latencies.append(time.perf_counter() - start)
+            return summarize(latencies)
+
+        for backend in BACKENDS:
+            micro[f'levenshtein_distance[{backend}]'] = timed(
+                lambda a, b, backend=backend: levenshtein_distance(a.lower(), b.lower(), backend), pairs
+            )
+        micro['get_word_comparison'] = timed(view.get_word_comparison, pairs)
+        # Whisper dominates; a few passes over the clips are enough
+        runs = max(1, min(iterations // 50, 5))
+        micro['transcribe_audio'] = timed(transcribe_audio, [(clip,) for clip in clips] * runs)
+        return micro
+
+    def report(self, name, summary, baseline, section):
+        line = (
+            f"{name:32s} n={summary['count']:<5d} p50 {summary['p50_ms']:9.2f} ms  p95 {summary['p95_ms']:9.2f} ms"
+            f"  p99 {summary['p99_ms']:9.2f} ms"
+        )
+        if 'throughput_rps' in summary:
+            line += f"  {summary['throughput_rps']:7.1f} req/s  {summary['queries_mean']:5.1f} queries"
+        if summary['errors']:
+            line += f"  {summary['errors']} errors"
+        previous = (baseline or {}).get(section, {}).get(name)
+        if previous and previous.get('p50_ms'):
+            change = (summary['p50_ms'] - previous['p50_ms']) / previous['p50_ms'] * 100
+            line += f"  p50 {change:+.0f}% vs baseline"
+        self.stdout.write(self.style.ERROR(line) if summary['errors'] else line)
@@ -0,0 +1,81 @@
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from core.utils.levenshtein import BACKENDS
+from core.utils.scoring import spelling_score, spelling_scores
+
+# Expected-sentence lengths (in words) per dialogue difficulty, as asked of the model in ConversationAI
+DIFFICULTY_WORDS = {
+    'easy': (8, 12),
+    'medium': (12, 18),
+    'hard': (15, 25),
+}
+
+VOCABULARY = (
+    "i you we they the a to of and in is was it that for on with my your have do did go went "
+    "like would could really because about people time weekend family friend restaurant travel "
+    "favourite usually sometimes definitely interesting experience expected harder traditional "
+    "neighbourhood recommend delicious comfortable afternoon beautiful important"
+).split()
+
+
+def _make_pair(rng, n_words):
+    """An expected sentence and a plausible student attempt with dropped, swapped and misspelled words."""
+    expected = [rng.choice(VOCABULARY) for _ in range(n_words)]
+    attempt = []
+    for word in expected:
+        roll = rng.random()
+        if roll < 0.05:
+            continue
+        if roll < 0.10:
+            attempt.append(rng.choice(VOCABULARY))
+        elif roll < 0.20 and len(word) > 2:
+            i = rng.randrange(len(word))
+            attempt.append(word[:i] + rng.choice('aeiou') + word[i + 1:])
+        else:
+            attempt.append(word)
+    return " ".join(attempt).capitalize(), " ".join(expected).capitalize() + "."
+
+
+class Command(BaseCommand):
+    help = 'Microbenchmark the spelling-score distance backends on easy, medium and hard sentence lengths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pairs', type=int, default=2000, help='Sentence pairs per difficulty')
+        parser.add_argument('--backends', default=','.join(BACKENDS), help='Comma separated: ' + ', '.join(BACKENDS))
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        backends = [b.strip() for b in options['backends'].split(',') if b.strip()]
+        unknown = [b for b in backends if b not in BACKENDS]
+        if unknown:
+            raise CommandError(f"Unknown backends: {', '.join(unknown)}")
+
+        rng = random.Random(options['seed'])
+        for difficulty, (low, high) in DIFFICULTY_WORDS.items():
+            pairs = [_make_pair(rng, rng.randint(low, high)) for _ in range(options['pairs'])]
+            chars = sum(len(b) for _, b in pairs) / len(pairs)
+            self.stdout.write(f"{difficulty} ({low}-{high} words, {chars:.0f} chars on average)")
+
+            reference = None
+            reference_time = None
+            for backend in backends:
+                start = time.perf_counter()
+                single = [spelling_score(a, b, backend) for a, b in pairs]
+                single_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                bulk = spelling_scores(pairs, backend)
+                bulk_time = time.perf_counter() - start
+
+                if reference is None:
+                    reference, reference_time = single, single_time
+                line = (
+                    f"  {backend:10s} single {single_time / len(pairs) * 1e6:8.2f} us/pair"
+                    f"   bulk {bulk_time / len(pairs) * 1e6:8.2f} us/pair"
+                    f"   speedup {reference_time / min(single_time, bulk_time):7.1f}x"
+                )
+                if single != reference or bulk != reference:
+                    self.stdout.write(self.style.ERROR(line + f"   scores differ from {backends[0]}"))
+                else:
+                    self.stdout.write(self.style.SUCCESS(line))
@@ -0,0 +1,123 @@
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from core.utils.audio import SAMPLE_RATE, load_audio
+from core.utils.levenshtein import levenshtein_distance
+from core.utils.whisper import get_model, transcribe_audio
+from core.utils.whisper_backends import BACKENDS
+
+AUDIO_EXTENSIONS = ('.wav', '.webm', '.ogg', '.mp3', '.m4a', '.mp4', '.flac')
+
+MODES = {
+    'baseline': {'WHISPER_SHORT_UTTERANCE': False, 'WHISPER_SHORT_AUDIO_CTX': False},
+    'short': {'WHISPER_SHORT_UTTERANCE': True, 'WHISPER_SHORT_AUDIO_CTX': False},
+    'short-ctx': {'WHISPER_SHORT_UTTERANCE': True, 'WHISPER_SHORT_AUDIO_CTX': True},
+}
+
+
+def _words(text):
+    return "".join(c for c in text.lower() if c.isalnum() or c.isspace() or c == "'").split()
+
+
+def word_error_rate(hypothesis, reference):
+    reference_words = _words(reference)
+    if not reference_words:
+        return 0.0
+    return levenshtein_distance(_words(hypothesis), reference_words) / len(reference_words)
+
+
+class Command(BaseCommand):
+    help = 'Compare inference backends and transcription modes on a folder of clips: latency, RTF and WER'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Folder of audio clips; clip.txt next to clip.wav holds the expected sentence')
+        parser.add_argument('--modes', default='baseline,short,short-ctx', help='Comma separated: ' + ', '.join(MODES))
+        parser.add_argument('--backends', default='torch', help='Comma separated: ' + ', '.join(BACKENDS))
+        parser.add_argument('--repeat', type=int, default=1, help='Transcribe every clip this many times per run')
+        parser.add_argument('--transcription-cache', action='store_true',
+                            help='Keep the transcription cache enabled (repeats of a clip then hit it)')
+
+    def load_corpus(self, directory):
+        corpus = []
+        for name in sorted(os.listdir(directory)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in AUDIO_EXTENSIONS:
+                continue
+            expected = None
+            txt_path = os.path.join(directory, stem + '.txt')
+            if os.path.exists(txt_path):
+                with open(txt_path) as f:
+                    expected = f.read().strip()
+            corpus.append((name, load_audio(os.path.join(directory, name)), expected))
+        return corpus
+
+    def _parse_list(self, value, allowed, label):
+        items = [item.strip() for item in value.split(',') if item.strip()]
+        unknown = [item for item in items if item not in allowed]
+        if unknown:
+            raise CommandError(f"Unknown {label}: {', '.join(unknown)}")
+        return items
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['directory']):
+            raise CommandError(f"{options['directory']} is not a directory")
+
+        modes = self._parse_list(options['modes'], MODES, 'modes')
+        backends = self._parse_list(options['backends'], BACKENDS, 'backends')
+        # The PyTorch baseline is the reference every other run is compared with
+        runs = [('torch', 'baseline')] + [
+            (backend, mode) for backend in backends for mode in modes if (backend, mode) != ('torch', 'baseline')
+        ]
+
+        corpus = self.load_corpus(options['directory'])
+        if not corpus:
+            raise CommandError('No audio clips found')
+        audio_seconds = sum(len(samples) for _, samples, _ in corpus) / SAMPLE_RATE
+
+        overrides = {}
+        if not options['transcription_cache']:
+            overrides['CACHES'] = {**settings.CACHES, 'transcriptions': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+        baseline = {}
+        baseline_mean = None
+        for backend, mode in runs:
+            get_model(backend)  # keep the model load out of the timings
+            timings = []
+            matches = 0
+            wers = []
+            baseline_wers = []
+            with override_settings(WHISPER_BACKEND=backend, **MODES[mode], **overrides):
+                for name, samples, expected in corpus:
+                    for _ in range(options['repeat']):
+                        start = time.perf_counter()
+                        text = transcribe_audio(samples, expected)
+                        timings.append(time.perf_counter() - start)
+                    if expected:
+                        wers.append(word_error_rate(text, expected))
+                    if baseline_mean is None:
+                        baseline[name] = text
+                        continue
+                    baseline_wers.append(word_error_rate(text, baseline[name]))
+                    if text == baseline[name]:
+                        matches += 1
+                    else:
+                        self.stdout.write(self.style.WARNING(f"  [{backend}/{mode}] {name}: '{text}' != '{baseline[name]}'"))
+
+            timings.sort()
+            mean = sum(timings) / len(timings)
+            p95 = timings[min(int(len(timings) * 0.95), len(timings) - 1)]
+            rtf = sum(timings) / (audio_seconds * options['repeat'])
+            line = f"{backend:10s} {mode:10s} mean {mean * 1000:8.1f} ms   p95 {p95 * 1000:8.1f} ms   RTF {rtf:.3f}"
+            if wers:
+                line += f"   WER {100 * sum(wers) / len(wers):5.1f}%"
+            if baseline_mean is None:
+                baseline_mean = mean
+            else:
+                line += (
+                    f"   speedup {baseline_mean / mean:5.2f}x"
+                    f"   WER vs baseline {100 * sum(baseline_wers) / len(baseline_wers):5.1f}%"
+                    f"   matches baseline {matches}/{len(corpus)}"
+                )
+            self.stdout.write(self.style.SUCCESS(line))
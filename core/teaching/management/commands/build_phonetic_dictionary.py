@@ -0,0 +1,62 @@
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.utils.phonetics import PhoneticDictionary, encode_phonemes, reset, write_dictionary
+
+
+def _parse_cmudict(path):
+    """{word: key} from a CMUdict-format file (first pronunciation of each word); also returns skipped lines."""
+    entries = {}
+    skipped = 0
+    with open(path, encoding='latin-1') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line or line.startswith(';;;'):
+                continue
+            word, *phonemes = line.split()
+            word = word.lower()
+            if word.endswith(')') and '(' in word:
+                continue  # alternate pronunciation, e.g. "their(1)"
+            try:
+                entries.setdefault(word, encode_phonemes(phonemes))
+            except KeyError:
+                skipped += 1
+    return entries, skipped
+
+
+class Command(BaseCommand):
+    help = 'Build the memory-mapped pronouncing dictionary used by phonetic scoring from a CMUdict file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='CMUdict-format file, e.g. cmudict.dict or cmudict-0.7b')
+        parser.add_argument('--output', help='Where to write the dictionary (default: PHONETIC_DICTIONARY_PATH)')
+
+    def handle(self, *args, **options):
+        path = options['output'] or settings.PHONETIC_DICTIONARY_PATH
+        if not os.path.exists(options['source']):
+            raise CommandError(f"{options['source']} does not exist")
+
+        start = time.perf_counter()
+        entries, skipped = _parse_cmudict(options['source'])
+        if not entries:
+            raise CommandError(f"No pronunciations found in {options['source']}")
+        count = write_dictionary(entries, path)
+        self.stdout.write(
+            f"Wrote {count} words to {path} ({os.path.getsize(path) / 1e6:.1f} MB) in {time.perf_counter() - start:.1f}s"
+            + (f", skipped {skipped} lines with unknown phonemes" if skipped else "")
+        )
+
+        # Check the file reads back
+        dictionary = PhoneticDictionary(path)
+        words = sorted(entries)[::max(1, count // 1000)]
+        start = time.perf_counter()
+        for word in words:
+            if dictionary.lookup(word) != entries[word]:
+                raise CommandError(f"Lookup of '{word}' does not match the source")
+        elapsed = time.perf_counter() - start
+        reset()
+        self.stdout.write(self.style.SUCCESS(
+            f"Lookups match the source ({elapsed / len(words) * 1e6:.1f} us each). "
+            "Set PHONETIC_SCORING_DIFFICULTIES to use it; running workers pick it up on restart."
+        ))
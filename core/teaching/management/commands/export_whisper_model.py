@@ -0,0 +1,53 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from core.utils.audio import load_audio
+from core.utils.whisper import get_model, _encode
+from core.utils.whisper_backends import export_onnx_encoder, onnx_encoder_path
+
+
+class Command(BaseCommand):
+    help = 'Export the Whisper encoder to ONNX and check it against the PyTorch model'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='Where to write the .onnx file (default: WHISPER_ONNX_DIR)')
+        parser.add_argument('--clip', help='Optional audio clip to validate with instead of synthetic input')
+        parser.add_argument('--tolerance', type=float, default=1e-3, help='Maximum allowed absolute difference')
+
+    def handle(self, *args, **options):
+        import numpy as np
+        import onnxruntime
+        import torch
+        import whisper
+
+        path = options['output'] or onnx_encoder_path()
+        model = get_model('torch')
+
+        start = time.perf_counter()
+        export_onnx_encoder(model, path)
+        self.stdout.write(f"Exported {path} ({os.path.getsize(path) / 1e6:.1f} MB) in {time.perf_counter() - start:.1f}s")
+
+        # Validate on a full 30s window and on a short one (the reduced-context path)
+        if options['clip']:
+            samples = load_audio(options['clip'])
+        else:
+            rng = np.random.default_rng(0)
+            samples = (rng.standard_normal(whisper.audio.SAMPLE_RATE * 3) * 0.1).astype(np.float32)
+        full = whisper.log_mel_spectrogram(whisper.pad_or_trim(samples), model.dims.n_mels)[None]
+        short = full[:, :, :640]
+
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        worst = 0.0
+        for name, mel in (('30s window', full), ('short window', short)):
+            with torch.no_grad():
+                expected = _encode(model, mel).numpy()
+            start = time.perf_counter()
+            actual = session.run(None, {'mel': mel.numpy()})[0]
+            elapsed = time.perf_counter() - start
+            diff = float(np.abs(expected - actual).max())
+            worst = max(worst, diff)
+            self.stdout.write(f"  {name}: shape {actual.shape}, max abs diff {diff:.2e}, {elapsed * 1000:.0f} ms")
+
+        if worst > options['tolerance']:
+            raise CommandError(f"ONNX encoder differs from PyTorch by {worst:.2e} (> {options['tolerance']:.0e})")
+        self.stdout.write(self.style.SUCCESS('ONNX encoder matches the PyTorch model. Set WHISPER_BACKEND=onnx to use it.'))
@@ -0,0 +1,66 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Exists, OuterRef, Q
+from django.utils import timezone
+from teaching.models import ConversationSession, ConversationTopic, Dialogue
+from core.utils.conversation_ai import get_conversation_ai
+
+
+class Command(BaseCommand):
+    help = (
+        'Keep a pool of ready dialogues for every active topic, so starting a conversation '
+        'does not wait on the conversation AI. Topics typed by students get a smaller pool, and only '
+        'while they are in use. Run once, or with --interval as a background job.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=settings.DIALOGUE_POOL_SIZE, help='Dialogues to top a topic up to')
+        parser.add_argument('--low-water', type=int, default=settings.DIALOGUE_POOL_LOW_WATER,
+                            help='Only refill topics with fewer dialogues than this')
+        parser.add_argument('--custom-size', type=int, default=settings.DIALOGUE_POOL_CUSTOM_SIZE,
+                            help='Dialogues to top a student-typed topic up to (0 skips them)')
+        parser.add_argument('--recent-days', type=int, default=settings.DIALOGUE_POOL_CUSTOM_RECENT_DAYS,
+                            help='Only refill student-typed topics practised within this many days')
+        parser.add_argument('--topic', action='append', help='Only this topic (by name; repeatable)')
+        parser.add_argument('--interval', type=float, default=0, help='Keep running, refilling every this many seconds')
+
+    def handle(self, *args, **options):
+        if options['size'] < 1 or not 0 < options['low_water'] <= options['size']:
+            raise CommandError('--size must be positive and --low-water between 1 and --size')
+        if options['custom_size'] < 0:
+            raise CommandError('--custom-size must not be negative')
+
+        ai = get_conversation_ai()
+        while True:
+            self.refill(ai, options)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def refill(self, ai, options):
+        recently_used = ConversationSession.objects.filter(
+            dialogue__topic=OuterRef('pk'),
+            created_at__gte=timezone.now() - timedelta(days=options['recent_days']),
+        )
+        topics = ConversationTopic.objects.filter(is_active=True).filter(
+            Q(is_custom=False) | Q(Exists(recently_used))
+        ).annotate(pooled=Count('dialogues', filter=Q(dialogues__is_fallback=False)))
+        if options['topic']:
+            topics = topics.filter(name__in=options['topic'])
+
+        created = 0
+        for topic in topics.order_by('pooled', 'id'):
+            size = options['custom_size'] if topic.is_custom else options['size']
+            if topic.pooled >= min(options['low_water'], size):
+                continue
+            for _ in range(size - topic.pooled):
+                try:
+                    # No built-in fallback: a failed generation is retried on the next run instead of pooled
+                    Dialogue.generate(topic, ai, fallback=False)
+                except Exception as e:
+                    self.stderr.write(self.style.ERROR(f"Could not generate a dialogue for '{topic.name}': {e}"))
+                    break
+                created += 1
+        self.stdout.write(self.style.SUCCESS(f"Added {created} dialogues to the pool"))
@@ -0,0 +1,166 @@
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import OuterRef, Subquery
+from teaching.models import Message
+from core.utils.expected_index import ExpectedSentence
+from core.utils.scoring import SCORING_MODES, phonetic_score, scoring_mode, spelling_scores
+
+
+def _init_worker():
+    import django
+
+    django.setup()
+
+
+def score_rows(rows, mode=None):
+    """
+    New scores for (id, user_text, expected_text, difficulty, old_score) rows, in
+    order. Runs in the worker processes; each distinct expected sentence is
+    compiled once.
+    """
+    modes = [mode or scoring_mode(row[3]) for row in rows]
+    scores = [None] * len(rows)
+
+    spelling = [i for i, m in enumerate(modes) if m == 'spelling']
+    for i, score in zip(spelling, spelling_scores([(rows[i][1], rows[i][2]) for i in spelling])):
+        scores[i] = score
+
+    compiled = {}
+    for i, m in enumerate(modes):
+        if m == 'phonetic':
+            expected = rows[i][2]
+            if expected not in compiled:
+                compiled[expected] = ExpectedSentence(expected)
+            scores[i] = phonetic_score(rows[i][1], compiled[expected])
+    return scores
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-score stored user messages against the expected text they answered '
+        '(the preceding assistant message\'s original_text) with the current scoring code. '
+        'Answers scored by the forced-alignment engine are left alone'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--after-id', type=int, default=0, help='Resume after this message id')
+        parser.add_argument('--checkpoint', help='File to keep the id watermark in; resumes from it when present')
+        parser.add_argument('--mode', choices=SCORING_MODES, help='Force a scoring mode (default: per topic difficulty)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Scoring processes (0 scores inline)')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows per database fetch and per scoring task')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per UPDATE statement')
+        parser.add_argument('--limit', type=int, help='Stop after this many messages')
+        parser.add_argument('--dry-run', action='store_true', help='Score and report, but write nothing')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        if chunk_size < 1 or options['batch_size'] < 1:
+            raise CommandError('--chunk-size and --batch-size must be positive')
+
+        watermark = options['after_id']
+        checkpoint = options['checkpoint']
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                watermark = max(watermark, json.load(f)['last_id'])
+            self.stdout.write(f"Resuming after message {watermark} (from {checkpoint})")
+
+        pool = None
+        if options['workers'] > 0:
+            # Fork the workers before any query, so no child inherits an open database connection
+            connections.close_all()
+            pool = multiprocessing.get_context().Pool(options['workers'], initializer=_init_worker)
+
+        expected_text = Message.objects.filter(
+            conversation_session=OuterRef('conversation_session'),
+            role='assistant',
+            id__lt=OuterRef('id'),
+        ).order_by('-id').values('original_text')[:1]
+        rows = (
+            Message.objects.filter(role='user', id__gt=watermark, conversation_session__isnull=False)
+            # Forced-alignment scores are confidences over a blanked transcript, not string similarities
+            .exclude(scoring_engine='forced')
+            .annotate(expected_text=Subquery(expected_text))
+            .filter(expected_text__isnull=False)
+            .exclude(expected_text='')
+            .order_by('id')
+            .values_list(
+                'id', 'content', 'expected_text',
+                'conversation_session__dialogue__topic__difficulty_level', 'spelling_score',
+            )
+        )
+        if options['limit']:
+            rows = rows[:options['limit']]
+
+        self.processed = self.changed = 0
+        self.last_id = watermark
+        self.start = time.perf_counter()
+        pending = deque()
+        try:
+            chunk = []
+            # Server-side cursor on PostgreSQL: only chunk_size rows are held at a time
+            for row in rows.iterator(chunk_size=chunk_size):
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    pending.append(self._submit(pool, chunk, options['mode']))
+                    chunk = []
+                    # Keep a bounded number of chunks in flight
+                    while len(pending) > max(options['workers'], 1) * 2:
+                        self._write(*pending.popleft(), options, checkpoint)
+            if chunk:
+                pending.append(self._submit(pool, chunk, options['mode']))
+            while pending:
+                self._write(*pending.popleft(), options, checkpoint)
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING(f"Interrupted; resume with --after-id {self.last_id}"))
+            raise
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        if checkpoint and os.path.exists(checkpoint):
+            # Finished: the next run (e.g. after another scoring change) starts from the beginning
+            os.remove(checkpoint)
+
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Scored' if options['dry_run'] else 'Re-scored'} {self.processed} messages in {elapsed:.1f}s "
+            f"({self.processed / elapsed if elapsed else 0:.0f}/s), {self.changed} changed"
+            + (" (dry run, nothing written)" if options['dry_run'] else "")
+        ))
+
+    def _submit(self, pool, chunk, mode):
+        if pool is None:
+            return chunk, score_rows(chunk, mode)
+        return chunk, pool.apply_async(score_rows, (chunk, mode))
+
+    def _write(self, chunk, result, options, checkpoint):
+        scores = result if isinstance(result, list) else result.get()
+        # Only rows whose score actually moves need an UPDATE
+        updates = [
+            Message(id=row[0], spelling_score=score)
+            for row, score in zip(chunk, scores)
+            if row[4] != score
+        ]
+        if updates and not options['dry_run']:
+            Message.objects.bulk_update(updates, ['spelling_score'], batch_size=options['batch_size'])
+
+        self.processed += len(chunk)
+        self.changed += len(updates)
+        self.last_id = chunk[-1][0]
+        if checkpoint and not options['dry_run']:
+            tmp = f"{checkpoint}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump({'last_id': self.last_id}, f)
+            os.replace(tmp, checkpoint)
+
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write(
+            f"  up to message {self.last_id}: {self.processed} scored, {self.changed} changed, "
+            f"{self.processed / elapsed if elapsed else 0:.0f} messages/s"
+        )
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teaching', '0002_conversation_and_progress_models'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversationsession',
+            index=models.Index(fields=['dialogue', 'room', 'created_at'], name='teaching_co_dialogu_49a676_idx'),
+        ),
+    ]
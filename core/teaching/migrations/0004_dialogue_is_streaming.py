@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teaching', '0003_conversationsession_dialogue_room_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dialogue',
+            name='is_streaming',
+            field=models.BooleanField(default=False),
+        ),
+    ]
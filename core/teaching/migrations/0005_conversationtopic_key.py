@@ -0,0 +1,29 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:05
+
+from django.db import migrations, models
+
+from core.utils.topic_cache import normalize_topic
+
+
+def fill_keys(apps, schema_editor):
+    ConversationTopic = apps.get_model('teaching', 'ConversationTopic')
+    topics = list(ConversationTopic.objects.only('id', 'name'))
+    for topic in topics:
+        topic.key = normalize_topic(topic.name)
+    ConversationTopic.objects.bulk_update(topics, ['key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teaching', '0004_dialogue_is_streaming'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationtopic',
+            name='key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=200),
+        ),
+        migrations.RunPython(fill_keys, migrations.RunPython.noop),
+    ]
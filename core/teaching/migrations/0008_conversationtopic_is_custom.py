@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:16
+
+from django.db import migrations, models
+from django.db.models import F, Value
+from django.db.models.functions import Concat
+
+
+def mark_custom(apps, schema_editor):
+    # TopicView has always described the topics students type this way
+    ConversationTopic = apps.get_model('teaching', 'ConversationTopic')
+    ConversationTopic.objects.filter(description=Concat(Value('Conversation about '), F('name'))).update(is_custom=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teaching', '0007_dialogue_is_fallback'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationtopic',
+            name='is_custom',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_custom, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+from core.utils.topic_cache import normalize_topic
+
+
+def refresh_keys(apps, schema_editor):
+    # Topic keys became sorted word sets without filler words or British spellings
+    ConversationTopic = apps.get_model('teaching', 'ConversationTopic')
+    topics = list(ConversationTopic.objects.only('id', 'name'))
+    for topic in topics:
+        topic.key = normalize_topic(topic.name)
+    ConversationTopic.objects.bulk_update(topics, ['key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teaching', '0008_conversationtopic_is_custom'),
+    ]
+
+    operations = [
+        migrations.RunPython(refresh_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teaching', '0009_refresh_conversationtopic_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='scoring_engine',
+            field=models.CharField(default='transcribe', max_length=16),
+        ),
+    ]
@@ -1,7 +1,10 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from core.utils.base_model import BaseModel
-from django.db.models import Avg, Count, Q
+from core.utils.conversation_ai import EXCHANGES_PER_DIFFICULTY
+from core.utils.topic_cache import normalize_topic
+from django.db.models import Avg, Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.utils import timezone
 import json
 import uuid
 
@@ -101,6 +104,12 @@ class ConversationTopic(BaseModel):
     description = models.TextField(blank=True)
     difficulty_level = models.CharField(max_length=10, choices=DIFFICULTY_CHOICES, default='easy')
     is_active = models.BooleanField(default=True)
+    key = models.CharField(max_length=200, blank=True, editable=False, db_index=True)  # normalized name, see core.utils.topic_cache
+    is_custom = models.BooleanField(default=False)  # typed by a student rather than seeded by populate_topics
+    
+    def save(self, *args, **kwargs):
+        self.key = normalize_topic(self.name)
+        super().save(*args, **kwargs)
     
     def __str__(self):
         return f"{self.name} ({self.get_difficulty_level_display()})"
@@ -124,12 +133,14 @@ class UserProgress(BaseModel):
         else:
             return ['easy', 'medium', 'hard']
     
+    # (from level, to level, completed conversations needed)
+    LEVEL_ADVANCES = (('easy', 'medium', 2), ('medium', 'hard', 5))
+    
     def should_advance_level(self):
         """Check if user should advance to next level"""
-        if self.completed_conversations >= 2 and self.current_level == 'easy':  # Changed from 5 to 2
-            return 'medium'
-        elif self.completed_conversations >= 5 and self.current_level == 'medium':  # Changed from 10 to 5
-            return 'hard'
+        for from_level, to_level, needed in self.LEVEL_ADVANCES:
+            if self.current_level == from_level and self.completed_conversations >= needed:
+                return to_level
         return None
     
     def advance_level_if_needed(self):
@@ -141,11 +152,39 @@ class UserProgress(BaseModel):
             return True
         return False
     
+    @classmethod
+    def complete_conversation(cls, user_id):
+        """
+        Count a completed conversation for the user and advance their level if it
+        is due (should_advance_level's thresholds), in one conditional UPDATE, so
+        concurrent sessions of the same user can't lose an increment. The row is
+        created if the user has none. Returns (completed_conversations,
+        current_level, level_advanced), read back after the update.
+        """
+        progress = cls.objects.filter(user_id=user_id)
+        with transaction.atomic():
+            # Only to tell whether this update moved the level; the update itself doesn't use it
+            previous_level = progress.values_list('current_level', flat=True).first()
+            if previous_level is None:
+                previous_level = cls.objects.get_or_create(user_id=user_id)[0].current_level
+            progress.update(
+                completed_conversations=F('completed_conversations') + 1,
+                # The right-hand side sees the old row, hence needed - 1
+                current_level=Case(
+                    *[
+                        When(current_level=from_level, completed_conversations__gte=needed - 1, then=Value(to_level))
+                        for from_level, to_level, needed in cls.LEVEL_ADVANCES
+                    ],
+                    default=F('current_level'),
+                ),
+                updated_at=timezone.now(),
+            )
+            completed, level = progress.values_list('completed_conversations', 'current_level').get()
+        return completed, level, level != previous_level
+    
     def increment_completed_conversations(self):
         """Increment completed conversations count and check for level advance"""
-        self.completed_conversations += 1
-        level_advanced = self.advance_level_if_needed()
-        self.save()
+        self.completed_conversations, self.current_level, level_advanced = self.complete_conversation(self.user_id)
         return level_advanced
     
     def get_average_score(self):
@@ -213,6 +252,8 @@ class Dialogue(BaseModel):
     topic = models.ForeignKey(ConversationTopic, on_delete=models.CASCADE, related_name='dialogues')
     exchanges = models.JSONField()  # Store the dialogue exchanges as JSON
     total_exchanges = models.IntegerField(default=7)
+    is_streaming = models.BooleanField(default=False)  # exchanges are still being appended
+    is_fallback = models.BooleanField(default=False)  # built-in conversation served while the AI failed; never pooled
     
     def get_exchanges(self):
         """Get the dialogue exchanges as a Python list"""
@@ -222,6 +263,91 @@ class Dialogue(BaseModel):
         """Set the dialogue exchanges from a Python list"""
         self.exchanges = exchanges_list
     
+    @classmethod
+    def pooled(cls, topic=None):
+        """Dialogues that can be served again: everything but fallback conversations"""
+        dialogues = cls.objects.filter(is_fallback=False)
+        return dialogues.filter(topic=topic) if topic is not None else dialogues
+    
+    @classmethod
+    def generate(cls, topic, ai, fallback=True):
+        """
+        Have the conversation AI write a new dialogue for the topic at its
+        difficulty and store it. With `fallback`, a failure stores the built-in
+        conversation instead, marked so it is not served from the pool.
+        """
+        num_exchanges = EXCHANGES_PER_DIFFICULTY.get(topic.difficulty_level, EXCHANGES_PER_DIFFICULTY['hard'])
+        try:
+            exchanges = ai.generate_conversation(
+                topic.name, num_exchanges=num_exchanges, difficulty=topic.difficulty_level, fallback=False,
+            )
+        except Exception:
+            if not fallback:
+                raise
+            return cls.create_fallback(topic, ai)
+        return cls.objects.create(topic=topic, exchanges=exchanges, total_exchanges=len(exchanges))
+    
+    @classmethod
+    def create_fallback(cls, topic, ai):
+        """Store the built-in conversation for the topic, for one session only"""
+        num_exchanges = EXCHANGES_PER_DIFFICULTY.get(topic.difficulty_level, EXCHANGES_PER_DIFFICULTY['hard'])
+        exchanges = ai.get_fallback_conversation(topic.name, num_exchanges, topic.difficulty_level)
+        return cls.objects.create(topic=topic, exchanges=exchanges, total_exchanges=len(exchanges), is_fallback=True)
+    
+    @classmethod
+    def generate_streaming(cls, topic, ai, on_first_exchange):
+        """
+        Like generate(), but stores the dialogue as soon as the AI has written its
+        first exchange and calls on_first_exchange(dialogue), then appends the
+        other exchanges as they arrive. If the AI fails part way the dialogue
+        keeps the exchanges written so far; if it fails before the first one,
+        the built-in conversation is served as in generate().
+        """
+        num_exchanges = EXCHANGES_PER_DIFFICULTY.get(topic.difficulty_level, EXCHANGES_PER_DIFFICULTY['hard'])
+        exchanges = ai.stream_conversation(
+            topic.name, num_exchanges=num_exchanges, difficulty=topic.difficulty_level, fallback=False
+        )
+        try:
+            first = next(exchanges)
+        except Exception:
+            dialogue = cls.create_fallback(topic, ai)
+            on_first_exchange(dialogue)
+            return dialogue
+        dialogue = cls.objects.create(
+            topic=topic, exchanges=[first], total_exchanges=num_exchanges, is_streaming=True
+        )
+        try:
+            on_first_exchange(dialogue)
+            try:
+                for exchange in exchanges:
+                    dialogue.exchanges.append(exchange)
+                    cls.objects.filter(pk=dialogue.pk).update(exchanges=dialogue.exchanges)
+            except Exception as e:
+                print(f"Dialogue {dialogue.pk} stopped after {len(dialogue.exchanges)} exchanges: {str(e)}")
+        finally:
+            dialogue.is_streaming = False
+            dialogue.total_exchanges = len(dialogue.exchanges)
+            cls.objects.filter(pk=dialogue.pk).update(
+                is_streaming=False, total_exchanges=dialogue.total_exchanges, updated_at=timezone.now()
+            )
+        return dialogue
+    
+    @classmethod
+    def least_recently_used(cls, topic, user):
+        """
+        The topic's dialogue that the user practised longest ago, preferring ones
+        they have never had, in one query; None if the topic has no dialogues yet.
+        """
+        last_used = ConversationSession.objects.filter(
+            dialogue=OuterRef('pk'), room__user=user
+        ).order_by('-created_at').values('created_at')[:1]
+        return (
+            cls.pooled(topic)
+            .annotate(last_used=Subquery(last_used))
+            .order_by(F('last_used').asc(nulls_first=True), 'id')
+            .first()
+        )
+    
     def __str__(self):
         return f"Dialogue for {self.topic.name}"
 
@@ -232,6 +358,12 @@ class ConversationSession(BaseModel):
     current_exchange_index = models.IntegerField(default=0)
     is_completed = models.BooleanField(default=False)
     
+    class Meta:
+        indexes = [
+            # Dialogue.least_recently_used
+            models.Index(fields=['dialogue', 'room', 'created_at']),
+        ]
+    
     def get_current_exchange(self):
         """Get the current exchange the user should respond to"""
         exchanges = self.dialogue.get_exchanges()
@@ -239,13 +371,28 @@ class ConversationSession(BaseModel):
             return exchanges[self.current_exchange_index]
         return None
     
+    def advance_from(self, index):
+        """
+        Move past exchange `index` with a single conditional UPDATE. Returns False,
+        changing nothing, if the session is no longer at that exchange (e.g. a
+        double-submitted answer already advanced it).
+        """
+        completed = index + 1 >= len(self.dialogue.get_exchanges())
+        updated = ConversationSession.objects.filter(
+            pk=self.pk, current_exchange_index=index, is_completed=False
+        ).update(
+            current_exchange_index=F('current_exchange_index') + 1,
+            is_completed=completed,
+            updated_at=timezone.now(),
+        )
+        if updated:
+            self.current_exchange_index = index + 1
+            self.is_completed = completed
+        return bool(updated)
+
     def advance_to_next_exchange(self):
         """Move to the next exchange in the dialogue"""
-        exchanges = self.dialogue.get_exchanges()
-        self.current_exchange_index += 1
-        if self.current_exchange_index >= len(exchanges):
-            self.is_completed = True
-            self.save()
+        self.advance_from(self.current_exchange_index)
         return self.current_exchange_index
     
     def __str__(self):
@@ -263,6 +410,9 @@ class Message(BaseModel):
     spelling_score = models.FloatField(null=True, blank=True)
     original_text = models.TextField(null=True, blank=True)
     conversation_session = models.ForeignKey(ConversationSession, on_delete=models.CASCADE, null=True, blank=True, related_name='messages')
+    # settings.SCORING_ENGINE that produced spelling_score: 'forced' scores are
+    # confidences and content is a blanked transcript, not something to re-score
+    scoring_engine = models.CharField(max_length=16, default='transcribe')
 
     class Meta:
         indexes = [
@@ -273,3 +423,23 @@ class Message(BaseModel):
 
     def __str__(self):
         return f"{self.role}: {self.content[:50]}..."
+
+class BackgroundJob(BaseModel):
+    """
+    Status of a core.utils.jobs background job. Kept in the database so a poll
+    answered by any web process finds a job started by another.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    ]
+
+    id = models.CharField(primary_key=True, max_length=32)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    extra = models.JSONField(default=dict, blank=True)  # e.g. the room that may read it
+
+    def __str__(self):
+        return f"Job {self.id} ({self.status})"
@@ -3,15 +3,17 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.views import View
 from django.http import JsonResponse
 from django.contrib import messages
-from django.db.models import Avg, Count
+from django.db.models import Avg, Count, OuterRef, Q, Subquery
 from django.contrib.auth import login
 from django.views.decorators.http import require_http_methods
 from .models import Teacher, TeacherReferral, StudentEnrollment, Message, UserProgress
 from django.contrib.auth.models import User
+from core.utils.query_budget import query_budget
 
 class TeacherDashboardView(LoginRequiredMixin, View):
     template_name = 'teacher/dashboard.html'
     
+    @query_budget(4)
     def get(self, request):
         # Check if user is a teacher
         try:
@@ -20,12 +22,24 @@ class TeacherDashboardView(LoginRequiredMixin, View):
             messages.error(request, "You need teacher access to view this page.")
             return redirect('room_list')
         
-        # Get teacher's referrals
-        referrals = TeacherReferral.objects.filter(teacher=teacher).order_by('-created_at')
+        # Get teacher's referrals with their student count and average score in one query
+        referral_scores = Message.objects.filter(
+            room__user__student_enrollments__referral=OuterRef('pk'),
+            role='user',
+            spelling_score__isnull=False
+        ).order_by().values('room__user__student_enrollments__referral').annotate(
+            avg=Avg('spelling_score')
+        ).values('avg')
+        referrals = list(TeacherReferral.objects.filter(teacher=teacher).annotate(
+            students_count=Count('student_enrollments', distinct=True),
+            average_score=Subquery(referral_scores),
+        ).order_by('-created_at'))
+        for referral in referrals:
+            referral.average_score = round(referral.average_score, 2) if referral.average_score else 0
         
         # Calculate statistics
-        total_referrals = referrals.count()
-        active_referrals = referrals.filter(is_active=True).count()
+        total_referrals = len(referrals)
+        active_referrals = sum(1 for referral in referrals if referral.is_active)
         total_students = StudentEnrollment.objects.filter(referral__teacher=teacher).count()
         
         # Get recent activity
@@ -45,6 +59,7 @@ class TeacherDashboardView(LoginRequiredMixin, View):
         return render(request, self.template_name, context)
 
 class CreateReferralView(LoginRequiredMixin, View):
+    @query_budget(3)
     def post(self, request):
         try:
             teacher = request.user.teacher_profile
@@ -71,6 +86,7 @@ class CreateReferralView(LoginRequiredMixin, View):
 class ReferralDetailView(LoginRequiredMixin, View):
     template_name = 'teacher/referral_detail.html'
     
+    @query_budget(5)
     def get(self, request, referral_id):
         try:
             teacher = request.user.teacher_profile
@@ -80,49 +96,32 @@ class ReferralDetailView(LoginRequiredMixin, View):
         
         referral = get_object_or_404(TeacherReferral, id=referral_id, teacher=teacher)
         
-        # Get students using this referral
+        # Get students using this referral, with their progress and scores in one query
+        from django.utils import timezone
+        from datetime import timedelta
+        recent_date = timezone.now() - timedelta(days=7)
+        scored = Q(user__room__messages__role='user', user__room__messages__spelling_score__isnull=False)
+        recent = scored & Q(user__room__messages__created_at__gte=recent_date)
         enrollments = StudentEnrollment.objects.filter(
             referral=referral
-        ).select_related('user').order_by('-enrolled_at')
+        ).select_related('user', 'user__progress').annotate(
+            total_attempts=Count('user__room__messages', filter=scored),
+            avg_score=Avg('user__room__messages__spelling_score', filter=scored),
+            recent_attempts=Count('user__room__messages', filter=recent),
+            recent_avg=Avg('user__room__messages__spelling_score', filter=recent),
+        ).order_by('-enrolled_at')
         
         # Get student performance data
         student_stats = []
         for enrollment in enrollments:
-            user = enrollment.user
-            
-            # Get user progress
-            try:
-                progress = UserProgress.objects.get(user=user)
-            except UserProgress.DoesNotExist:
-                progress = None
-            
-            # Calculate student's scores
-            messages_with_scores = Message.objects.filter(
-                room__user=user,
-                role='user',
-                spelling_score__isnull=False
-            )
-            
-            total_attempts = messages_with_scores.count()
-            avg_score = messages_with_scores.aggregate(avg=Avg('spelling_score'))['avg']
-            avg_score = round(avg_score, 2) if avg_score else 0
-            
-            # Recent performance (last 7 days)
-            from django.utils import timezone
-            from datetime import timedelta
-            recent_date = timezone.now() - timedelta(days=7)
-            recent_attempts = messages_with_scores.filter(created_at__gte=recent_date)
-            recent_avg = recent_attempts.aggregate(avg=Avg('spelling_score'))['avg']
-            recent_avg = round(recent_avg, 2) if recent_avg else 0
-            
             student_stats.append({
                 'enrollment': enrollment,
-                'user': user,
-                'progress': progress,
-                'total_attempts': total_attempts,
-                'avg_score': avg_score,
-                'recent_avg': recent_avg,
-                'recent_attempts': recent_attempts.count()
+                'user': enrollment.user,
+                'progress': getattr(enrollment.user, 'progress', None),
+                'total_attempts': enrollment.total_attempts,
+                'avg_score': round(enrollment.avg_score, 2) if enrollment.avg_score else 0,
+                'recent_avg': round(enrollment.recent_avg, 2) if enrollment.recent_avg else 0,
+                'recent_attempts': enrollment.recent_attempts
             })
         
         context = {
@@ -134,6 +133,7 @@ class ReferralDetailView(LoginRequiredMixin, View):
         return render(request, self.template_name, context)
 
 class ToggleReferralView(LoginRequiredMixin, View):
+    @query_budget(3)
     def post(self, request, referral_id):
         try:
             teacher = request.user.teacher_profile
@@ -149,6 +149,7 @@ class ToggleReferralView(LoginRequiredMixin, View):
         
         return redirect('teacher_dashboard')
 
+@query_budget(9)
 @require_http_methods(["GET", "POST"])
 def teacher_signup_view(request):
     if request.method == 'POST':
@@ -1,3 +1,1705 @@
-from django.test import TestCase
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+import numpy as np
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from .models import Room, Message, ConversationTopic, Dialogue, ConversationSession, UserProgress, Teacher, TeacherReferral, StudentEnrollment, BackgroundJob
+from .routing import websocket_urlpatterns
+from .urls import urlpatterns
+from .views import AnswerConflict, ExchangePending, MessageView, generate_conversation_job
+from core.utils.alignment import compare_words, compare_words_batch
+from core.utils.audio import probe_audio, trim_silence
+from core.utils.audio_guard import AudioRejected, check_upload, decode_checked
+from core.utils import transcription_cache, transcription_pool
+from core.utils import conversation_ai
+from core.utils.circuit_breaker import CircuitOpen
+from core.utils.conversation_ai import ConversationAI, StubConversationAI, iter_array_items
+from core.utils import expected_index, jobs, topic_cache, tracing
+from core.utils.expected_index import ExpectedSentence
+from core.utils.levenshtein import BACKENDS, levenshtein_distance, levenshtein_distance_python, levenshtein_distances
+from core.utils import phonetics
+from core.utils.query_budget import QueryBudgetExceeded, QueryRecorder, budget_of, query_budget, sql_shape
+from core.utils.phonetics import PhoneticDictionary, encode_phonemes, metaphone, write_dictionary
+from core.utils.scoring import phonetic_score, score_answer, scoring_mode, spelling_score, spelling_scores
+from core.utils.whisper_backends import onnx_encoder_path
 
-# Create your tests here.
+STUB_AI = 'core.utils.conversation_ai.StubConversationAI'
+
+EXCHANGES = [
+    {'exchange_number': 1, 'bot_says': 'Hello! How are you?', 'user_should_say': 'I am fine thank you'},
+    {'exchange_number': 2, 'bot_says': 'Where are you from?', 'user_should_say': 'I am from Jakarta'},
+]
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    STREAMING_PARTIAL_INTERVAL_MS=0,
+)
+class RoomConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('student', 'student@example.com', 'password')
+        UserProgress.objects.create(user=self.user)
+        self.room = Room.objects.create(user=self.user)
+        topic = ConversationTopic.objects.create(name='Greetings')
+        dialogue = Dialogue.objects.create(topic=topic, exchanges=EXCHANGES, total_exchanges=len(EXCHANGES))
+        self.session = ConversationSession.objects.create(room=self.room, dialogue=dialogue)
+
+    def communicator(self, user, room_id=None):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/room/{room_id or self.room.id}/")
+        communicator.scope['user'] = user
+        return communicator
+
+    async def test_rejects_anonymous_user(self):
+        communicator = self.communicator(AnonymousUser())
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4401)
+
+    @mock.patch('teaching.consumers.transcribe', return_value='I am')
+    @mock.patch('teaching.consumers.transcribe_answer', return_value=('I am fine thank you', None, None))
+    async def test_streamed_answer_gets_partial_and_result(self, transcribe_answer, transcribe):
+        communicator = self.communicator(self.user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'type': 'start'})
+        ready = await communicator.receive_json_from()
+        self.assertEqual(ready, {'type': 'ready', 'expected_response': 'I am fine thank you'})
+
+        audio = wav_bytes(tone(2))
+        await communicator.send_to(bytes_data=audio[:16044])  # header and half a second
+        partial = await communicator.receive_json_from()
+        self.assertEqual(partial, {'type': 'partial', 'text': 'I am'})
+
+        await communicator.send_to(bytes_data=audio[16044:])
+        await communicator.send_json_to({'type': 'stop'})
+        result = await communicator.receive_json_from(timeout=5)
+        while result['type'] == 'partial':
+            result = await communicator.receive_json_from(timeout=5)
+        await communicator.disconnect()
+
+        self.assertEqual(result['type'], 'result')
+        self.assertTrue(result['success'])
+        self.assertEqual(result['user_message']['spelling_score'], 100)
+        self.assertEqual(result['expected_response'], 'I am from Jakarta')
+        transcribe_answer.assert_called_once_with(audio, 'I am fine thank you')
+        self.assertTrue(await Message.objects.filter(room=self.room, role='user', content='I am fine thank you').aexists())
+
+    @override_settings(STREAMING_PARTIAL_WINDOW_SECONDS=1)
+    @mock.patch('teaching.consumers.transcribe', return_value='thank you')
+    async def test_partials_transcribe_a_trailing_window(self, transcribe):
+        communicator = self.communicator(self.user)
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'start'})
+        await communicator.receive_json_from()
+        samples = np.concatenate([tone(2), tone(1, frequency=440)])
+        await communicator.send_to(bytes_data=wav_bytes(samples))
+        self.assertEqual(await communicator.receive_json_from(timeout=5), {'type': 'partial', 'text': 'thank you'})
+        await communicator.disconnect()
+
+        window = transcribe.call_args.args[0]
+        self.assertEqual(len(window), 16000)
+        self.assertTrue(np.allclose(window, samples[-16000:], atol=1e-4))
+
+    @mock.patch('teaching.consumers.has_idle_worker', return_value=False)
+    @mock.patch('teaching.consumers.transcribe')
+    async def test_no_partials_while_workers_are_busy(self, transcribe, has_idle_worker):
+        communicator = self.communicator(self.user)
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'start'})
+        await communicator.receive_json_from()
+        await communicator.send_to(bytes_data=wav_bytes(tone(1)))
+        self.assertTrue(await communicator.receive_nothing(timeout=0.3))
+        await communicator.disconnect()
+        has_idle_worker.assert_called()
+        transcribe.assert_not_called()
+
+    @override_settings(AUDIO_MAX_UPLOAD_BYTES=20000)
+    @mock.patch('teaching.consumers.transcribe', return_value='I am')
+    @mock.patch('teaching.consumers.transcribe_answer')
+    async def test_oversized_stream_drops_the_answer(self, transcribe_answer, transcribe):
+        communicator = self.communicator(self.user)
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'start'})
+        await communicator.receive_json_from()
+        audio = wav_bytes(tone(1))
+        await communicator.send_to(bytes_data=audio[:16044])
+        await communicator.receive_json_from(timeout=5)  # partial
+        await communicator.send_to(bytes_data=audio[16044:])
+        error = await communicator.receive_json_from(timeout=5)
+        self.assertEqual((error['type'], error['code']), ('error', 'too_large'))
+        # Nothing is kept of the refused answer: more audio and a stop are ignored
+        await communicator.send_to(bytes_data=audio[16044:])
+        await communicator.send_json_to({'type': 'stop'})
+        self.assertTrue(await communicator.receive_nothing(timeout=0.3))
+        await communicator.disconnect()
+        transcribe_answer.assert_not_called()
+
+    @mock.patch('teaching.consumers.transcribe_answer')
+    async def test_rejected_audio_is_reported(self, transcribe_answer):
+        transcribe_answer.side_effect = AudioRejected('silent')
+        communicator = self.communicator(self.user)
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'start'})
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'type': 'stop'})
+        error = await communicator.receive_json_from(timeout=5)
+        await communicator.disconnect()
+
+        self.assertEqual(error['type'], 'error')
+        self.assertEqual(error['code'], 'silent')
+        self.assertFalse(await Message.objects.filter(room=self.room, role='user').aexists())
+
+
+    @override_settings(BACKGROUND_JOB_WORKERS=0, CONVERSATION_AI_BACKEND=STUB_AI)
+    async def test_background_conversation_is_announced(self):
+        communicator = self.communicator(self.user)
+        await communicator.connect()
+        await database_sync_to_async(self.client.force_login)(self.user)
+        response = await database_sync_to_async(self.client.post)(
+            f'/room/{self.room.id}/topic/', data={'topic': 'weekend plans', 'async': True}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 202)
+        event = await communicator.receive_json_from(timeout=5)
+        await communicator.disconnect()
+        self.assertEqual((event['type'], event['job_id'], event['status']), ('topic_job', response.json()['job_id'], 'ready'))
+        self.assertTrue(event['expected_response'])
+
+
+def reference_spelling_score(user_input, expected_text):
+    """calculate_spelling_score as it was before the scoring module, on the reference distance."""
+    if not user_input or not expected_text:
+        return None
+    distance = levenshtein_distance_python(user_input.lower(), expected_text.lower())
+    max_length = max(len(user_input), len(expected_text))
+    if max_length == 0:
+        return 0
+    return round((1 - distance / max_length) * 100)
+
+
+class TranscriptionCacheStatsTests(SimpleTestCase):
+    def setUp(self):
+        transcription_cache.get_cache().clear()
+        transcription_cache.reset_stats()
+        self.addCleanup(transcription_cache.reset_stats)
+        tracing.reset()
+        self.addCleanup(tracing.reset)
+
+    def test_worker_lookups_are_counted_by_the_caller(self):
+        key = transcription_cache.pcm_key(np.zeros(16, dtype=np.float32))
+        transcription_cache.set(key, 'hello')
+
+        def job():
+            transcription_cache.get(key)
+            transcription_cache.get(key + 'x')
+            return 'hello'
+
+        result = transcription_pool._run_job(job, (), {})  # as run in a worker process
+        self.assertEqual(transcription_cache.stats()['pcm_hits'], 0)
+        self.assertEqual(transcription_pool._unwrap(result), 'hello')
+        stats = transcription_cache.stats()
+        self.assertEqual((stats['pcm_hits'], stats['pcm_misses'], stats['pcm_hit_rate']), (1, 1, 0.5))
+        self.assertIn(
+            'english_teaching_transcription_cache_lookups_total{kind="pcm",outcome="hit"} 1', tracing.render_prometheus()
+        )
+
+    def test_cache_hit_does_not_load_the_model(self):
+        from core.utils.audio import load_audio
+        from core.utils.whisper import transcribe_audio
+
+        audio = wav_bytes(tone(1))
+        transcription_cache.set(transcription_cache.pcm_key(load_audio(audio), 'hello'), 'hello')
+        with mock.patch('core.utils.whisper.get_model') as get_model:
+            self.assertEqual(transcribe_audio(audio, 'hello'), 'hello')
+        get_model.assert_not_called()
+
+    def test_traced_job(self):
+        def job():
+            tracing.record('whisper', 0.1)
+            transcription_cache.get(transcription_cache.raw_key(b'audio'))
+            return 'text'
+
+        with tracing.collect() as spans:
+            self.assertEqual(transcription_pool._unwrap(transcription_pool._run_job(job, (), {}, traced=True)), 'text')
+        self.assertEqual([name for name, _ in spans], ['whisper'])
+        self.assertEqual(transcription_cache.stats()['raw_misses'], 1)
+
+
+def wav_bytes(samples, sample_rate=16000):
+    """16-bit mono WAV bytes of float samples."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+def slow_transcription(audio, expected_text=None):
+    """A stand-in Whisper job that never finishes in time."""
+    time.sleep(60)
+
+
+def tone(seconds, frequency=220):
+    t = np.arange(int(seconds * 16000)) / 16000
+    return (0.3 * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+@override_settings(AUDIO_MAX_UPLOAD_BYTES=5 * 1024 * 1024, AUDIO_MAX_SECONDS=30, AUDIO_MIN_SECONDS=0.3, AUDIO_SILENCE_DB=-50)
+class AudioGuardTests(SimpleTestCase):
+    def assertRejected(self, code, func, *args):
+        with self.assertRaises(AudioRejected) as context:
+            func(*args)
+        self.assertEqual(context.exception.code, code)
+
+    def test_probe_wav_header(self):
+        self.assertEqual(probe_audio(wav_bytes(tone(1.5))), {'duration': 1.5, 'sample_rate': 16000, 'channels': 1})
+
+    def test_probe_wrong_header(self):
+        unknown = {'duration': None, 'sample_rate': None, 'channels': None}
+        self.assertEqual(probe_audio(b'not audio at all'), unknown)
+        self.assertEqual(probe_audio(b'RIFF\x00\x00'), unknown)  # truncated
+        # Without a duration the upload is let through to be checked once decoded
+        self.assertEqual(check_upload(b'RIFF\x00\x00'), unknown)
+
+    def test_upload_rejections(self):
+        self.assertRejected('empty', check_upload, b'')
+        self.assertRejected('too_long', check_upload, wav_bytes(np.zeros(31 * 16000)))
+        self.assertRejected('too_short', check_upload, wav_bytes(tone(0.1)))
+        with override_settings(AUDIO_MAX_UPLOAD_BYTES=1000):
+            self.assertRejected('too_large', check_upload, wav_bytes(tone(1)))
+        self.assertEqual(check_upload(wav_bytes(tone(1)))['duration'], 1)
+
+    def test_decoded_rejections(self):
+        self.assertRejected('silent', decode_checked, wav_bytes(np.zeros(16000)))
+        self.assertRejected('silent', decode_checked, wav_bytes(0.001 * tone(1)))  # about -60 dBFS
+        self.assertRejected('too_short', decode_checked, tone(0.1))
+        # Decoding stops just past the limit, so a long recording is still refused
+        self.assertRejected('too_long', decode_checked, tone(40))
+        self.assertEqual(len(decode_checked(wav_bytes(tone(1)))), 16000)
+
+    def test_trim_silence(self):
+        samples = np.concatenate([np.zeros(16000), tone(0.5), np.zeros(16000)]).astype(np.float32)
+        trimmed = trim_silence(samples)
+        # The voiced half second plus 200ms of padding on each side
+        self.assertEqual(len(trimmed), int(0.9 * 16000))
+        self.assertTrue(np.array_equal(trimmed[3200:-3200], tone(0.5)))
+        self.assertEqual(len(trim_silence(np.zeros(16000, dtype=np.float32))), 0)
+        self.assertEqual(len(trim_silence(tone(0.01))), 160)  # shorter than a frame: unchanged
+
+class TranscriptionPoolTests(SimpleTestCase):
+    def make_pool(self, timeout=0.5):
+        # Forked workers inherit the patched initializer and skip loading Whisper; jobs are builtins so they pickle
+        patcher = mock.patch.object(transcription_pool, '_init_worker', lambda: None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        pool = transcription_pool.TranscriptionPool(
+            max_workers=1, max_queue=0, timeout=timeout, retry_after=3, start_method='fork'
+        )
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def test_workers_are_spawned_and_load_the_model(self):
+        self.assertEqual(transcription_pool.TranscriptionPool(1, 0, 1, 1).start_method, 'spawn')
+        with mock.patch.object(transcription_pool, '_pool', None), \
+                override_settings(TRANSCRIPTION_WORKERS=1, TRANSCRIPTION_START_METHOD='forkserver'):
+            self.assertEqual(transcription_pool.get_pool().start_method, 'forkserver')
+        with mock.patch('django.setup') as setup, mock.patch('core.utils.whisper.get_model') as get_model:
+            transcription_pool._init_worker()
+        setup.assert_called_once()
+        get_model.assert_called_once()
+
+    def test_timeout_kills_stuck_worker_and_frees_slot(self):
+        pool = self.make_pool()
+        self.assertEqual(pool.run(abs, -2), 2)
+        executor = pool._executor
+        workers = list(executor._processes.values())
+        started = time.monotonic()
+        with self.assertRaises(transcription_pool.TranscriptionTimeout):
+            pool.run(time.sleep, 60)
+        self.assertLess(time.monotonic() - started, 5)
+        for worker in workers:
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
+        self.assertIsNot(pool._executor, executor)
+        self.assertEqual(pool.run(abs, -3), 3)  # the slot was released and a fresh pool started
+
+    def test_timeout_when_the_timer_fires_first(self):
+        pool = self.make_pool(timeout=0.2)
+        future, executor, release = pool._submit(time.sleep, (60,), {})
+        pool._expire(future, executor, release)
+        with mock.patch.object(pool, '_submit', return_value=(future, executor, release)):
+            with self.assertRaises(transcription_pool.TranscriptionTimeout):
+                pool.run(time.sleep, 60)
+
+    def test_submitted_job_past_timeout_is_stopped(self):
+        pool = self.make_pool()
+        future = pool.submit(time.sleep, 60)
+        with self.assertRaises(BrokenProcessPool):
+            future.result(timeout=5)
+        self.assertEqual(pool.run(abs, -4), 4)
+
+
+    def test_idle_worker(self):
+        pool = self.make_pool(timeout=5)
+        self.assertTrue(pool.has_idle_worker())
+        future = pool.submit(time.sleep, 0.3)
+        self.assertFalse(pool.has_idle_worker())
+        future.result(timeout=5)
+        for _ in range(50):  # the slot is released by a done callback, just after result() returns
+            if pool.has_idle_worker():
+                break
+            time.sleep(0.01)
+        self.assertTrue(pool.has_idle_worker())
+        with override_settings(TRANSCRIPTION_WORKERS=0):
+            self.assertTrue(transcription_pool.has_idle_worker())  # jobs run inline
+
+    def test_full_queue_is_refused(self):
+        pool = self.make_pool(timeout=5)
+        future = pool.submit(time.sleep, 0.5)
+        with self.assertRaises(transcription_pool.TranscriptionQueueFull) as context:
+            pool.run(abs, -1)
+        self.assertEqual(context.exception.retry_after, 3)
+        future.result(timeout=5)
+        self.assertEqual(pool.run(abs, -1), 1)
+
+class WhisperModelTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict('core.utils.whisper._models', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_model_is_loaded_once(self):
+        from core.utils.whisper import get_model
+
+        def load_model(*args, **kwargs):
+            time.sleep(0.05)  # let the other threads reach the lock
+            return mock.Mock()
+
+        with mock.patch('whisper.load_model', side_effect=load_model) as load:
+            threads = [threading.Thread(target=get_model) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            model = get_model()
+        load.assert_called_once()
+        self.assertIs(get_model(), model)
+        model.eval.assert_called_once()
+
+    def test_preload_fills_the_registry(self):
+        from core.utils.whisper import get_model, is_model_loaded, preload_model
+
+        param = mock.Mock()
+        with mock.patch('whisper.load_model') as load:
+            load.return_value.parameters.return_value = [param]
+            self.assertFalse(is_model_loaded())
+            model = preload_model()
+            self.assertTrue(is_model_loaded())
+            self.assertFalse(is_model_loaded('torch-int8'))
+            self.assertIs(get_model(), model)
+        load.assert_called_once()
+        param.requires_grad_.assert_called_once_with(False)
+
+
+class WhisperBackendTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict('core.utils.whisper._models', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('whisper.load_model')
+        self.load_model = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_backend_from_settings(self):
+        from core.utils.whisper import get_model
+
+        loaded = self.load_model.return_value
+        with mock.patch('core.utils.whisper_backends.quantize_int8') as quantize:
+            with override_settings(WHISPER_BACKEND='torch'):
+                self.assertIs(get_model(), loaded)
+            with override_settings(WHISPER_BACKEND='torch-int8'):
+                self.assertIs(get_model(), quantize.return_value)
+        quantize.assert_called_once_with(loaded)
+        self.assertIs(get_model('torch'), loaded)
+
+        with override_settings(WHISPER_BACKEND='tflite'), self.assertRaises(ValueError):
+            get_model()
+
+    @override_settings(WHISPER_BACKEND='onnx')
+    def test_onnx_encoder(self):
+        from core.utils.whisper import get_model
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(WHISPER_ONNX_DIR=directory):
+            open(onnx_encoder_path(), 'wb').close()
+            with mock.patch('core.utils.whisper_backends._onnx_encoder') as onnx_encoder:
+                model = get_model()
+        onnx_encoder.assert_called_once()
+        self.assertIs(model.encoder, onnx_encoder.return_value)
+
+    @override_settings(WHISPER_BACKEND='onnx')
+    def test_onnx_falls_back_to_torch(self):
+        from core.utils.whisper import get_model
+
+        loaded = self.load_model.return_value
+        encoder = loaded.encoder
+        with tempfile.TemporaryDirectory() as directory, override_settings(WHISPER_ONNX_DIR=directory):
+            self.assertIs(get_model(), loaded)  # no exported encoder
+
+            open(onnx_encoder_path(), 'wb').close()
+            with mock.patch.dict('sys.modules', {'onnxruntime': None}):  # not installed
+                with mock.patch.dict('core.utils.whisper._models', clear=True):
+                    self.assertIs(get_model(), loaded)
+        self.assertIs(loaded.encoder, encoder)
+
+
+@override_settings(WHISPER_SHORT_UTTERANCE=True, WHISPER_SHORT_AUDIO_CTX=True, AUDIO_MAX_SECONDS=31)
+class ShortUtteranceTests(SimpleTestCase):
+    def setUp(self):
+        transcription_cache.get_cache().clear()
+        self.model = mock.Mock()
+        self.model.dims.n_text_ctx = 448
+        self.model.dims.n_audio_ctx = 1500
+        tokenizer = mock.Mock()
+        tokenizer.encode.side_effect = str.split  # one token per word
+        patcher = mock.patch('core.utils.whisper._get_tokenizer', return_value=tokenizer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sample_len_from_expected_text(self):
+        from core.utils.whisper import _sample_len_for
+
+        self.assertEqual(_sample_len_for(self.model, ['Hi there', 'How are you today']), 4 * 2 + 10)
+        self.assertEqual(_sample_len_for(self.model, [' '.join(['word'] * 500)]), 224)
+        self.assertIsNone(_sample_len_for(self.model, ['Hi there', None]))
+        self.assertIsNone(_sample_len_for(self.model, ['']))
+        with override_settings(WHISPER_SHORT_UTTERANCE=False):
+            self.assertIsNone(_sample_len_for(self.model, ['Hi there']))
+
+    def test_audio_ctx(self):
+        from whisper.audio import N_SAMPLES
+        from core.utils.whisper import _audio_ctx_for
+
+        self.assertEqual(_audio_ctx_for(self.model, 0), 64)
+        self.assertEqual(_audio_ctx_for(self.model, 16000), 128)  # 2s with headroom: 100 positions
+        self.assertEqual(_audio_ctx_for(self.model, N_SAMPLES - 16000), 1500)
+        self.assertEqual(_audio_ctx_for(self.model, N_SAMPLES), 1500)
+        with override_settings(WHISPER_SHORT_AUDIO_CTX=False):
+            self.assertEqual(_audio_ctx_for(self.model, 16000), 1500)
+
+    def test_one_window(self):
+        from whisper.audio import N_SAMPLES
+        from core.utils.whisper import _fits_one_window
+
+        self.assertFalse(_fits_one_window(np.zeros(0, dtype=np.float32)))
+        self.assertTrue(_fits_one_window(np.zeros(N_SAMPLES, dtype=np.float32)))
+        self.assertFalse(_fits_one_window(np.zeros(N_SAMPLES + 1, dtype=np.float32)))
+
+    def transcribe(self, seconds, expected_text):
+        from core.utils.whisper import transcribe_audio
+
+        self.model.transcribe.return_value = {'text': ' full'}
+        with mock.patch('core.utils.whisper.get_model', return_value=self.model), \
+                mock.patch('core.utils.whisper._decode_windows', return_value=[' window']) as decode:
+            text = transcribe_audio(tone(seconds), expected_text)
+        return text, decode
+
+    def test_audio_just_under_one_window_is_decoded_as_a_window(self):
+        text, decode = self.transcribe(29.9, 'Hi there')
+        self.assertEqual(text, 'window')
+        self.assertEqual(decode.call_args.args[2], ['Hi there'])
+        self.model.transcribe.assert_not_called()
+
+    def test_audio_just_over_one_window_is_transcribed_in_full(self):
+        text, decode = self.transcribe(30.1, 'Hi there')
+        self.assertEqual(text, 'full')
+        decode.assert_not_called()
+
+    def test_without_expected_text(self):
+        text, decode = self.transcribe(1, None)
+        self.assertEqual(text, 'window')
+        self.assertEqual(decode.call_args.args[2], [None])
+
+
+class TranscribeBatchTests(SimpleTestCase):
+    def setUp(self):
+        transcription_cache.get_cache().clear()
+        self.model = mock.Mock()
+        self.model.transcribe.return_value = {'text': ' I am fine thank you'}
+        patcher = mock.patch('core.utils.whisper.get_model', return_value=self.model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def transcribe_batch(self):
+        from core.utils.whisper import clean_transcription, transcribe_batch
+
+        audios = [wav_bytes(tone(1)), wav_bytes(np.zeros(16000)), wav_bytes(tone(1.5))]
+        with mock.patch('core.utils.whisper._decode_windows', return_value=[' I am fine thank you'] * 2) as decode:
+            results = transcribe_batch(audios, ['I am fine thank you'] * 3)
+        expected = clean_transcription(' I am fine thank you')
+        self.assertEqual((results[0], results[2]), (expected, expected))
+        self.assertEqual(results[1].code, 'silent')
+        return decode
+
+    @override_settings(WHISPER_SHORT_UTTERANCE=True)
+    def test_short_utterances_are_decoded_together(self):
+        decode = self.transcribe_batch()
+        self.assertEqual(len(decode.call_args.args[1]), 2)
+        self.model.transcribe.assert_not_called()
+
+    @override_settings(WHISPER_SHORT_UTTERANCE=False)
+    def test_without_short_utterance_mode_each_gets_model_transcribe(self):
+        # The same model.transcribe call transcribe_audio makes in this mode
+        decode = self.transcribe_batch()
+        decode.assert_not_called()
+        self.assertEqual(self.model.transcribe.call_count, 2)
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def make_batcher(self, window=0.2, max_batch=3):
+        self.batches = []
+
+        def run_batch(items):
+            self.batches.append(items)
+            future = Future()
+            future.set_result([AudioRejected('silent') if item == 'quiet' else item.upper() for item in items])
+            return future
+
+        return transcription_pool.MicroBatcher(
+            run_batch, window=window, max_batch=max_batch, max_pending=10, timeout=5, retry_after=3
+        )
+
+    def run_together(self, batcher, items):
+        results = {}
+
+        def run(item):
+            try:
+                results[item] = batcher.run(item)
+            except AudioRejected as e:
+                results[item] = e.code
+
+        threads = [threading.Thread(target=run, args=(item,)) for item in items]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_each_caller_gets_its_own_result(self):
+        batcher = self.make_batcher()
+        results = self.run_together(batcher, ['one', 'quiet', 'two'])
+        self.assertEqual(results, {'one': 'ONE', 'quiet': 'silent', 'two': 'TWO'})
+        self.assertEqual(len(self.batches), 1)
+
+    def test_batch_is_cut_at_max_batch(self):
+        batcher = self.make_batcher(window=1, max_batch=2)
+        started = time.monotonic()
+        self.run_together(batcher, ['one', 'two', 'three', 'four'])
+        self.assertEqual(sorted(len(batch) for batch in self.batches), [2, 2])
+        self.assertLess(time.monotonic() - started, 1)  # full batches go without waiting out the window
+
+    def test_batch_is_cut_at_window(self):
+        batcher = self.make_batcher(window=0.05)
+        self.assertEqual(batcher.run('one'), 'ONE')
+        time.sleep(0.2)
+        self.assertEqual(batcher.run('two'), 'TWO')
+        self.assertEqual(self.batches, [['one'], ['two']])
+
+
+class ForcedAlignmentTests(SimpleTestCase):
+    def setUp(self):
+        transcription_cache.get_cache().clear()
+
+    def score(self, confidences, audio=None, expected_text="I went home."):
+        from core.utils.forced_alignment import score_expected
+
+        with mock.patch('core.utils.forced_alignment.word_confidences', return_value=confidences) as aligned:
+            return score_expected(audio or wav_bytes(tone(1)), expected_text), aligned
+
+    def test_no_words_or_too_little_audio_is_empty(self):
+        from core.utils.forced_alignment import _score_samples
+
+        result, aligned = self.score([], expected_text="   ")
+        self.assertEqual((result['transcript'], result['score'], result['word_comparison']['total_expected_words']), ('', 0, 0))
+        aligned.assert_not_called()
+        result = _score_samples(tone(0.05), ['i', 'went', 'home.'])
+        self.assertEqual(result['score'], 0)
+        self.assertEqual([word['word'] for word in result['word_comparison']['missing_words']], ['i', 'went', 'home.'])
+
+    def test_confidence_thresholds(self):
+        from core.utils.forced_alignment import UNCLEAR_WORD
+
+        result, aligned = self.score([0.9, 0.45, 0.1])
+        analysis = result['word_comparison']['word_analysis']
+        self.assertEqual([word['status'] for word in analysis], ['correct', 'close', 'incorrect'])
+        self.assertEqual([word['user_word'] for word in analysis], ['i', 'went', UNCLEAR_WORD])
+        self.assertEqual(result['transcript'], f'I went {UNCLEAR_WORD}')
+        self.assertEqual(result['score'], 48)
+        self.assertEqual(result['word_comparison']['correct_words'], 1)
+        self.assertEqual(
+            [(word['expected_word'], word['confidence']) for word in result['word_comparison']['incorrect_words']],
+            [('went', 45), ('home.', 10)],
+        )
+        # On the 0.6 / 0.3 boundaries
+        result, _ = self.score([0.6, 0.3, 0.29], expected_text="I went out")
+        self.assertEqual(
+            [word['status'] for word in result['word_comparison']['word_analysis']], ['correct', 'close', 'incorrect']
+        )
+
+    def test_words_are_normalized_like_the_spelling_path(self):
+        result, aligned = self.score([0.9, 0.9], expected_text="Hello, YOU’RE")
+        # Punctuation is not aligned, and the words compare as compare_words would
+        self.assertEqual(aligned.call_args.args[1], ['hello', "you're"])
+        self.assertEqual(
+            [word['expected_word'] for word in result['word_comparison']['word_analysis']],
+            [word['expected_word'] for word in compare_words("hello, you're", "Hello, YOU’RE")['word_analysis']],
+        )
+        self.assertEqual(result['transcript'], "Hello, YOU’RE")
+
+    def test_cached_by_decoded_audio_and_sentence(self):
+        audio = wav_bytes(tone(1))
+        first, aligned = self.score([0.9, 0.9, 0.9], audio)
+        aligned.assert_called_once()
+        second, aligned = self.score([0.1, 0.1, 0.1], audio)
+        aligned.assert_not_called()
+        self.assertEqual(second, first)
+        _, aligned = self.score([0.9, 0.9], audio, expected_text="I went")
+        aligned.assert_called_once()
+
+
+class LevenshteinBackendTests(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        sentence = "Yes, I tried it once but it was much harder than I expected."
+        self.pairs = [
+            ('', ''), ('', 'abc'), ('abc', ''), ('kitten', 'sitting'), ('flaw', 'lawn'),
+            ('Straße', 'strasse'), ('İstanbul', 'istanbul'), ('café', 'cafe'),
+            (sentence, sentence.lower().replace(',', '')),
+            (sentence, 'yes i try it one but was much hard then i expect'),
+        ]
+        for _ in range(300):
+            a = ''.join(rng.choice('abcd efg') for _ in range(rng.randint(0, 90)))
+            b = ''.join(rng.choice('abcd efg') for _ in range(rng.randint(0, 90)))
+            self.pairs.append((a, b))
+
+    def test_backends_match_reference(self):
+        for backend in BACKENDS:
+            for a, b in self.pairs:
+                self.assertEqual(levenshtein_distance(a, b, backend), levenshtein_distance_python(a, b), (backend, a, b))
+
+    def test_word_sequences(self):
+        for backend in BACKENDS:
+            self.assertEqual(levenshtein_distance('i am from jakarta'.split(), 'i from big jakarta'.split(), backend), 2)
+
+    def test_bulk_distances(self):
+        expected = [levenshtein_distance_python(a, b) for a, b in self.pairs]
+        for backend in BACKENDS:
+            self.assertEqual(levenshtein_distances(self.pairs, backend), expected)
+        self.assertEqual(levenshtein_distances([]), [])
+
+    def test_spelling_scores_match_reference(self):
+        expected = [reference_spelling_score(a, b) for a, b in self.pairs]
+        view = MessageView()
+        for backend in BACKENDS:
+            self.assertEqual(spelling_scores(self.pairs, backend), expected)
+            self.assertEqual([spelling_score(a, b, backend) for a, b in self.pairs], expected)
+        self.assertEqual([view.calculate_spelling_score(a, b) for a, b in self.pairs], expected)
+
+
+class WordAlignmentTests(SimpleTestCase):
+    def test_exact_answer(self):
+        result = compare_words("I am fine, thank you", "I am fine, thank you")
+        self.assertEqual(result['correct_words'], 5)
+        self.assertEqual(result['incorrect_words'], [])
+        self.assertEqual(result['word_analysis'][0], {'user_word': 'i', 'expected_word': 'i', 'status': 'correct', 'position': 0})
+
+    def test_close_and_incorrect_words(self):
+        result = compare_words("i am form jakarta", "I am from Jakarta")
+        self.assertEqual(result['word_analysis'][2]['status'], 'close')
+        self.assertEqual(result['word_analysis'][2]['similarity'], 75)
+        self.assertEqual(result['incorrect_words'], [{'user_word': 'form', 'expected_word': 'from', 'position': 2}])
+        self.assertEqual(result['correct_words'], 3)
+
+        result = compare_words("i am from london", "I am from Jakarta")
+        self.assertEqual(result['word_analysis'][3]['status'], 'incorrect')
+
+    def test_missing_and_extra_words(self):
+        result = compare_words("the the cat sat", "the cat sat on the mat")
+        self.assertEqual([w['word'] for w in result['missing_words']], ['on', 'the', 'mat'])
+        self.assertEqual([w['word'] for w in result['extra_words']], ['the'])
+        self.assertEqual(result['correct_words'], 3)
+        self.assertEqual(result['total_expected_words'], 6)
+        self.assertEqual(result['total_user_words'], 4)
+
+    def test_empty_input(self):
+        self.assertEqual(
+            compare_words("", "hello"),
+            {'word_analysis': [], 'missing_words': [], 'extra_words': [], 'incorrect_words': []},
+        )
+
+    def test_batch_matches_single(self):
+        pairs = [("i am form jakarta", "I am from Jakarta"), ("hello", "Hello there"), ("i am form jakarta", "I am from Jakarta")]
+        self.assertEqual(compare_words_batch(pairs), [compare_words(a, b) for a, b in pairs])
+
+
+class ExpectedIndexTests(SimpleTestCase):
+    def test_compiled_matches_plain_text(self):
+        pairs = [
+            ("i am form jakarta", "I am from Jakarta"),
+            ("Yes I try it one but was much hard then i expect", "Yes, I tried it once but it was much harder than I expected."),
+            ("x" * 200, "Straße " * 30),
+            ("hello", "Hello there"),
+        ]
+        for user_input, expected_text in pairs:
+            compiled = ExpectedSentence(expected_text)
+            for backend in BACKENDS:
+                self.assertEqual(spelling_score(user_input, compiled, backend), spelling_score(user_input, expected_text, backend))
+            self.assertEqual(compare_words(user_input, compiled), compare_words(user_input, expected_text))
+        self.assertIsNone(spelling_score("", ExpectedSentence("hello")))
+
+    def test_dialogue_cache(self):
+        dialogue = Dialogue(pk=1, exchanges=EXCHANGES, total_exchanges=len(EXCHANGES))
+        self.addCleanup(expected_index.clear)
+        with override_settings(EXPECTED_INDEX_CACHE_SIZE=1):
+            compiled = expected_index.compile_dialogue(dialogue)
+            self.assertIs(expected_index.get_expected(dialogue, 1), compiled[1])
+            self.assertEqual(compiled[1].words, ['i', 'am', 'from', 'jakarta'])
+            self.assertIsNone(expected_index.get_expected(dialogue, 2))
+
+            expected_index.compile_dialogue(Dialogue(pk=2, exchanges=EXCHANGES))
+            self.assertIsNot(expected_index.get_expected(dialogue, 1), compiled[1])
+
+    def test_metaphone(self):
+        self.assertEqual(metaphone("their"), metaphone("there"))
+        self.assertEqual(metaphone("night"), metaphone("nite"))
+        self.assertEqual(metaphone("Phone"), metaphone("fone"))
+        self.assertNotEqual(metaphone("thank"), metaphone("tank"))
+
+
+class PhoneticScoringTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(phonetics.reset)
+        phonetics.reset()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'phonetic.dict')
+        write_dictionary({
+            'their': encode_phonemes(['DH', 'EH1', 'R']),
+            'there': encode_phonemes(['DH', 'EH1', 'R']),
+            'to': encode_phonemes(['T', 'UW1']),
+            'two': encode_phonemes(['T', 'UW1']),
+            'home': encode_phonemes(['HH', 'OW1', 'M']),
+            'i': encode_phonemes(['AY1']),
+            'went': encode_phonemes(['W', 'EH1', 'N', 'T']),
+            'night': encode_phonemes(['N', 'AY1', 'T']),
+        }, self.path)
+
+    def test_dictionary_lookup(self):
+        dictionary = PhoneticDictionary(self.path)
+        self.assertEqual(len(dictionary), 8)
+        self.assertEqual(dictionary.lookup('two'), dictionary.lookup('to'))
+        self.assertIsNone(dictionary.lookup('zebra'))
+        self.assertIsNone(dictionary.lookup('a'))
+
+    def test_homophones_score_full_marks(self):
+        with override_settings(PHONETIC_DICTIONARY_PATH=self.path):
+            self.assertEqual(phonetic_score("I went two there home", "I went to their home."), 100)
+            self.assertLess(spelling_score("I went two there home", "I went to their home."), 100)
+            result = compare_words("I went two there home", "I went to their home.", phonetic=True)
+            self.assertEqual(result['incorrect_words'], [])
+            self.assertEqual(result['correct_words'], 5)
+            self.assertEqual(
+                phonetic_score("I went two there home", ExpectedSentence("I went to their home.")), 100
+            )
+
+    def test_words_missing_from_dictionary_use_metaphone(self):
+        # "nite" is not in the dictionary, so it is compared with "night" on Metaphone, not with its pronunciation
+        with override_settings(PHONETIC_DICTIONARY_PATH=self.path):
+            self.assertEqual(phonetics.phonetic_keys('nite')[0], None)
+            self.assertTrue(phonetics.sounds_alike(phonetics.phonetic_keys('nite'), phonetics.phonetic_keys('night')))
+            self.assertEqual(phonetic_score("I went home last nite", "I went home last night"), 100)
+            self.assertEqual(phonetic_score("I went home last nite", ExpectedSentence("I went home last night")), 100)
+            result = compare_words("I went home at nite", "I went home at night", phonetic=True)
+            self.assertEqual(result['incorrect_words'], [])
+
+    def test_metaphone_fallback(self):
+        with override_settings(PHONETIC_DICTIONARY_PATH=os.path.join(os.path.dirname(self.path), 'missing.dict')):
+            self.assertEqual(phonetic_score("the knight was long", "The night was long"), 100)
+            self.assertIsNone(phonetic_score("", "The night was long"))
+
+    def test_mode_per_difficulty(self):
+        with override_settings(PHONETIC_SCORING_DIFFICULTIES=['easy']):
+            self.assertEqual(scoring_mode('easy'), 'phonetic')
+            self.assertEqual(scoring_mode('hard'), 'spelling')
+        self.assertEqual(score_answer("the knight", "The night", 'spelling'), spelling_score("the knight", "The night"))
+        with self.assertRaises(ValueError):
+            score_answer("a", "b", 'rhyming')
+
+
+class RescoreMessagesTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('student', 'student@example.com', 'password')
+        room = Room.objects.create(user=user)
+        topic = ConversationTopic.objects.create(name='Greetings')
+        dialogue = Dialogue.objects.create(topic=topic, exchanges=EXCHANGES, total_exchanges=len(EXCHANGES))
+        session = ConversationSession.objects.create(room=room, dialogue=dialogue)
+        self.answers = []
+        for exchange, answer in zip(EXCHANGES, ["i am fine thank", "I am from Jakarta"]):
+            Message.objects.create(
+                room=room, role='assistant', content=exchange['bot_says'],
+                original_text=exchange['user_should_say'], conversation_session=session,
+            )
+            self.answers.append(Message.objects.create(
+                room=room, role='user', content=answer, original_text=answer,
+                conversation_session=session, spelling_score=1,
+            ))
+        # Free chat outside a conversation has nothing to be scored against
+        self.free_chat = Message.objects.create(room=room, role='user', content='hello', spelling_score=1)
+
+    def scores(self):
+        return [Message.objects.get(id=m.id).spelling_score for m in self.answers + [self.free_chat]]
+
+    def test_rescores_against_preceding_prompt(self):
+        call_command('rescore_messages', workers=0, chunk_size=1, stdout=StringIO())
+        self.assertEqual(self.scores(), [
+            spelling_score("i am fine thank", "I am fine thank you"),
+            spelling_score("I am from Jakarta", "I am from Jakarta"),
+            1,
+        ])
+
+    def test_forced_alignment_scores_are_left_alone(self):
+        Message.objects.filter(id=self.answers[0].id).update(content='i am ___ thank you', scoring_engine='forced')
+        call_command('rescore_messages', workers=0, stdout=StringIO())
+        self.assertEqual(self.scores(), [1, 100, 1])
+
+    def test_resume_and_dry_run(self):
+        call_command('rescore_messages', workers=0, dry_run=True, stdout=StringIO())
+        self.assertEqual(self.scores(), [1, 1, 1])
+        call_command('rescore_messages', workers=0, after_id=self.answers[0].id, stdout=StringIO())
+        self.assertEqual(self.scores(), [1, 100, 1])
+
+
+class AnswerWritePathTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('student', 'student@example.com', 'password')
+        UserProgress.objects.create(user=self.user)
+        self.room = Room.objects.create(user=self.user)
+        topic = ConversationTopic.objects.create(name='Greetings')
+        dialogue = Dialogue.objects.create(topic=topic, exchanges=EXCHANGES, total_exchanges=len(EXCHANGES))
+        self.session = ConversationSession.objects.create(room=self.room, dialogue=dialogue)
+
+    def load_session(self):
+        return ConversationSession.objects.select_related('dialogue__topic').get(pk=self.session.pk)
+
+    def test_answer_is_one_update_and_one_insert(self):
+        session = self.load_session()
+        with CaptureQueriesContext(connection) as queries:
+            payload = MessageView().record_answer(self.room, session, 'I am fine thank you', 'I am fine thank you')
+        # Savepoints aside (the test case's transaction turns atomic() into one)
+        statements = [q['sql'].split()[0] for q in queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(statements, ['UPDATE', 'INSERT'])
+        self.assertEqual(payload['current_exchange_index'], 1)
+        self.assertEqual(self.load_session().current_exchange_index, 1)
+        self.assertEqual(
+            list(self.room.messages.order_by('created_at', 'id').values_list('role', flat=True)),
+            ['user', 'assistant', 'assistant'],
+        )
+
+    def test_scoring_engine_is_stored(self):
+        MessageView().record_answer(self.room, self.load_session(), 'I am fine thank', 'I am fine thank you')
+        forced = {'correct_words': 4, 'total_expected_words': 5, 'word_analysis': [], 'incorrect_words': [],
+                  'missing_words': [], 'extra_words': []}
+        MessageView().record_answer(self.room, self.load_session(), 'I am fine thank ___', 'I am fine thank you', 80, forced)
+        self.assertEqual(
+            list(self.room.messages.filter(role='user').order_by('id').values_list('scoring_engine', 'spelling_score')),
+            [('transcribe', spelling_score('I am fine thank', 'I am fine thank you')), ('forced', 80)],
+        )
+
+    def test_double_submit_conflicts_without_writing(self):
+        first, second = self.load_session(), self.load_session()
+        MessageView().record_answer(self.room, first, 'I am fine thank you', 'I am fine thank you')
+        with self.assertRaises(AnswerConflict):
+            MessageView().record_answer(self.room, second, 'I am fine thank you', 'I am fine thank you')
+        self.assertEqual(self.load_session().current_exchange_index, 1)
+        self.assertEqual(self.room.messages.count(), 3)
+
+    def test_conflict_is_409(self):
+        self.client.force_login(self.user)
+        with mock.patch.object(ConversationSession, 'advance_from', return_value=False):
+            response = self.client.post(
+                f'/room/{self.room.id}/send/', data={'content': 'I am fine thank you'}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(self.room.messages.exists())
+
+    def test_last_answer_completes_session(self):
+        session = self.load_session()
+        MessageView().record_answer(self.room, session, 'I am fine thank you', 'I am fine thank you')
+        payload = MessageView().record_answer(self.room, session, 'I am from Jakarta', 'I am from Jakarta')
+        self.assertTrue(payload['conversation_completed'])
+        self.assertTrue(self.load_session().is_completed)
+        self.assertEqual(UserProgress.objects.get(user=self.user).completed_conversations, 1)
+
+
+    @override_settings(SCORING_ENGINE='transcribe', TRANSCRIPTION_WORKERS=0, TRANSCRIPTION_MAX_BATCH=1)
+    def test_rejected_audio_is_400(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        self.client.force_login(self.user)
+        transcription_cache.get_cache().clear()
+        for audio, code in [(np.zeros(31 * 16000), 'too_long'), (np.zeros(16000), 'silent')]:
+            with mock.patch('core.utils.whisper.get_model') as get_model:
+                response = self.client.post(
+                    f'/room/{self.room.id}/send/', data={'audio': SimpleUploadedFile('answer.wav', wav_bytes(audio))}
+                )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['code'], code)
+            self.assertFalse(get_model.return_value.method_calls)  # refused before Whisper ran
+        self.assertFalse(self.room.messages.exists())
+        self.assertEqual(self.load_session().current_exchange_index, 0)
+
+    def post_audio(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        self.client.force_login(self.user)
+        return self.client.post(
+            f'/room/{self.room.id}/send/', data={'audio': SimpleUploadedFile('answer.wav', wav_bytes(tone(1)))}
+        )
+
+    @override_settings(SCORING_ENGINE='transcribe')
+    def test_busy_transcription_is_503_with_retry_after(self):
+        with mock.patch('teaching.views.transcribe', side_effect=transcription_pool.TranscriptionQueueFull(7)):
+            response = self.post_audio()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertFalse(self.room.messages.exists())
+
+    @override_settings(SCORING_ENGINE='transcribe', TRANSCRIPTION_MAX_BATCH=1)
+    def test_slow_transcription_is_504(self):
+        transcription_cache.get_cache().clear()
+        pool = transcription_pool.TranscriptionPool(
+            max_workers=1, max_queue=0, timeout=0.3, retry_after=3, start_method='fork'
+        )
+        self.addCleanup(pool.shutdown)
+        with mock.patch.object(transcription_pool, '_init_worker', lambda: None), \
+                mock.patch.object(transcription_pool, 'get_pool', return_value=pool), \
+                mock.patch('core.utils.whisper.transcribe_audio', slow_transcription):
+            response = self.post_audio()
+        self.assertEqual(response.status_code, 504)
+        self.assertFalse(self.room.messages.exists())
+
+
+class UserProgressCounterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('student', 'student@example.com', 'password')
+        self.progress = UserProgress.objects.create(user=self.user)
+
+    def test_levels_advance_at_their_steps(self):
+        results = []
+        for _ in range(6):
+            with CaptureQueriesContext(connection) as queries:
+                results.append(UserProgress.complete_conversation(self.user.id))
+            # Savepoints aside (the test case's transaction turns atomic() into one)
+            statements = [q['sql'] for q in queries if 'SAVEPOINT' not in q['sql']]
+            self.assertEqual([sql.split()[0] for sql in statements], ['SELECT', 'UPDATE', 'SELECT'])
+            # The count and the level are computed by the database, not written from Python
+            self.assertIn('"completed_conversations" + 1', statements[1])
+            self.assertIn('CASE WHEN', statements[1])
+        self.assertEqual(results, [
+            (1, 'easy', False), (2, 'medium', True), (3, 'medium', False),
+            (4, 'medium', False), (5, 'hard', True), (6, 'hard', False),
+        ])
+        self.progress.refresh_from_db()
+        self.assertEqual((self.progress.completed_conversations, self.progress.current_level), (6, 'hard'))
+
+    def test_instance_method_and_missing_row(self):
+        self.assertFalse(self.progress.increment_completed_conversations())
+        self.assertTrue(self.progress.increment_completed_conversations())
+        self.assertEqual((self.progress.completed_conversations, self.progress.current_level), (2, 'medium'))
+        other = User.objects.create_user('newcomer', 'newcomer@example.com', 'password')
+        self.assertEqual(UserProgress.complete_conversation(other.id), (1, 'easy', False))
+        self.assertEqual(UserProgress.objects.get(user=other).completed_conversations, 1)
+
+    def test_completions_from_stale_copies_both_count(self):
+        # Two sessions of the same user, each holding the progress row as it was before either finished
+        first, second = UserProgress.objects.get(user=self.user), UserProgress.objects.get(user=self.user)
+        self.assertFalse(first.increment_completed_conversations())
+        self.assertTrue(second.increment_completed_conversations())
+        self.assertEqual((second.completed_conversations, second.current_level), (2, 'medium'))
+        self.progress.refresh_from_db()
+        self.assertEqual((self.progress.completed_conversations, self.progress.current_level), (2, 'medium'))
+
+    def test_level_advanced_only_when_it_changed(self):
+        # A level set elsewhere (e.g. by a teacher) is not reported as an advance
+        UserProgress.objects.filter(pk=self.progress.pk).update(completed_conversations=1, current_level='medium')
+        self.assertEqual(UserProgress.complete_conversation(self.user.id), (2, 'medium', False))
+
+
+class UserProgressConcurrencyTests(TransactionTestCase):
+    def test_concurrent_completions_are_not_lost(self):
+        user = User.objects.create_user('student', 'student@example.com', 'password')
+        UserProgress.objects.create(user=user)
+        threads, per_thread = 8, 25
+        advanced = []
+        errors = []
+
+        def complete():
+            try:
+                for _ in range(per_thread):
+                    for attempt in range(50):
+                        try:
+                            advanced.append(UserProgress.complete_conversation(user.id)[2])
+                            break
+                        except OperationalError:
+                            # SQLite allows one writer at a time; PostgreSQL just waits on the row lock
+                            time.sleep(0.01)
+                    else:
+                        errors.append('gave up')
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=complete) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        progress = UserProgress.objects.get(user=user)
+        self.assertEqual(progress.completed_conversations, threads * per_thread)
+        self.assertEqual(progress.current_level, 'hard')
+        self.assertEqual(advanced.count(True), 2)
+
+
+@override_settings(CONVERSATION_AI_BACKEND=STUB_AI)
+class DialoguePoolTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('student', 'student@example.com', 'password')
+        UserProgress.objects.create(user=self.user)
+        self.room = Room.objects.create(user=self.user)
+        self.topic = ConversationTopic.objects.create(name='favorite food')
+
+    def test_refill_tops_up_below_low_water(self):
+        inactive = ConversationTopic.objects.create(name='travel', is_active=False)
+        Dialogue.objects.create(topic=self.topic, exchanges=EXCHANGES, total_exchanges=len(EXCHANGES))
+        call_command('refill_dialogue_pool', size=4, low_water=2, stdout=StringIO())
+        self.assertEqual(self.topic.dialogues.count(), 4)
+        self.assertEqual(inactive.dialogues.count(), 0)
+        self.assertEqual(self.topic.dialogues.last().total_exchanges, 5)  # easy
+
+        self.topic.dialogues.last().delete()
+        call_command('refill_dialogue_pool', size=4, low_water=2, stdout=StringIO())
+        self.assertEqual(self.topic.dialogues.count(), 3)  # still above the low-water mark
+
+    def test_custom_topics_only_while_in_use(self):
+        unused = ConversationTopic.objects.create(name='my cat', is_custom=True)
+        used = ConversationTopic.objects.create(name='my dog', is_custom=True)
+        stale = ConversationTopic.objects.create(name='my bird', is_custom=True)
+        for topic, days in ((used, 1), (stale, 30)):
+            session = ConversationSession.objects.create(
+                room=self.room, dialogue=Dialogue.objects.create(topic=topic, exchanges=EXCHANGES, total_exchanges=2, is_fallback=True)
+            )
+            ConversationSession.objects.filter(pk=session.pk).update(created_at=timezone.now() - timedelta(days=days))
+        call_command('refill_dialogue_pool', size=4, low_water=2, custom_size=2, recent_days=7, stdout=StringIO())
+        self.assertEqual(Dialogue.pooled(self.topic).count(), 4)
+        self.assertEqual(Dialogue.pooled(used).count(), 2)
+        self.assertFalse(Dialogue.pooled(unused).exists())
+        self.assertFalse(Dialogue.pooled(stale).exists())
+
+    def test_failed_generation_is_not_pooled(self):
+        stderr = StringIO()
+        with mock.patch.object(StubConversationAI, 'generate_conversation', side_effect=ValueError('quota')):
+            call_command('refill_dialogue_pool', size=2, low_water=1, stdout=StringIO(), stderr=stderr)
+        self.assertFalse(self.topic.dialogues.exists())
+        self.assertIn('quota', stderr.getvalue())
+
+    def test_fallback_is_served_but_not_pooled(self):
+        self.client.force_login(self.user)
+        with mock.patch.object(StubConversationAI, 'generate_conversation', side_effect=ValueError('quota')):
+            response = self.client.post(
+                f'/room/{self.room.id}/topic/', data={'topic': 'favorite food'}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        dialogue = self.room.conversation_sessions.get().dialogue
+        self.assertTrue(dialogue.is_fallback)
+        self.assertIsNone(Dialogue.least_recently_used(self.topic, self.user))
+
+        # The pool still counts as empty, so the next refill fills it
+        call_command('refill_dialogue_pool', size=2, low_water=1, stdout=StringIO())
+        self.assertEqual(Dialogue.pooled(self.topic).count(), 2)
+
+    def test_least_recently_used_per_user(self):
+        dialogues = [
+            Dialogue.objects.create(topic=self.topic, exchanges=EXCHANGES, total_exchanges=len(EXCHANGES))
+            for _ in range(3)
+        ]
+        ConversationSession.objects.create(room=self.room, dialogue=dialogues[1])
+        ConversationSession.objects.create(room=self.room, dialogue=dialogues[0])
+        with self.assertNumQueries(1):
+            self.assertEqual(Dialogue.least_recently_used(self.topic, self.user), dialogues[2])
+        ConversationSession.objects.create(room=self.room, dialogue=dialogues[2])
+        self.assertEqual(Dialogue.least_recently_used(self.topic, self.user), dialogues[1])
+
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        self.assertEqual(Dialogue.least_recently_used(self.topic, other), dialogues[0])
+        self.assertIsNone(Dialogue.least_recently_used(ConversationTopic.objects.create(name='empty'), self.user))
+
+    def test_topic_view_uses_pool(self):
+        pooled = Dialogue.objects.create(topic=self.topic, exchanges=EXCHANGES, total_exchanges=len(EXCHANGES))
+        self.client.force_login(self.user)
+        with mock.patch('teaching.views.get_conversation_ai') as get_ai:
+            response = self.client.post(
+                f'/room/{self.room.id}/topic/', data={'topic': 'favorite food'}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        get_ai.assert_not_called()
+        self.assertEqual(response.json()['expected_response'], EXCHANGES[0]['user_should_say'])
+        self.assertEqual(self.room.conversation_sessions.get().dialogue, pooled)
+
+        # An empty pool falls back to generating on the request
+        response = self.client.post(
+            f'/room/{self.room.id}/topic/', data={'topic': 'weekend plans'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Dialogue.objects.filter(topic__name='weekend plans').count(), 1)
+
+
+@override_settings(
+    CONVERSATION_AI_RETRIES=1, CONVERSATION_AI_BACKOFF=0, CONVERSATION_AI_TIMEOUT=5,
+    CONVERSATION_AI_BREAKER_THRESHOLD=2, CONVERSATION_AI_BREAKER_RESET=60,
+)
+class ConversationAIClientTests(SimpleTestCase):
+    def setUp(self):
+        tracing.reset()
+        self.addCleanup(tracing.reset)
+        conversation_ai.reset()
+        self.addCleanup(conversation_ai.reset)
+        for patcher in (
+            mock.patch.dict(os.environ, {'GEMINI_API_KEY': 'key'}),
+            mock.patch('google.generativeai.configure'),
+            mock.patch('google.generativeai.GenerativeModel'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.ai = ConversationAI()
+        self.generate = self.ai.model.generate_content
+
+    def response(self, exchanges=EXCHANGES):
+        return mock.Mock(text=json.dumps(exchanges))
+
+    def test_client_is_shared(self):
+        with override_settings(CONVERSATION_AI_BACKEND='core.utils.conversation_ai.ConversationAI'):
+            self.assertIs(conversation_ai.get_conversation_ai(), conversation_ai.get_conversation_ai())
+        with override_settings(CONVERSATION_AI_BACKEND=STUB_AI):
+            self.assertIsInstance(conversation_ai.get_conversation_ai(), StubConversationAI)
+
+    def test_retries_then_succeeds(self):
+        self.generate.side_effect = [TimeoutError('deadline exceeded'), self.response()]
+        self.assertEqual(self.ai.generate_conversation('greetings', 2, 'easy', fallback=False), EXCHANGES)
+        self.assertEqual(self.generate.call_count, 2)
+        self.assertEqual(self.generate.call_args.kwargs['request_options'], {'timeout': 5})
+        self.assertEqual(self.ai.breaker.state, 'closed')
+
+    def test_open_breaker_serves_fallback_without_calling(self):
+        self.generate.side_effect = TimeoutError('deadline exceeded')
+        fallback = self.ai.get_fallback_conversation('favorite food', 5, 'easy')
+        self.assertEqual(self.ai.generate_conversation('favorite food', 5, 'easy'), fallback)
+        self.assertEqual(self.ai.breaker.state, 'open')
+
+        self.generate.reset_mock()
+        self.assertEqual(self.ai.generate_conversation('favorite food', 5, 'easy'), fallback)
+        self.generate.assert_not_called()
+        with self.assertRaises(CircuitOpen):
+            self.ai.generate_conversation('favorite food', 5, 'easy', fallback=False)
+
+        metrics = tracing.render_prometheus()
+        self.assertIn('english_teaching_conversation_ai_breaker_state 2', metrics)
+        self.assertIn('english_teaching_conversation_ai_calls_total{outcome="error"} 2', metrics)
+        self.assertIn('english_teaching_conversation_ai_calls_total{outcome="short_circuited"} 2', metrics)
+        self.assertIn('english_teaching_stage_seconds_count{stage="ai_call"} 2', metrics)
+
+    def test_half_open_trial_closes_breaker(self):
+        self.generate.side_effect = TimeoutError('deadline exceeded')
+        self.ai.generate_conversation('greetings', 2, 'easy')
+        self.ai.breaker.reset_timeout = 0
+        self.generate.side_effect = [self.response()]
+        self.assertEqual(self.ai.generate_conversation('greetings', 2, 'easy'), EXCHANGES)
+        self.assertEqual(self.ai.breaker.state, 'closed')
+        self.assertIn('english_teaching_conversation_ai_breaker_state 0', tracing.render_prometheus())
+
+    def test_streams_first_exchange(self):
+        text = '```json\n' + json.dumps(EXCHANGES) + '\n```'
+        self.generate.side_effect = [TimeoutError('deadline exceeded'), [mock.Mock(text=text[i:i + 5]) for i in range(0, len(text), 5)]]
+        stream = self.ai.stream_conversation('greetings', 2, 'easy', fallback=False)
+        self.assertEqual(next(stream), EXCHANGES[0])
+        self.assertTrue(self.generate.call_args.kwargs['stream'])
+        self.assertEqual(list(stream), EXCHANGES[1:])
+        self.assertIn('english_teaching_stage_seconds_count{stage="ai_first_exchange"} 1', tracing.render_prometheus())
+
+    def test_stream_falls_back_before_first_exchange(self):
+        self.generate.side_effect = TimeoutError('deadline exceeded')
+        fallback = self.ai.get_fallback_conversation('greetings', 2, 'easy')
+        self.assertEqual(list(self.ai.stream_conversation('greetings', 2, 'easy')), fallback)
+
+
+class IterArrayItemsTests(SimpleTestCase):
+    def items(self, text, size):
+        return list(iter_array_items(text[i:i + size] for i in range(0, len(text), size)))
+
+    def test_any_chunking(self):
+        values = [{'a': 'x, "y" ] }', 'b': [1, {'c': None}]}, 'say \\"hi\\"', 3, True, [], {}]
+        text = 'Here you go:\n' + json.dumps(values) + ' trailing'
+        for size in (1, 2, 3, 7, 1000):
+            self.assertEqual(self.items(text, size), values)
+        self.assertEqual(self.items('[]', 1), [])
+
+    def test_malformed(self):
+        for text in ('[{"a": 1}, {"b": ', '[{"a": 1}}]', '[{"a": nope}]', 'no array'):
+            with self.assertRaises(ValueError):
+                self.items(text, 3)
+
+
+@override_settings(
+    BACKGROUND_JOB_WORKERS=0,
+    CONVERSATION_AI_BACKEND=STUB_AI,
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+)
+class StreamingDialogueTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('student', 'student@example.com', 'password')
+        UserProgress.objects.create(user=self.user)
+        self.room = Room.objects.create(user=self.user)
+        self.topic = ConversationTopic.objects.create(name='Greetings', difficulty_level='easy')
+        self.client.force_login(self.user)
+        expected_index.clear()  # dialogue ids are reused between tests
+        self.addCleanup(expected_index.clear)
+
+    def test_first_exchange_is_stored_before_the_rest(self):
+        seen = []
+
+        def on_first_exchange(dialogue):
+            stored = Dialogue.objects.get(pk=dialogue.pk)
+            seen.append((len(stored.exchanges), stored.is_streaming))
+
+        with mock.patch.object(StubConversationAI, 'generate_conversation', return_value=EXCHANGES):
+            dialogue = Dialogue.generate_streaming(self.topic, StubConversationAI(), on_first_exchange)
+        self.assertEqual(seen, [(1, True)])
+        dialogue.refresh_from_db()
+        self.assertEqual((dialogue.exchanges, dialogue.total_exchanges, dialogue.is_streaming), (EXCHANGES, 2, False))
+
+    def test_failure_before_first_exchange_is_not_pooled(self):
+        with mock.patch.object(StubConversationAI, 'generate_conversation', side_effect=ValueError('quota')):
+            job_id = jobs.submit(generate_conversation_job, self.room.id, self.topic.id)
+        self.assertEqual(jobs.get_status(job_id)['status'], 'ready')
+        self.assertTrue(self.room.conversation_sessions.get().dialogue.is_fallback)
+        self.assertFalse(Dialogue.pooled(self.topic).exists())
+
+    def test_job_publishes_on_first_exchange(self):
+        notified = []
+
+        def stream(*args, **kwargs):
+            yield EXCHANGES[0]
+            self.assertEqual(len(notified), 1)  # the student can start before the rest is written
+            yield EXCHANGES[1]
+
+        with mock.patch.object(StubConversationAI, 'stream_conversation', side_effect=stream):
+            job_id = jobs.submit(generate_conversation_job, self.room.id, self.topic.id,
+                                 notify=lambda job_id, status: notified.append(status))
+        self.assertEqual(len(notified), 1)
+        status = jobs.get_status(job_id)
+        self.assertEqual(status['status'], 'ready')
+        self.assertEqual(status['result']['expected_response'], EXCHANGES[0]['user_should_say'])
+        self.assertEqual(self.room.conversation_sessions.get().dialogue.total_exchanges, 2)
+
+    def test_answer_waits_for_pending_exchange(self):
+        dialogue = Dialogue.objects.create(topic=self.topic, exchanges=EXCHANGES[:1], total_exchanges=2, is_streaming=True)
+        session = ConversationSession.objects.create(room=self.room, dialogue=dialogue)
+        self.assertEqual(expected_index.get_expected(dialogue, 1), None)
+
+        send = lambda: self.client.post(
+            f'/room/{self.room.id}/send/', data={'content': 'I am fine thank you'}, content_type='application/json'
+        )
+        response = send()
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '2'))
+        self.assertFalse(Message.objects.filter(room=self.room).exists())
+
+        Dialogue.objects.filter(pk=dialogue.pk).update(exchanges=EXCHANGES)
+        response = send()
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json().get('conversation_completed'))
+        session.refresh_from_db()
+        self.assertEqual(session.current_exchange_index, 1)
+        dialogue.refresh_from_db()
+        self.assertEqual(expected_index.get_expected(dialogue, 1).text, EXCHANGES[1]['user_should_say'])
+
+
+@override_settings(
+    BACKGROUND_JOB_WORKERS=0,
+    CONVERSATION_AI_BACKEND=STUB_AI,
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+)
+class TopicJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('student', 'student@example.com', 'password')
+        UserProgress.objects.create(user=self.user)
+        self.room = Room.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def start(self, topic):
+        return self.client.post(
+            f'/room/{self.room.id}/topic/', data={'topic': topic, 'async': True}, content_type='application/json'
+        )
+
+    def test_empty_pool_returns_job(self):
+        response = self.start('my cat')
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertTrue(job['pending'])
+
+        with override_settings(QUERY_BUDGET_MODE='raise'):
+            status = self.client.get(job['status_url']).json()
+        self.assertEqual(status['status'], 'ready')
+        self.assertTrue(BackgroundJob.objects.filter(pk=job['job_id'], status='ready').exists())
+        session = self.room.conversation_sessions.get()
+        self.assertEqual(status['expected_response'], session.get_current_exchange()['user_should_say'])
+        self.assertEqual(self.client.get(f'/room/{self.room.id}/topic/jobs/unknown/').status_code, 404)
+
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        other_room = Room.objects.create(user=other)
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(f'/room/{other_room.id}/topic/jobs/{job["job_id"]}/').status_code, 404)
+
+    def test_pooled_topic_starts_immediately(self):
+        topic = ConversationTopic.objects.create(name='Greetings')
+        Dialogue.objects.create(topic=topic, exchanges=EXCHANGES, total_exchanges=len(EXCHANGES))
+        response = self.start('Greetings')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['expected_response'], EXCHANGES[0]['user_should_say'])
+
+    def test_failed_job(self):
+        with mock.patch.object(StubConversationAI, 'generate_conversation', side_effect=ValueError('quota')), \
+                mock.patch.object(StubConversationAI, 'get_fallback_conversation', side_effect=ValueError('no dialogue')):
+            job = self.start('my cat').json()
+        status = self.client.get(job['status_url']).json()
+        self.assertEqual((status['status'], status['error']), ('failed', 'no dialogue'))
+        self.assertFalse(self.room.conversation_sessions.exists())
+
+    def test_stale_pending_job_fails(self):
+        job = self.start('my cat').json()
+        BackgroundJob.objects.filter(pk=job['job_id']).update(status='pending', result=None)
+        self.assertEqual(self.client.get(job['status_url']).json()['status'], 'pending')
+
+        BackgroundJob.objects.filter(pk=job['job_id']).update(updated_at=timezone.now() - timedelta(seconds=301))
+        status = self.client.get(job['status_url']).json()
+        self.assertEqual((status['status'], status['error']), ('failed', 'Job timed out'))
+
+
+
+class TopicCacheTests(TestCase):
+    def setUp(self):
+        topic_cache.clear()
+        self.addCleanup(topic_cache.clear)
+        tracing.reset()
+        self.addCleanup(tracing.reset)
+
+    def test_normalize(self):
+        for name in ('Favorite Food', 'favorite  food ', 'favorite foods', 'FAVORITE FOOD!', 'my favourite foods', 'Food, favorite'):
+            self.assertEqual(topic_cache.normalize_topic(name), 'favorite food')
+        self.assertEqual(topic_cache.normalize_topic("My hobbies & Mother's Day"), 'day hobby mother')
+        self.assertEqual(topic_cache.normalize_topic('news about boxes'), 'box news')
+        self.assertEqual(topic_cache.normalize_topic('the'), 'the')
+
+    def test_ies_plurals(self):
+        for plural, singular in (('movies', 'movie'), ('cookies', 'cookie'), ('pies', 'pie'), ('hobbies', 'hobby'), ('cities', 'city')):
+            self.assertEqual(topic_cache.normalize_topic(plural), singular)
+            self.assertEqual(topic_cache.normalize_topic(singular), singular)
+
+    def test_near_duplicates_share_a_topic(self):
+        topic, created = topic_cache.get_or_create_topic('Favorite Food', difficulty_level='easy')
+        self.assertTrue(created)
+        for name in ('favorite food ', 'favourite foods', 'My favourite food'):
+            self.assertEqual(topic_cache.get_or_create_topic(name), (topic, False))
+        self.assertEqual(topic_cache.get_or_create_topic('my car')[1], True)
+        self.assertEqual(topic_cache.get_or_create_topic('my cat')[1], True)
+        self.assertEqual(ConversationTopic.objects.count(), 3)
+
+        stats = topic_cache.stats()
+        self.assertEqual((stats['exact'], stats['fuzzy'], stats['miss']), (3, 0, 3))
+        self.assertEqual((stats['hit_rate'], stats['index_loads']), (0.5, 0))
+        self.assertIn('english_teaching_topic_lookups_total{outcome="exact"} 3', tracing.render_prometheus())
+
+    @override_settings(TOPIC_MATCH_THRESHOLD=95)
+    def test_fuzzy_matches_typos_only(self):
+        food = ConversationTopic.objects.create(name='favorite food')
+        for name in ('buying a car', 'online shopping', 'a day at the beach'):
+            ConversationTopic.objects.create(name=name)
+        self.assertEqual(topic_cache.find_topic('my favrite food'), food)
+        for name in ('buying a cat', 'favorite mood', 'online shipping', 'a day at the bench', 'favorite food recipe'):
+            self.assertIsNone(topic_cache.find_topic(name), name)
+        stats = topic_cache.stats()
+        self.assertEqual((stats['fuzzy'], stats['miss'], stats['index_loads']), (1, 5, 1))
+
+    def test_only_active_topics_match(self):
+        ConversationTopic.objects.create(name='Favorite Food', is_active=False)
+        ConversationTopic.objects.create(name='Favourite Foods', is_active=False)
+        self.assertIsNone(topic_cache.find_topic('favorite food'))
+        self.assertIsNone(topic_cache.find_topic('favourite food'))
+
+    @override_settings(CONVERSATION_AI_BACKEND=STUB_AI)
+    def test_similar_names_match_reachable_difficulties_only(self):
+        seeded = ConversationTopic.objects.create(name='travel experiences', difficulty_level='medium')
+        self.assertIsNone(topic_cache.find_topic('Travel Experience', difficulties=['easy']))
+        self.assertIsNone(topic_cache.find_topic('travel experiance', difficulties=['easy']))
+        self.assertEqual(topic_cache.find_topic('Travel Experience', difficulties=['easy', 'medium']), seeded)
+        # The exact name still finds it, and TopicView refuses it as before
+        self.assertEqual(topic_cache.find_topic('travel experiences', difficulties=['easy']), seeded)
+
+        user = User.objects.create_user('student', 'student@example.com', 'password')
+        UserProgress.objects.create(user=user)
+        room = Room.objects.create(user=user)
+        self.client.force_login(user)
+        response = self.client.post(
+            f'/room/{room.id}/topic/', data={'topic': 'travel experience'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ConversationTopic.objects.get(name='travel experience').difficulty_level, 'easy')
+
+    @override_settings(TOPIC_MATCH_THRESHOLD=95, TOPIC_CACHE_SIZE=1)
+    def test_created_topics_are_indexed(self):
+        self.assertTrue(topic_cache.get_or_create_topic('Favorite Food')[1])  # loads the (empty) index
+        self.assertTrue(topic_cache.get_or_create_topic('weekend plans')[1])
+        self.assertEqual(topic_cache.find_topic('weekend plasn').name, 'weekend plans')
+        stats = topic_cache.stats()
+        self.assertEqual((stats['size'], stats['evictions'], stats['index_loads']), (1, 1, 1))
+
+    def test_index_is_bounded_and_reloaded(self):
+        for name in ('travel', 'music', 'sports'):
+            ConversationTopic.objects.create(name=name)
+        with override_settings(TOPIC_CACHE_SIZE=2):
+            self.assertEqual([key for _, (key, _) in topic_cache._index_items()], ['music', 'sports'])
+        ConversationTopic.objects.create(name='weather')
+        with mock.patch.object(topic_cache, 'INDEX_MAX_AGE', 0):
+            self.assertIn('weather', [key for _, (key, _) in topic_cache._index_items()])
+        self.assertEqual(topic_cache.stats()['index_loads'], 2)
+
+    @override_settings(CONVERSATION_AI_BACKEND=STUB_AI)
+    def test_topic_view_reuses_pool(self):
+        user = User.objects.create_user('student', 'student@example.com', 'password')
+        UserProgress.objects.create(user=user)
+        room = Room.objects.create(user=user)
+        topic = ConversationTopic.objects.create(name='Weekend Plans')
+        Dialogue.objects.create(topic=topic, exchanges=EXCHANGES, total_exchanges=len(EXCHANGES))
+        self.client.force_login(user)
+        with mock.patch.object(StubConversationAI, 'generate_conversation') as generate:
+            response = self.client.post(
+                f'/room/{room.id}/topic/', data={'topic': 'weekend plan'}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        generate.assert_not_called()
+        self.assertEqual(room.conversation_sessions.get().dialogue.topic, topic)
+        self.assertEqual(ConversationTopic.objects.count(), 1)
+
+class TracingTests(TestCase):
+    def setUp(self):
+        tracing.reset()
+        self.addCleanup(tracing.reset)
+        self.user = User.objects.create_user('student', 'student@example.com', 'password')
+        UserProgress.objects.create(user=self.user)
+        self.room = Room.objects.create(user=self.user)
+        topic = ConversationTopic.objects.create(name='Greetings')
+        dialogue = Dialogue.objects.create(topic=topic, exchanges=EXCHANGES, total_exchanges=len(EXCHANGES))
+        ConversationSession.objects.create(room=self.room, dialogue=dialogue)
+        self.client.force_login(self.user)
+
+    def send(self, text):
+        return self.client.post(
+            f'/room/{self.room.id}/send/', data={'content': text}, content_type='application/json'
+        )
+
+    def test_disabled_by_default(self):
+        response = self.send("I am fine thank you")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+        self.assertNotIn('stage="scoring"', tracing.render_prometheus())
+
+    @override_settings(TRACING_ENABLED=True, METRICS_TOKEN='secret')
+    def test_server_timing_and_metrics(self):
+        response = self.send("I am fine thank you")
+        self.assertEqual(response.status_code, 200)
+        stages = [part.split(';')[0] for part in response['Server-Timing'].split(', ')]
+        for stage in ('message_view', 'scoring', 'word_comparison', 'save_answer', 'db', 'total'):
+            self.assertIn(stage, stages)
+
+        self.client.logout()
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        metrics = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(metrics.status_code, 200)
+        body = metrics.content.decode()
+        self.assertIn('english_teaching_stage_seconds_bucket{stage="scoring",le="+Inf"} 1', body)
+        self.assertIn('english_teaching_stage_seconds_count{stage="request"}', body)
+
+    def test_worker_spans_are_replayed(self):
+        with tracing.collect() as spans:
+            value = tracing.unwrap(tracing.TracedResult('text', [('whisper', 0.2)]))
+        self.assertEqual(value, 'text')
+        self.assertEqual(spans, [('whisper', 0.2)])
+        self.assertEqual(tracing.server_timing(spans + [('whisper', 0.1)]), 'whisper;dur=300.0;desc="x2"')
+
+
+class BenchmarkFlowTests(SimpleTestCase):
+    def test_summary_percentiles(self):
+        from .management.commands.benchmark_flow import summarize
+
+        summary = summarize([i / 1000 for i in range(1, 101)], wall_time=2.0, queries=[3, 5])
+        self.assertEqual((summary['p50_ms'], summary['p95_ms'], summary['p99_ms']), (50, 95, 99))
+        self.assertEqual(summary['throughput_rps'], 50)
+        self.assertEqual((summary['queries_mean'], summary['queries_max']), (4, 5))
+        self.assertIsNone(summarize([])['p50_ms'])
+
+    def test_fixtures_and_stub(self):
+        from core.utils.audio_guard import decode_checked
+        from .management.commands.benchmark_flow import FIXTURES, synthetic_wav
+
+        for seconds, frequency in FIXTURES:
+            self.assertAlmostEqual(len(decode_checked(synthetic_wav(seconds, frequency))) / 16000, seconds, places=2)
+        exchanges = StubConversationAI().generate_conversation('weekend plans', num_exchanges=5, difficulty='easy')
+        self.assertTrue(exchanges[0]['user_should_say'])
+
+
+    def test_whisper_benchmark_bypasses_transcription_cache(self):
+        from django.core.cache import caches
+
+        module = 'teaching.management.commands.benchmark_whisper'
+        backends = []
+        with tempfile.TemporaryDirectory() as directory:
+            open(os.path.join(directory, 'clip.wav'), 'wb').close()
+            with mock.patch(f'{module}.load_audio', return_value=np.zeros(16000, dtype=np.float32)), \
+                    mock.patch(f'{module}.get_model'), \
+                    mock.patch(f'{module}.transcribe_audio', side_effect=lambda *args: backends.append(
+                        caches['transcriptions'].__class__.__name__) or 'hello'):
+                call_command('benchmark_whisper', directory, modes='baseline', repeat=2, stdout=StringIO())
+                self.assertEqual(backends, ['DummyCache', 'DummyCache'])
+                backends.clear()
+                call_command('benchmark_whisper', directory, modes='baseline', transcription_cache=True, stdout=StringIO())
+                self.assertNotEqual(backends, ['DummyCache'])
+
+@override_settings(QUERY_BUDGET_MODE='raise', QUERY_BUDGET_REPEAT_LIMIT=3, CONVERSATION_AI_BACKEND=STUB_AI)
+class QueryBudgetTests(TestCase):
+    """Every view in teaching/urls.py declares a query budget; the flows below fail if one is exceeded or has an N+1."""
+
+    def setUp(self):
+        teacher_user = User.objects.create_user('teacher', 'teacher@example.com', 'password', is_staff=True)
+        self.teacher = Teacher.objects.create(user=teacher_user, name='Teacher', email='teacher@example.com')
+        self.referral = TeacherReferral.objects.create(teacher=self.teacher, name='Class A')
+        # Enough students, rooms and answers that any per-row query shows up as a repeat
+        for i in range(4):
+            student = User.objects.create_user(f'student{i}', f'student{i}@example.com', 'password')
+            UserProgress.objects.create(user=student)
+            StudentEnrollment.objects.create(user=student, referral=self.referral)
+            room = Room.objects.create(user=student)
+            for score in (40, 60, 95):
+                Message.objects.create(room=room, role='user', content='answer', spelling_score=score)
+        self.student = User.objects.get(username='student0')
+        self.room = Room.objects.filter(user=self.student).first()
+
+    def test_every_view_declares_a_budget(self):
+        for pattern in urlpatterns:
+            view_class = getattr(pattern.callback, 'view_class', None)
+            if view_class is None:
+                self.assertIsNotNone(budget_of(pattern.callback), pattern.name)
+                continue
+            for method in view_class.http_method_names:
+                if method != 'options' and hasattr(view_class, method):
+                    self.assertIsNotNone(budget_of(view_class, method), f'{pattern.name} {method}')
+
+    def test_student_flow(self):
+        self.client.force_login(self.student)
+        self.assertEqual(self.client.get('/').status_code, 200)
+        response = self.client.post(
+            f'/room/{self.room.id}/topic/', data={'topic': 'weekend plans'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        expected = response.json()['expected_response']
+        self.assertEqual(self.client.get(f'/room/{self.room.id}/').status_code, 200)
+
+        # A retry, then correct answers through to the end of the conversation
+        response = self.client.post(f'/room/{self.room.id}/send/', data={'content': 'no idea'}, content_type='application/json')
+        self.assertTrue(response.json()['needs_retry'])
+        for _ in range(20):
+            response = self.client.post(f'/room/{self.room.id}/send/', data={'content': expected}, content_type='application/json')
+            data = response.json()
+            if data.get('conversation_completed'):
+                break
+            expected = data['expected_response']
+        self.assertTrue(data.get('conversation_completed'))
+        self.assertEqual(self.client.get(f'/room/{self.room.id}/').status_code, 200)
+        self.assertEqual(self.client.post('/', data={'title': 'Another'}).status_code, 302)
+
+    def test_teacher_and_admin_pages(self):
+        self.client.force_login(self.teacher.user)
+        self.assertEqual(self.client.get('/teacher/').status_code, 200)
+        response = self.client.get(f'/teacher/referral/{self.referral.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['student_stats']), 4)
+        self.assertEqual(response.context['student_stats'][0]['total_attempts'], 3)
+        self.assertEqual(response.context['student_stats'][0]['avg_score'], 65)
+
+        response = self.client.get('/score-analytics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['top_performers']), 4)
+        self.assertEqual(self.client.get('/transcription-cache/stats/').status_code, 200)
+        self.assertEqual(self.client.get('/topic-cache/stats/').status_code, 200)
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+        self.assertEqual(self.client.post('/teacher/create-referral/', data={'name': 'Class B'}).status_code, 302)
+        self.assertEqual(self.client.post(f'/teacher/referral/{self.referral.id}/toggle/').status_code, 302)
+
+    def test_account_pages(self):
+        self.assertEqual(self.client.get('/login/').status_code, 200)
+        self.assertEqual(self.client.post('/login/', data={'email': 'student1', 'password': 'password'}).status_code, 302)
+        self.assertEqual(self.client.get('/logout/').status_code, 302)
+        self.assertEqual(self.client.post('/signup/', data={
+            'name': 'New Student', 'email': 'student1@example.org', 'password': 'password', 'password_confirm': 'password',
+        }).status_code, 302)
+        self.client.logout()
+        self.assertEqual(self.client.post('/teacher/signup/', data={
+            'name': 'New Teacher', 'username': 'newteacher', 'email': 'new@example.com',
+            'password': 'password', 'password_confirm': 'password',
+        }).status_code, 302)
+        self.assertEqual(self.client.get('/test-csrf/').status_code, 200)
+
+    def test_over_budget_and_repeats_raise(self):
+        @query_budget(1)
+        def view():
+            for room in Room.objects.all():
+                room.user.username  # lazy foreign key per row
+            return 'ok'
+
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            view()
+        self.assertIn('5 queries, budget 1', str(raised.exception))
+        self.assertIn('N+1: 4x', str(raised.exception))
+
+        with QueryRecorder() as recorder:
+            list(Room.objects.filter(id__in=[1, 2, 3]))
+            list(Room.objects.filter(id__in=[4]))
+        self.assertEqual(len(recorder), 2)
+        self.assertEqual(recorder.repeated(limit=2), {sql_shape(recorder.queries[0]): 2})
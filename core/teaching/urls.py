@@ -1,6 +1,6 @@
 from django.urls import path
-from .views import RoomView, MessageView, TopicView, login_view, signup_view, logout_view, test_csrf
-from .admin_views import ScoreAnalyticsView
+from .views import RoomView, MessageView, TopicView, TopicJobView, login_view, signup_view, logout_view, test_csrf
+from .admin_views import MetricsView, ScoreAnalyticsView, TopicCacheStatsView, TranscriptionCacheStatsView
 from .teacher_views import TeacherDashboardView, CreateReferralView, ReferralDetailView, ToggleReferralView, teacher_signup_view
 
 urlpatterns = [
@@ -8,11 +8,15 @@ urlpatterns = [
     path('room/<int:room_id>/', RoomView.as_view(), name='room'),  # Specific room view
     path('room/<int:room_id>/send/', MessageView.as_view(), name='send_message'),
     path('room/<int:room_id>/topic/', TopicView.as_view(), name='generate_topic'),
+    path('room/<int:room_id>/topic/jobs/<str:job_id>/', TopicJobView.as_view(), name='topic_job'),
     path('login/', login_view, name='login'),
     path('signup/', signup_view, name='signup'),
     path('logout/', logout_view, name='logout'),
     path('test-csrf/', test_csrf, name='test_csrf'),
     path('score-analytics/', ScoreAnalyticsView.as_view(), name='score_analytics'),
+    path('transcription-cache/stats/', TranscriptionCacheStatsView.as_view(), name='transcription_cache_stats'),
+    path('topic-cache/stats/', TopicCacheStatsView.as_view(), name='topic_cache_stats'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     # Teacher URLs
     path('teacher/', TeacherDashboardView.as_view(), name='teacher_dashboard'),
     path('teacher/create-referral/', CreateReferralView.as_view(), name='create_referral'),
@@ -1,25 +1,62 @@
 from django.views import View
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.http import JsonResponse
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.utils import timezone
+from django.conf import settings
+from django.db import transaction
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from .models import Room, Message, ConversationTopic, Dialogue, ConversationSession, UserProgress, Teacher
-from core.utils.whisper import transcribe_audio
-from core.utils.conversation_ai import ConversationAI
+from core.utils.audio_guard import AudioRejected, check_upload
+from core.utils.transcription_pool import transcribe, score, TranscriptionQueueFull, TranscriptionTimeout
+from core.utils.conversation_ai import get_conversation_ai
+from core.utils.expected_index import compile_dialogue, get_expected
+from core.utils import jobs, topic_cache
 import json
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.models import User
 from django.views.decorators.http import require_http_methods
-import tempfile
-import os
 import random
-from core.utils.levenshtein import levenshtein_distance
+import time
+from core.utils.alignment import compare_words
+from core.utils.scoring import score_answer, scoring_mode
+from core.utils.query_budget import query_budget
+from core.utils import tracing
+from core.utils.tracing import span, traced
+
+
+class AnswerConflict(Exception):
+    """The session moved past the answered exchange before the answer was stored (e.g. a double submit)."""
+
+
+class ExchangePending(Exception):
+    """The answer was right but the next exchange of a streamed dialogue has not been written yet."""
+
+
+def transcribe_answer(audio_bytes, expected_response):
+    """
+    Run speech recognition on a recorded answer. Returns (transcript, score,
+    word_comparison); score and word_comparison are None unless the scoring
+    engine produced them itself. Raises AudioRejected, TranscriptionQueueFull
+    or TranscriptionTimeout.
+    """
+    # Refuse empty, oversized or over-long uploads before they reach a worker
+    check_upload(audio_bytes)
+    if settings.SCORING_ENGINE == 'forced':
+        # Score the audio directly against the expected sentence
+        result = score(audio_bytes, expected_response)
+        return result['transcript'], result['score'], result['word_comparison']
+    # Convert audio to text using Whisper in the transcription worker pool
+    return transcribe(audio_bytes, expected_response), None, None
 
 class RoomView(LoginRequiredMixin, View):
     template_name = 'room.html'
 
+    @query_budget(6)
     def get(self, request, room_id=None):
         # Get or create user progress
         user_progress, created = UserProgress.objects.get_or_create(user=request.user)
@@ -42,10 +79,10 @@ class RoomView(LoginRequiredMixin, View):
                 user=request.user
             )
             # Get last 50 messages ordered by creation time
-            messages = room.messages.all().order_by('-created_at')[:100][::-1]
+            messages = room.messages.all().order_by('-created_at', '-id')[:100][::-1]
             
             # Get current conversation session if any
-            current_session = room.conversation_sessions.filter(is_completed=False).first()
+            current_session = room.conversation_sessions.select_related('dialogue').filter(is_completed=False).first()
         else:
             # No room selected, show welcome state
             room = None
@@ -67,17 +104,98 @@ class RoomView(LoginRequiredMixin, View):
             'current_session': current_session,
             'current_expected_response': current_expected_response,
             'user_progress': user_progress,
+            'websocket_url': settings.WEBSOCKET_URL,
         })
 
+    @query_budget(1)
     def post(self, request):
         # Create new room
         title = request.POST.get('title', 'New Chat')
         room = Room.objects.create(user=request.user, title=title)
         return redirect('room', room_id=room.id)
 
+def start_conversation(room, topic, dialogue):
+    """
+    Start `dialogue` in the room, ending any conversation in progress there.
+    Returns the response payload, or None if the dialogue has no exchanges.
+    """
+    compile_dialogue(dialogue)
+    
+    # End any existing conversation sessions in this room
+    ConversationSession.objects.filter(room=room, is_completed=False).update(is_completed=True)
+    
+    # Create new conversation session
+    session = ConversationSession.objects.create(
+        room=room,
+        dialogue=dialogue,
+        current_exchange_index=0
+    )
+    
+    # Get the first exchange
+    first_exchange = session.get_current_exchange()
+    if not first_exchange:
+        return None
+    
+    # Create the initial bot message
+    Message.objects.create(
+        room=room,
+        role='assistant',
+        content=first_exchange['bot_says'],
+        conversation_session=session,
+        original_text=first_exchange['user_should_say']  # What user should say
+    )
+    
+    return {
+        'success': True,
+        'message': 'New conversation started!',
+        'bot_message': first_exchange['bot_says'],
+        'expected_response': first_exchange['user_should_say'],
+        'exchange_number': first_exchange['exchange_number'],
+        'total_exchanges': dialogue.total_exchanges,
+        'difficulty_level': topic.get_difficulty_level_display()
+    }
+
+
+def generate_conversation_job(room_id, topic_id):
+    """
+    Background job: stream a dialogue for the topic and start it in the room as
+    soon as its first exchange is written; the rest is appended while the
+    student answers.
+    """
+    room = Room.objects.get(id=room_id)
+    topic = ConversationTopic.objects.get(id=topic_id)
+    start = time.perf_counter()
+
+    def on_first_exchange(dialogue):
+        jobs.publish(start_conversation(room, topic, dialogue))
+        tracing.observe('time_to_first_prompt', time.perf_counter() - start)
+
+    Dialogue.generate_streaming(topic, get_conversation_ai(), on_first_exchange)
+
+
+def notify_room(job_id, status):
+    """Tell the room's open WebSockets that a background conversation job finished."""
+    channel_layer = get_channel_layer()
+    if channel_layer is not None:
+        async_to_sync(channel_layer.group_send)(room_group(status['room_id']), {
+            'type': 'job.finished',
+            'job_id': job_id,
+            'status': status['status'],
+            'error': status.get('error'),
+            'result': status.get('result'),
+        })
+
+
+def room_group(room_id):
+    """Channel layer group of a room's WebSocket connections."""
+    return f'room_{room_id}'
+
+
 class TopicView(LoginRequiredMixin, View):
     """Handle topic-related operations"""
     
+    @query_budget(11)
+    @traced('topic_view')
     def post(self, request, room_id):
         """Generate a new conversation for a selected topic"""
         room = get_object_or_404(Room, id=room_id, user=request.user)
@@ -110,13 +228,14 @@ class TopicView(LoginRequiredMixin, View):
                 except TeacherReferral.DoesNotExist:
                     return JsonResponse({'error': 'Invalid referral code'}, status=400)
             
-            # Get or create the topic
-            topic, created = ConversationTopic.objects.get_or_create(
-                name=topic_name,
-                defaults={
-                    'description': f'Conversation about {topic_name}',
-                    'difficulty_level': user_progress.current_level
-                }
+            # Get or create the topic; near-duplicate names ("favourite foods") match an
+            # existing topic so they share its dialogue pool instead of calling the AI
+            topic, created = topic_cache.get_or_create_topic(
+                topic_name,
+                difficulties=user_progress.get_available_difficulty_levels(),
+                description=f'Conversation about {topic_name}',
+                difficulty_level=user_progress.current_level,
+                is_custom=True,
             )
             
             # Check if user has access to this topic's difficulty level
@@ -126,65 +245,49 @@ class TopicView(LoginRequiredMixin, View):
                     'error': f'You need to complete {required_convos} conversations to access {topic.get_difficulty_level_display()} level topics'
                 }, status=400)
             
-            # Generate new dialogue using AI with difficulty-appropriate parameters
-            ai = ConversationAI()
-            num_exchanges = self._get_exchanges_for_difficulty(topic.difficulty_level)
-            exchanges = ai.generate_conversation(topic_name, num_exchanges=num_exchanges, difficulty=topic.difficulty_level)
-            
-            # Create new dialogue
-            dialogue = Dialogue.objects.create(
-                topic=topic,
-                exchanges=exchanges,
-                total_exchanges=len(exchanges)
-            )
-            
-            # End any existing conversation sessions in this room
-            ConversationSession.objects.filter(room=room, is_completed=False).update(is_completed=True)
-            
-            # Create new conversation session
-            session = ConversationSession.objects.create(
-                room=room,
-                dialogue=dialogue,
-                current_exchange_index=0
-            )
-            
-            # Get the first exchange
-            first_exchange = session.get_current_exchange()
-            
-            if first_exchange:
-                # Create the initial bot message
-                Message.objects.create(
-                    room=room,
-                    role='assistant',
-                    content=first_exchange['bot_says'],
-                    conversation_session=session,
-                    original_text=first_exchange['user_should_say']  # What user should say
+            # Take the dialogue from the topic's pool (kept full by refill_dialogue_pool)
+            # that this user had longest ago; only an empty pool waits on the AI
+            dialogue = Dialogue.least_recently_used(topic, request.user)
+            if dialogue is None and data.get('async'):
+                # Generate in the background; the client polls the job (or waits for
+                # the room WebSocket's dialogue_ready event) instead of holding this worker
+                job_id = jobs.submit(
+                    generate_conversation_job, room.id, topic.id,
+                    notify=notify_room, room_id=room.id,
                 )
-                
                 return JsonResponse({
                     'success': True,
-                    'message': 'New conversation started!',
-                    'bot_message': first_exchange['bot_says'],
-                    'expected_response': first_exchange['user_should_say'],
-                    'exchange_number': first_exchange['exchange_number'],
-                    'total_exchanges': dialogue.total_exchanges,
-                    'difficulty_level': topic.get_difficulty_level_display()
-                })
-            else:
+                    'pending': True,
+                    'job_id': job_id,
+                    'status_url': reverse('topic_job', kwargs={'room_id': room.id, 'job_id': job_id}),
+                }, status=202)
+            if dialogue is None:
+                dialogue = Dialogue.generate(topic, get_conversation_ai())
+            
+            payload = start_conversation(room, topic, dialogue)
+            if payload is None:
                 return JsonResponse({'error': 'Failed to generate conversation'}, status=500)
+            return JsonResponse(payload)
                 
         except Exception as e:
             print(f"Error in TopicView: {str(e)}")
             return JsonResponse({'error': 'Failed to generate conversation'}, status=500)
+
+class TopicJobView(LoginRequiredMixin, View):
+    """Status of a background conversation job started by TopicView"""
     
-    def _get_exchanges_for_difficulty(self, difficulty_level):
-        """Get number of exchanges based on difficulty level"""
-        if difficulty_level == 'easy':
-            return 5  # Easy: 5 exchanges
-        elif difficulty_level == 'medium':
-            return 7  # Medium: 7 exchanges
-        else:  # hard
-            return 10  # Hard: 10 exchanges
+    @query_budget(2)
+    def get(self, request, room_id, job_id):
+        room = get_object_or_404(Room, id=room_id, user=request.user)
+        status = jobs.get_status(job_id)
+        if status is None or status.get('room_id') != room.id:
+            return JsonResponse({'error': 'Job not found'}, status=404)
+        return JsonResponse({
+            'job_id': job_id,
+            'status': status['status'],
+            'error': status.get('error'),
+            **(status.get('result') or {}),
+        })
 
 class MessageView(LoginRequiredMixin, View):
     """
@@ -195,123 +298,18 @@ class MessageView(LoginRequiredMixin, View):
         """Helper method to get room with proper permissions"""
         return get_object_or_404(Room, id=room_id, user=self.request.user)
 
-    def calculate_spelling_score(self, user_input, expected_text):
-        """Calculate spelling similarity score between user input and expected text."""
-        if not user_input or not expected_text:
-            return None
-            
-        # Calculate Levenshtein distance
-        distance = levenshtein_distance(user_input.lower(), expected_text.lower())
-        max_length = max(len(user_input), len(expected_text))
-        
-        # Calculate similarity score (0-100)
-        if max_length == 0:
-            return 0
-        similarity = (1 - distance / max_length) * 100
-        return round(similarity)
+    @traced('scoring')
+    def calculate_spelling_score(self, user_input, expected_text, mode='spelling'):
+        """Calculate similarity score between user input and expected text ('spelling' or 'phonetic' mode)."""
+        return score_answer(user_input, expected_text, mode)
 
-    def get_word_comparison(self, user_input, expected_text):
+    @traced('word_comparison')
+    def get_word_comparison(self, user_input, expected_text, mode='spelling'):
         """Get detailed word-by-word comparison with specific feedback."""
-        if not user_input or not expected_text:
-            return {
-                'word_analysis': [],
-                'missing_words': [],
-                'extra_words': [],
-                'incorrect_words': []
-            }
-        
-        # Clean and normalize input
-        user_input = user_input.lower().strip().replace("'", "'")  # Normalize apostrophes
-        expected_text = expected_text.lower().strip().replace("'", "'")
-        
-        # Clean and split into words
-        user_words = user_input.split()
-        expected_words = expected_text.split()
-        
-        word_analysis = []
-        incorrect_words = []
-        missing_words = []
-        extra_words = []
-        
-        # Use difflib for better word matching
-        import difflib
-        matcher = difflib.SequenceMatcher(None, user_words, expected_words)
-        
-        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-            if tag == 'equal':
-                # Words match exactly
-                for k in range(i2 - i1):
-                    word_analysis.append({
-                        'user_word': user_words[i1 + k],
-                        'expected_word': expected_words[j1 + k],
-                        'status': 'correct',
-                        'position': len(word_analysis)
-                    })
-            elif tag == 'replace':
-                # Words are different
-                for k in range(max(i2 - i1, j2 - j1)):
-                    user_word = user_words[i1 + k] if i1 + k < i2 else None
-                    expected_word = expected_words[j1 + k] if j1 + k < j2 else None
-                    
-                    if user_word and expected_word:
-                        # Check if it's a close match (similar spelling)
-                        similarity = difflib.SequenceMatcher(None, user_word, expected_word).ratio()
-                        if similarity > 0.9:  # Increased threshold for more accuracy
-                            status = 'correct'
-                        elif similarity > 0.7:  # Adjusted threshold for close matches
-                            status = 'close'
-                        else:
-                            status = 'incorrect'
-                        
-                        word_analysis.append({
-                            'user_word': user_word,
-                            'expected_word': expected_word,
-                            'status': status,
-                            'position': len(word_analysis),
-                            'similarity': round(similarity * 100)
-                        })
-                        
-                        if status != 'correct':
-                            incorrect_words.append({
-                                'user_word': user_word,
-                                'expected_word': expected_word,
-                                'position': len(word_analysis) - 1
-                            })
-                    elif expected_word:
-                        missing_words.append({
-                            'word': expected_word,
-                            'position': len(word_analysis)
-                        })
-                    elif user_word:
-                        extra_words.append({
-                            'word': user_word,
-                            'position': len(word_analysis)
-                        })
-            elif tag == 'delete':
-                # User said extra words
-                for k in range(i2 - i1):
-                    extra_words.append({
-                        'word': user_words[i1 + k],
-                        'position': len(word_analysis)
-                    })
-            elif tag == 'insert':
-                # User missed words
-                for k in range(j2 - j1):
-                    missing_words.append({
-                        'word': expected_words[j1 + k],
-                        'position': len(word_analysis)
-                    })
-        
-        return {
-            'word_analysis': word_analysis,
-            'missing_words': missing_words,
-            'extra_words': extra_words,
-            'incorrect_words': incorrect_words,
-            'total_expected_words': len(expected_words),
-            'total_user_words': len(user_words),
-            'correct_words': len([w for w in word_analysis if w['status'] == 'correct'])
-        }
+        return compare_words(user_input, expected_text, phonetic=mode == 'phonetic')
 
+    @query_budget(13)
+    @traced('message_view')
     def post(self, request, room_id=None):
         try:
             room = self.get_room(room_id)
@@ -332,6 +330,12 @@ class MessageView(LoginRequiredMixin, View):
             else:
                 return self._handle_text_message(request, room, current_session)
                 
+        except AnswerConflict:
+            return JsonResponse({'error': 'This answer was already submitted.'}, status=409)
+        except ExchangePending:
+            response = JsonResponse({'error': 'The rest of the conversation is still being written. Please try again in a moment.'}, status=503)
+            response['Retry-After'] = '2'
+            return response
         except Exception as e:
             print(f"Error in MessageView: {str(e)}")
             return JsonResponse({'error': 'Failed to process message'}, status=500)
@@ -347,40 +351,23 @@ class MessageView(LoginRequiredMixin, View):
         
         expected_response = current_exchange['user_should_say']
         
-        # Process audio file
-        temp_file = None
+        # Read the upload into memory; it is decoded straight to PCM without temp files
+        with span('upload'):
+            audio_bytes = b''.join(audio_file.chunks())
+        
         try:
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-            for chunk in audio_file.chunks():
-                temp_file.write(chunk)
-            temp_file.close()
-            
-            # Convert audio to text using Whisper
-            transcribed_text = transcribe_audio(temp_file.name)
-
-            # Calculate spelling score and get detailed comparison
-            spelling_score = self.calculate_spelling_score(transcribed_text, expected_response)
-            word_comparison = self.get_word_comparison(transcribed_text, expected_response)
-
-            # Create user message
-            user_message = Message.objects.create(
-                room=room,
-                role='user',
-                content=transcribed_text,
-                original_text=transcribed_text,
-                conversation_session=session,
-                spelling_score=spelling_score
-            )
-            
-            return self._process_user_response(transcribed_text, expected_response, spelling_score, word_comparison, room, session)
-            
-        finally:
-            # Clean up the temporary file
-            if temp_file and os.path.exists(temp_file.name):
-                try:
-                    os.unlink(temp_file.name)
-                except Exception as e:
-                    print(f"Error deleting temporary file: {str(e)}")
+            with span('transcription'):
+                transcribed_text, spelling_score, word_comparison = transcribe_answer(audio_bytes, expected_response)
+        except TranscriptionQueueFull as e:
+            response = JsonResponse({'error': 'Speech recognition is busy right now. Please try again in a few seconds.'}, status=503)
+            response['Retry-After'] = str(e.retry_after)
+            return response
+        except TranscriptionTimeout:
+            return JsonResponse({'error': 'Speech recognition took too long. Please try again.'}, status=504)
+        except AudioRejected as e:
+            return JsonResponse({'error': e.message, 'code': e.code}, status=400)
+
+        return JsonResponse(self.record_answer(room, session, transcribed_text, expected_response, spelling_score, word_comparison))
 
     def _handle_text_message(self, request, room, session):
         """Handle text message processing"""
@@ -397,24 +384,57 @@ class MessageView(LoginRequiredMixin, View):
         
         expected_response = current_exchange['user_should_say']
         
-        # Calculate spelling score and get detailed comparison
-        spelling_score = self.calculate_spelling_score(user_input, expected_response)
-        word_comparison = self.get_word_comparison(user_input, expected_response)
+        return JsonResponse(self.record_answer(room, session, user_input, expected_response))
+
+    def record_answer(self, room, session, user_input, expected_response, spelling_score=None, word_comparison=None):
+        """
+        Score an answer against the expected sentence (unless the scoring engine
+        already did), store it and return the response payload. Shared by the
+        HTTP views and the room WebSocket.
+        """
+        scoring_engine = 'forced' if word_comparison is not None else 'transcribe'
+        if word_comparison is None:
+            # Score against the dialogue's compiled expected response when it is still current
+            expected = get_expected(session.dialogue, session.current_exchange_index)
+            if expected is None or expected.text != expected_response:
+                expected = expected_response
+            # Calculate spelling (or, for some difficulties, phonetic) score and get detailed comparison
+            mode = scoring_mode(session.dialogue.topic.difficulty_level)
+            spelling_score = self.calculate_spelling_score(user_input, expected, mode)
+            word_comparison = self.get_word_comparison(user_input, expected, mode)
 
-        # Create user message
-        user_message = Message.objects.create(
+        user_message = Message(
             room=room,
             role='user',
             content=user_input,
             original_text=user_input,
             conversation_session=session,
-            spelling_score=spelling_score
+            spelling_score=spelling_score,
+            scoring_engine=scoring_engine,
         )
-        
-        return self._process_user_response(user_input, expected_response, spelling_score, word_comparison, room, session)
+        return self._process_user_response(user_message, expected_response, spelling_score, word_comparison, room, session)
+
+    def _save_answer(self, room, session, messages, advance=False):
+        """
+        Store the answer and the replies to it as one unit of work: the session
+        advances with a single conditional UPDATE and the messages go in with one
+        bulk INSERT. Raises AnswerConflict, writing nothing, if another request
+        advanced the session first. Returns whether the learner went up a level
+        (only possible when the answer completes the conversation).
+        """
+        with span('save_answer'), transaction.atomic():
+            if advance and not session.advance_from(session.current_exchange_index):
+                raise AnswerConflict()
+            Message.objects.bulk_create(messages)
+            if advance and session.is_completed:
+                # Mark conversation as completed in UserProgress
+                with span('progress'):
+                    return UserProgress.complete_conversation(room.user_id)[2]
+        return False
 
-    def _process_user_response(self, user_input, expected_response, spelling_score, word_comparison, room, session):
-        """Process the user's response and determine next action"""
+    def _process_user_response(self, user_message, expected_response, spelling_score, word_comparison, room, session):
+        """Process the user's response, determine the next action, store it and return the response payload"""
+        user_input = user_message.content
         
         # Threshold for acceptable pronunciation/spelling
         ACCEPTABLE_SCORE = 70
@@ -429,7 +449,11 @@ class MessageView(LoginRequiredMixin, View):
             if word_comparison['incorrect_words']:
                 feedback_parts.append("❌ Incorrect words:")
                 for wrong in word_comparison['incorrect_words']:
-                    feedback_parts.append(f"   • You said '{wrong['user_word']}' but should say '{wrong['expected_word']}'")
+                    if 'confidence' in wrong:
+                        # Forced-alignment scoring rates each expected word instead of transcribing
+                        feedback_parts.append(f"   • '{wrong['expected_word']}' was not clear ({wrong['confidence']}% confidence)")
+                    else:
+                        feedback_parts.append(f"   • You said '{wrong['user_word']}' but should say '{wrong['expected_word']}'")
             
             if word_comparison['missing_words']:
                 missing = [w['word'] for w in word_comparison['missing_words']]
@@ -441,109 +465,100 @@ class MessageView(LoginRequiredMixin, View):
             
             return "\n".join(feedback_parts) if feedback_parts else "Perfect match!"
         
-        if spelling_score >= ACCEPTABLE_SCORE:
+        detailed_feedback = generate_detailed_feedback()
+        feedback_content = f"🎯 YOUR RESPONSE: '{user_input}'\n📊 SCORE: {spelling_score}%\n🎯 CORRECT RESPONSE: '{expected_response}'\n\n{detailed_feedback}"
+        exchanges = session.dialogue.get_exchanges()
+        if spelling_score >= ACCEPTABLE_SCORE and session.current_exchange_index + 1 >= len(exchanges) \
+                and session.dialogue.is_streaming:
+            # Not the last exchange, just the last one written so far: look again
+            session.dialogue.refresh_from_db(fields=['exchanges', 'total_exchanges', 'is_streaming'])
+            exchanges = session.dialogue.get_exchanges()
+            if session.current_exchange_index + 1 >= len(exchanges) and session.dialogue.is_streaming:
+                raise ExchangePending()
+        
+        if spelling_score >= ACCEPTABLE_SCORE and session.current_exchange_index + 1 >= len(exchanges):
+            # Good pronunciation on the last exchange - conversation completed
+            response_content = f"{feedback_content}\n\n🎉 Excellent! You've completed the entire conversation!\n\nClick 'Generate New Conversation' to practice with a different topic."
+            
+            level_advanced = self._save_answer(room, session, [
+                user_message,
+                Message(room=room, role='assistant', content=response_content, conversation_session=session),
+            ], advance=True)
+            
+            return {
+                'success': True,
+                'conversation_completed': True,
+                'level_advanced': level_advanced,
+                'user_message': {
+                    'role': 'user',
+                    'content': user_input,
+                    'spelling_score': spelling_score
+                },
+                'assistant_message': {
+                    'role': 'assistant',
+                    'content': response_content
+                },
+                'word_comparison': word_comparison,
+                'expected_response': expected_response,
+                'current_exchange_index': session.current_exchange_index,
+                'total_exchanges': session.dialogue.total_exchanges
+            }
+        elif spelling_score >= ACCEPTABLE_SCORE:
             # Good pronunciation - advance to next exchange
-            session.advance_to_next_exchange()
-            session.save()  # Make sure to save the session
+            next_exchange = exchanges[session.current_exchange_index + 1]
+            continuation_content = f"✅ Great! Now let's continue...\n\n{next_exchange['bot_says']}"
             
-            if session.is_completed:
-                # Conversation completed
-                detailed_feedback = generate_detailed_feedback()
-                response_content = f"🎯 YOUR RESPONSE: '{user_input}'\n📊 SCORE: {spelling_score}%\n🎯 CORRECT RESPONSE: '{expected_response}'\n\n{detailed_feedback}\n\n🎉 Excellent! You've completed the entire conversation!\n\nClick 'Generate New Conversation' to practice with a different topic."
-                
-                assistant_message = Message.objects.create(
-                    room=room,
-                    role='assistant',
-                    content=response_content,
-                    conversation_session=session
-                )
-                
-                # Mark conversation as completed in UserProgress
-                user_progress = UserProgress.objects.get(user=room.user)
-                level_advanced = user_progress.increment_completed_conversations()
-                
-                return JsonResponse({
-                    'success': True,
-                    'conversation_completed': True,
-                    'level_advanced': level_advanced,
-                    'user_message': {
-                        'role': 'user',
-                        'content': user_input,
-                        'spelling_score': spelling_score
-                    },
-                    'assistant_message': {
-                        'role': 'assistant',
-                        'content': response_content
-                    },
-                    'word_comparison': word_comparison,
-                    'expected_response': expected_response,
-                    'current_exchange_index': session.current_exchange_index,
-                    'total_exchanges': session.dialogue.total_exchanges
-                })
-            else:
-                # Move to next exchange
-                next_exchange = session.get_current_exchange()
-                detailed_feedback = generate_detailed_feedback()
-                
-                # Create feedback message
-                feedback_content = f"🎯 YOUR RESPONSE: '{user_input}'\n📊 SCORE: {spelling_score}%\n🎯 CORRECT RESPONSE: '{expected_response}'\n\n{detailed_feedback}"
-                
-                feedback_message = Message.objects.create(
-                    room=room,
-                    role='assistant',
-                    content=feedback_content,
-                    conversation_session=session
-                )
-                
-                # Create continuation message
-                continuation_content = f"✅ Great! Now let's continue...\n\n{next_exchange['bot_says']}"
-                
-                continuation_message = Message.objects.create(
+            self._save_answer(room, session, [
+                user_message,
+                Message(room=room, role='assistant', content=feedback_content, conversation_session=session),
+                Message(
                     room=room,
                     role='assistant',
                     content=continuation_content,
                     conversation_session=session,
                     original_text=next_exchange['user_should_say']
-                )
-                
-                return JsonResponse({
-                    'success': True,
-                    'user_message': {
-                        'role': 'user',
-                        'content': user_input,
-                        'spelling_score': spelling_score
-                    },
-                    'feedback_message': {
-                        'role': 'assistant',
-                        'content': feedback_content
-                    },
-                    'continuation_message': {
-                        'role': 'assistant',
-                        'content': continuation_content
-                    },
-                    'expected_response': next_exchange['user_should_say'],
-                    'exchange_number': next_exchange['exchange_number'],
-                    'total_exchanges': session.dialogue.total_exchanges,
-                    'word_comparison': word_comparison,
-                    'previous_expected': expected_response,
-                    'current_exchange_index': session.current_exchange_index  # Add this to help track progress
-                })
+                ),
+            ], advance=True)
+            
+            return {
+                'success': True,
+                'user_message': {
+                    'role': 'user',
+                    'content': user_input,
+                    'spelling_score': spelling_score
+                },
+                'feedback_message': {
+                    'role': 'assistant',
+                    'content': feedback_content
+                },
+                'continuation_message': {
+                    'role': 'assistant',
+                    'content': continuation_content
+                },
+                'expected_response': next_exchange['user_should_say'],
+                'exchange_number': next_exchange['exchange_number'],
+                'total_exchanges': session.dialogue.total_exchanges,
+                'word_comparison': word_comparison,
+                'previous_expected': expected_response,
+                'current_exchange_index': session.current_exchange_index  # Add this to help track progress
+            }
         else:
             # Pronunciation needs improvement - don't advance
             current_exchange = session.get_current_exchange()
-            detailed_feedback = generate_detailed_feedback()
+            response_content = f"{feedback_content}\n\n🔄 Let's try again! Please say: '{expected_response}'\n\n(You need at least 70% accuracy to continue)"
             
-            response_content = f"🎯 YOUR RESPONSE: '{user_input}'\n📊 SCORE: {spelling_score}%\n🎯 CORRECT RESPONSE: '{expected_response}'\n\n{detailed_feedback}\n\n🔄 Let's try again! Please say: '{expected_response}'\n\n(You need at least 70% accuracy to continue)"
-            
-            assistant_message = Message.objects.create(
-                room=room,
-                role='assistant',
-                content=response_content,
-                conversation_session=session,
-                original_text=expected_response
-            )
+            self._save_answer(room, session, [
+                user_message,
+                Message(
+                    room=room,
+                    role='assistant',
+                    content=response_content,
+                    conversation_session=session,
+                    original_text=expected_response
+                ),
+            ])
             
-            return JsonResponse({
+            return {
                 'success': True,
                 'needs_retry': True,
                 'user_message': {
@@ -560,8 +575,9 @@ class MessageView(LoginRequiredMixin, View):
                 'total_exchanges': session.dialogue.total_exchanges,
                 'word_comparison': word_comparison,
                 'current_exchange_index': session.current_exchange_index
-            })
+            }
 
+@query_budget(8)
 @require_http_methods(["GET", "POST"])
 def login_view(request):
     if request.method == 'POST':
@@ -607,6 +623,7 @@ def login_view(request):
     
     return render(request, 'login.html')
 
+@query_budget(9)
 @require_http_methods(["GET", "POST"])
 def signup_view(request):
     if request.method == 'POST':
@@ -650,11 +667,13 @@ def signup_view(request):
     
     return render(request, 'signup.html')
 
+@query_budget(4)
 @require_http_methods(["GET"])
 def logout_view(request):
     logout(request)
     return redirect('login')
 
+@query_budget(0)
 @csrf_exempt
 def test_csrf(request):
     """Test endpoint to check CSRF functionality"""